@@ -0,0 +1,130 @@
+# semantic answer cache in front of the llm call - near-duplicate questions that retrieve the same
+# chunks for the same role/model/prompt get the stored answer back instead of a new generation
+
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    # in-memory LRU of answers, bucketed by exact retrieval key and matched by question embedding similarity
+
+    def __init__(self, similarity_threshold: float = 0.95, ttl_seconds: float = 3600, max_entries: int = 1000):
+
+        # similarity_threshold: min cosine similarity between question embeddings to count as the same question
+        # ttl_seconds: entries older than this are never served
+        # max_entries: LRU bound across all buckets
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # entry id -> entry dict, oldest first
+        self._buckets = {}  # bucket key -> set of entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _bucket_key(self, user_role: str, k: int, chunk_ids: List[str], model_name: str, prompt_version: str) -> Tuple:
+        # chunk ids are part of the key, so re-ingested chunks (new ids) never match old answers
+        return (user_role, k, tuple(chunk_ids), model_name, prompt_version)
+
+    def _normalize(self, embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        bucket = self._buckets.get(entry["bucket"])
+        if bucket is not None:
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._buckets[entry["bucket"]]
+
+    def get(self, question_embedding: List[float], user_role: str, k: int, chunk_ids: List[str],
+            model_name: str, prompt_version: str) -> Optional[str]:
+
+        # to get a cached answer for a near-duplicate question, None on miss
+        bucket_key = self._bucket_key(user_role, k, chunk_ids, model_name, prompt_version)
+        query_vector = self._normalize(question_embedding)
+        now = time.time()
+
+        with self._lock:
+            best_id = None
+            best_similarity = self.similarity_threshold
+
+            for entry_id in list(self._buckets.get(bucket_key, ())):
+                entry = self._entries[entry_id]
+
+                if now - entry["created_at"] > self.ttl_seconds:
+                    self._remove(entry_id)
+                    continue
+
+                similarity = float(np.dot(query_vector, entry["embedding"]))
+                if similarity >= best_similarity:
+                    best_id = entry_id
+                    best_similarity = similarity
+
+            if best_id is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id]["answer"]
+
+    def put(self, question_embedding: List[float], user_role: str, k: int, chunk_ids: List[str],
+            model_name: str, prompt_version: str, answer: str):
+
+        # to store an answer, evicting least recently used entries above max_entries
+        bucket_key = self._bucket_key(user_role, k, chunk_ids, model_name, prompt_version)
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+
+            self._entries[entry_id] = {
+                "bucket": bucket_key,
+                "embedding": self._normalize(question_embedding),
+                "answer": answer,
+                "created_at": time.time()
+            }
+            self._buckets.setdefault(bucket_key, set()).add(entry_id)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, chunk_ids: Optional[List[str]] = None) -> int:
+
+        # to drop entries built on any of the given chunks (all entries if None), returns count dropped
+        with self._lock:
+            if chunk_ids is None:
+                dropped = len(self._entries)
+                self._entries.clear()
+                self._buckets.clear()
+                return dropped
+
+            stale = set(chunk_ids)
+            stale_entries = [
+                entry_id for entry_id, entry in self._entries.items()
+                if stale.intersection(entry["bucket"][2])
+            ]
+            for entry_id in stale_entries:
+                self._remove(entry_id)
+            return len(stale_entries)
+
+    def get_statistics(self) -> Dict:
+
+        # to get hit/miss counters and current size
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries
+        }
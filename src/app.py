@@ -12,6 +12,7 @@ sys.path.append(str(Path(__file__).parent))
 
 from vectorstore import VectorStoreManager
 from rag import RAGRetriever
+from canned_questions import EXAMPLE_QUESTIONS
 
 # page configuration
 st.set_page_config(
@@ -127,7 +128,10 @@ def load_rag_system():
         vector_manager = VectorStoreManager(persist_directory="./chroma_db")
         if not vector_manager.load_vectorstore():
             return None, "Failed to load vector store from ./chroma_db. Please ensure the vector store exists."
-        rag = RAGRetriever(vector_manager, temperature=0.2)
+        # load the embedding model in the background while the page renders
+        vector_manager.warm_up()
+        # hybrid retrieval so exact identifiers (ADR 015, postmortem 089, endpoint names) are found
+        rag = RAGRetriever(vector_manager, temperature=0.2, retrieval_mode="hybrid")
         return rag, None
     except Exception as e:
         return None, str(e)
@@ -168,6 +172,30 @@ def save_feedback(message_id, question, answer, rating, comment):
     return True
 
 
+def format_timings(timings):
+    # one line per answer: total time, then each stage in the order it ran
+    parts = [f"{stage} {elapsed_ms:.0f} ms" for stage, elapsed_ms in timings["stages"].items()]
+    if timings.get("llm_ttft_ms") is not None:
+        parts.append(f"first token {timings['llm_ttft_ms']:.0f} ms")
+    if timings.get("tokens_in"):
+        parts.append(f"tokens {timings['tokens_in']} in / {timings.get('tokens_out', 0)} out")
+    return f"**Timings:** {timings['total_ms']:.0f} ms total - " + ", ".join(parts)
+
+
+def format_chunk_score(chunk):
+    # hybrid scores are rrf fusion scores (higher is better) and mean little on their own, so the vector
+    # and bm25 ranks they come from are shown too, vector mode scores are distances (lower is better)
+    if chunk.get("score_type") == "rrf":
+        vector_rank = f"#{chunk['dense_rank']}" if "dense_rank" in chunk else "-"
+        bm25_rank = f"#{chunk['lexical_rank']}" if "lexical_rank" in chunk else "-"
+        label = f"**RRF score:** {chunk['score']:.4f} | **Vector rank:** {vector_rank} | **BM25 rank:** {bm25_rank}"
+    else:
+        label = f"**Distance:** {chunk['score']:.4f}"
+    if "rerank_score" in chunk:
+        label += f" | **Rerank score:** {chunk['rerank_score']:.2f}"
+    return label
+
+
 def main():
     # init chat history
     if "messages" not in st.session_state:
@@ -293,26 +321,20 @@ def main():
                             if source_chunks:
                                 for chunk in source_chunks:
                                     st.markdown(f'<div style="background-color: #f8f9fa; padding: 10px; margin: 5px 0; border-left: 3px solid #5ba6fd; border-radius: 3px;">', unsafe_allow_html=True)
-                                    st.markdown(f"**Rank:** #{chunk['rank']} | **Relevance:** {chunk['score']:.4f}")
+                                    st.markdown(f"**Rank:** #{chunk['rank']} | {format_chunk_score(chunk)}")
                                     st.text(chunk['preview'])
                                     st.markdown('</div>', unsafe_allow_html=True)
                         st.markdown("---")
+                    
+                    if message.get("timings"):
+                        st.caption(format_timings(message["timings"]))
     
     # example questions (only show if no messages)
     if not st.session_state.messages:
         st.subheader("Example Questions")
         example_cols = st.columns(3)
         
-        examples = [
-            "What is our KYC verification process?",
-            "How does fraud detection work?",
-            "What were Q3 2024 results?",
-            "Explain the payment retry logic",
-            "What caused the October incident?",
-            "What are our Q4 OKR priorities?"
-        ]
-        
-        for i, example in enumerate(examples):
+        for i, example in enumerate(EXAMPLE_QUESTIONS):
             col = example_cols[i % 3]
             if col.button(example, key=f"ex_{i}"):
                 st.session_state.current_question = example
@@ -347,9 +369,20 @@ def main():
     if ask_button and question.strip():
         # add user message to chat
         st.session_state.messages.append({"role": "user", "content": question})
+        st.markdown(f'<div style="background-color: #f0f0f0; padding: 15px; border-radius: 10px; margin: 10px 0;"><strong>You:</strong><br>{question}</div>', unsafe_allow_html=True)
+        
+        # render tokens as they arrive instead of waiting for the full answer
+        answer_placeholder = st.empty()
+        answer_placeholder.markdown('<div style="background-color: white; border: 2px solid #5ba6fd; padding: 15px; border-radius: 10px; margin: 10px 0;"><strong>Assistant:</strong><br><em>Searching the knowledge base...</em></div>', unsafe_allow_html=True)
         
-        with st.spinner("Processing..."):
-            result = rag.query_with_context(question, k=num_sources, user_role=user_role)
+        streamed_answer = ""
+        result = None
+        for event in rag.stream_query_with_context(question, k=num_sources, user_role=user_role):
+            if event["type"] == "token":
+                streamed_answer += event["content"]
+                answer_placeholder.markdown(f'<div style="background-color: white; border: 2px solid #5ba6fd; padding: 15px; border-radius: 10px; margin: 10px 0;"><strong>Assistant:</strong><br>{streamed_answer}</div>', unsafe_allow_html=True)
+            else:
+                result = event
         
         if not result["error"]:
             # add assistant message to chat with unique message ID
@@ -359,6 +392,7 @@ def main():
                 "content": result["answer"],
                 "sources": result["sources"],
                 "chunks": result.get("chunks", []),
+                "timings": result.get("timings"),
                 "message_id": message_id
             })
         else:
@@ -0,0 +1,401 @@
+# vector storage backends behind VectorStoreManager - chroma (hnsw + sqlite) or a numpy backend doing exact
+# search with one matrix multiply over memory mapped, normalized vectors
+
+import os
+import json
+import shutil
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Iterator
+
+import numpy as np
+
+from compact_index import ColumnarMetadata, top_k_indices
+
+COLLECTION_NAME = "skyro_knowledge"
+NUMPY_INDEX_DIRNAME = "numpy_index"
+CHROMA_DATABASE_FILENAME = "chroma.sqlite3"
+
+
+class VectorBackend(ABC):
+    # what VectorStoreManager needs from a vector store: ids, embeddings, texts and metadata per chunk,
+    # top k search by embedding with a chroma style where clause
+    # distances are squared l2, smaller = more similar
+    # abstract, so a backend missing a method fails when it is created, not in the middle of a query
+
+    name = "base"
+
+    @abstractmethod
+    def load(self) -> bool:
+        # to open persisted data, False if there is none
+        raise NotImplementedError
+
+    @abstractmethod
+    def open(self):
+        # to open persisted data or start an empty store
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_loaded(self) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add(self, ids: List[str], embeddings: List[List[float]], texts: List[str], metadatas: List[Dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, ids: List[str]) -> List[Tuple[str, str, Dict]]:
+        # to fetch (id, text, metadata) for the ids that exist
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_ids(self, filter_dict: Dict) -> List[str]:
+        # to list the ids whose metadata matches a where clause
+        raise NotImplementedError
+
+    @abstractmethod
+    def query(self, query_embeddings: List[List[float]], k: int,
+              filter_dict: Optional[Dict] = None) -> List[List[Tuple[str, float]]]:
+        # to get the top k (id, distance) pairs per query
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_batches(self, batch_size: int = 5000, include_embeddings: bool = True) -> Iterator[Dict]:
+        # to page through everything as {"ids", "embeddings", "documents", "metadatas"} dicts
+        raise NotImplementedError
+
+    @abstractmethod
+    def persist(self):
+        raise NotImplementedError
+
+
+class ChromaBackend(VectorBackend):
+    # the skyro_knowledge chroma collection, through langchain's Chroma wrapper
+
+    name = "chroma"
+
+    def __init__(self, persist_directory: str, embedding_function=None):
+        self.persist_directory = persist_directory
+        self.embedding_function = embedding_function
+        self.vectorstore = None
+
+    def load(self) -> bool:
+        # the persist dir alone may only hold the embedding cache or the manifest
+        if not (Path(self.persist_directory) / CHROMA_DATABASE_FILENAME).exists():
+            return False
+        self.open()
+        return True
+
+    def open(self):
+        if self.vectorstore is None:
+            from langchain.vectorstores import Chroma
+
+            self.vectorstore = Chroma(
+                persist_directory=self.persist_directory,
+                embedding_function=self.embedding_function,
+                collection_name=COLLECTION_NAME
+            )
+
+    def is_loaded(self) -> bool:
+        return self.vectorstore is not None
+
+    @property
+    def collection(self):
+        return self.vectorstore._collection
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def add(self, ids: List[str], embeddings: List[List[float]], texts: List[str], metadatas: List[Dict]):
+        # upsert, chunk ids are content derived so a resync writes ids that were deleted before, and chroma's
+        # hnsw segment silently drops an add of a deleted id
+        self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+
+    def delete(self, ids: List[str]):
+        if ids:
+            self.collection.delete(ids=ids)
+
+    def get(self, ids: List[str]) -> List[Tuple[str, str, Dict]]:
+        if not ids:
+            return []
+        fetched = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return [
+            (doc_id, text, metadata or {})
+            for doc_id, text, metadata in zip(fetched["ids"], fetched["documents"], fetched["metadatas"])
+        ]
+
+    def get_ids(self, filter_dict: Dict) -> List[str]:
+        return self.collection.get(where=filter_dict, include=[])["ids"]
+
+    def query(self, query_embeddings: List[List[float]], k: int,
+              filter_dict: Optional[Dict] = None) -> List[List[Tuple[str, float]]]:
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=k,
+            where=filter_dict or None,
+            include=["distances"]
+        )
+        return [list(zip(ids, distances)) for ids, distances in zip(results["ids"], results["distances"])]
+
+    def iter_batches(self, batch_size: int = 5000, include_embeddings: bool = True) -> Iterator[Dict]:
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        for offset in range(0, self.count(), batch_size):
+            yield self.collection.get(offset=offset, limit=batch_size, include=include)
+
+    def persist(self):
+        if self.vectorstore is not None:
+            self.vectorstore.persist()
+
+
+class NumpyBackend(VectorBackend):
+    # exact search over all vectors with one matrix multiply, for collections small enough to scan
+    # files (in persist_directory/numpy_index): float32 vectors as .npy (memory mapped, so worker
+    # processes share one page cached copy), texts as one utf-8 blob + offsets, metadata as columns
+    # added chunks are kept in memory and deletes as a row mask until persist() rewrites the files
+
+    name = "numpy"
+
+    VECTORS_FILENAME = "vectors.npy"
+    TEXTS_FILENAME = "texts.bin"
+    TEXT_OFFSETS_FILENAME = "text_offsets.npy"
+    INFO_FILENAME = "index.json"
+
+    def __init__(self, persist_directory: str, block_rows: int = 65536):
+
+        # block_rows: rows multiplied per step in query, bounds the float32 copy read from the memory map
+        #   (the score matrix itself still has one entry per row and query)
+        self.directory = Path(persist_directory) / NUMPY_INDEX_DIRNAME
+        self.block_rows = block_rows
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.ids = []
+        self.row_by_id = {}
+        self.vectors = None
+        self.texts = None
+        self.text_offsets = None
+        self.metadata = None
+        self.deleted = np.zeros(0, dtype=bool)
+        self.pending = []  # (id, embedding, text, metadata) added since the last persist
+
+    def load(self) -> bool:
+        old_dir = self.directory.with_name(self.directory.name + ".old")
+        if not (self.directory / self.INFO_FILENAME).exists() and (old_dir / self.INFO_FILENAME).exists():
+            # persist() stopped between moving the old files aside and moving the new ones in
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.replace(old_dir, self.directory)
+        if not (self.directory / self.INFO_FILENAME).exists():
+            return False
+
+        with open(self.directory / self.INFO_FILENAME, 'r') as f:
+            info = json.load(f)
+
+        self._reset()
+        self.ids = info["ids"]
+        self.row_by_id = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self.vectors = np.load(self.directory / self.VECTORS_FILENAME, mmap_mode='r')
+        self.texts = np.memmap(self.directory / self.TEXTS_FILENAME, dtype=np.uint8, mode='r') \
+            if os.path.getsize(self.directory / self.TEXTS_FILENAME) else np.zeros(0, dtype=np.uint8)
+        self.text_offsets = np.load(self.directory / self.TEXT_OFFSETS_FILENAME)
+        self.metadata = ColumnarMetadata.load(self.directory, info)
+        self.deleted = np.zeros(len(self.ids), dtype=bool)
+        self.loaded = True
+        return True
+
+    def open(self):
+        if not self.loaded and not self.load():
+            self.loaded = True
+
+    def is_loaded(self) -> bool:
+        return self.loaded
+
+    def count(self) -> int:
+        return len(self.ids) - int(self.deleted.sum()) + len(self.pending)
+
+    def add(self, ids: List[str], embeddings: List[List[float]], texts: List[str], metadatas: List[Dict]):
+        # re-adding an existing id replaces it
+        self.delete([doc_id for doc_id in ids if doc_id in self.row_by_id])
+        pending_ids = set(ids)
+        self.pending = [item for item in self.pending if item[0] not in pending_ids]
+        self.pending.extend(zip(ids, np.asarray(embeddings, dtype=np.float32), texts, metadatas))
+
+    def delete(self, ids: List[str]):
+        removed = set()
+        for doc_id in ids:
+            row = self.row_by_id.get(doc_id)
+            if row is not None:
+                self.deleted[row] = True
+            removed.add(doc_id)
+        if self.pending:
+            self.pending = [item for item in self.pending if item[0] not in removed]
+
+    def _text(self, row: int) -> str:
+        return bytes(self.texts[self.text_offsets[row]:self.text_offsets[row + 1]]).decode('utf-8')
+
+    def get(self, ids: List[str]) -> List[Tuple[str, str, Dict]]:
+        pending = {item[0]: item for item in self.pending}
+        found = []
+        for doc_id in ids:
+            row = self.row_by_id.get(doc_id)
+            if row is not None and not self.deleted[row]:
+                found.append((doc_id, self._text(row), self.metadata.get(row)))
+            elif doc_id in pending:
+                found.append((doc_id, pending[doc_id][2], dict(pending[doc_id][3])))
+        return found
+
+    def _persisted_mask(self, filter_dict: Optional[Dict]) -> Optional[np.ndarray]:
+        # rows of the persisted part that are searchable, None = all of them
+        mask = self.metadata.mask(filter_dict) if self.metadata is not None else None
+        if self.deleted.any():
+            mask = ~self.deleted if mask is None else mask & ~self.deleted
+        return mask
+
+    def _pending_matches(self, filter_dict: Optional[Dict]) -> List[bool]:
+        from lexical_index import matches_filter
+        return [matches_filter(item[3], filter_dict) for item in self.pending]
+
+    def get_ids(self, filter_dict: Dict) -> List[str]:
+        ids = []
+        if self.ids:
+            mask = self._persisted_mask(filter_dict)
+            rows = np.arange(len(self.ids)) if mask is None else np.flatnonzero(mask)
+            ids.extend(self.ids[row] for row in rows)
+        ids.extend(item[0] for item, match in zip(self.pending, self._pending_matches(filter_dict)) if match)
+        return ids
+
+    def query(self, query_embeddings: List[List[float]], k: int,
+              filter_dict: Optional[Dict] = None) -> List[List[Tuple[str, float]]]:
+
+        # cosine similarity = dot product for normalized vectors, distance = 2 - 2 * cosine like chroma's l2
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+
+        candidate_ids = []
+        candidate_scores = []
+
+        if self.ids:
+            scores = np.empty((len(self.ids), len(queries)), dtype=np.float32)
+            for start in range(0, len(self.ids), self.block_rows):
+                scores[start:start + self.block_rows] = np.asarray(self.vectors[start:start + self.block_rows]) @ queries.T
+
+            mask = self._persisted_mask(filter_dict)
+            if mask is not None:
+                scores[~mask] = -np.inf
+            candidate_ids.append(self.ids)
+            candidate_scores.append(scores)
+
+        if self.pending:
+            matches = np.array(self._pending_matches(filter_dict), dtype=bool)
+            scores = np.stack([item[1] for item in self.pending]) @ queries.T
+            scores[~matches] = -np.inf
+            candidate_ids.append([item[0] for item in self.pending])
+            candidate_scores.append(scores)
+
+        if not candidate_scores:
+            return [[] for _ in queries]
+
+        all_ids = candidate_ids[0] if len(candidate_ids) == 1 else [doc_id for ids in candidate_ids for doc_id in ids]
+        all_scores = candidate_scores[0] if len(candidate_scores) == 1 else np.vstack(candidate_scores)
+
+        results = []
+        for column in range(len(queries)):
+            rows = top_k_indices(all_scores[:, column], k)
+            rows = rows[np.isfinite(all_scores[rows, column])]
+            results.append([(all_ids[row], float(2.0 - 2.0 * all_scores[row, column])) for row in rows])
+        return results
+
+    def iter_batches(self, batch_size: int = 5000, include_embeddings: bool = True) -> Iterator[Dict]:
+        rows = [row for row in range(len(self.ids)) if not self.deleted[row]]
+        for start in range(0, len(rows), batch_size):
+            batch_rows = rows[start:start + batch_size]
+            yield {
+                "ids": [self.ids[row] for row in batch_rows],
+                "embeddings": np.asarray(self.vectors[batch_rows]).tolist() if include_embeddings else None,
+                "documents": [self._text(row) for row in batch_rows],
+                "metadatas": [self.metadata.get(row) for row in batch_rows]
+            }
+
+        for start in range(0, len(self.pending), batch_size):
+            batch = self.pending[start:start + batch_size]
+            yield {
+                "ids": [item[0] for item in batch],
+                "embeddings": [item[1].tolist() for item in batch] if include_embeddings else None,
+                "documents": [item[2] for item in batch],
+                "metadatas": [dict(item[3]) for item in batch]
+            }
+
+    def persist(self):
+
+        # to write kept rows + pending chunks to new files and swap them in, streaming in batches
+        if not self.loaded or (not self.pending and not self.deleted.any() and self.directory.exists()):
+            return
+
+        count = self.count()
+        dimension = self.vectors.shape[1] if self.vectors is not None else (len(self.pending[0][1]) if self.pending else 0)
+        tmp_dir = self.directory.with_name(self.directory.name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        vectors = np.lib.format.open_memmap(
+            tmp_dir / self.VECTORS_FILENAME, mode='w+', dtype=np.float32, shape=(count, dimension)
+        )
+        ids = []
+        metadatas = []
+        offsets = [0]
+
+        with open(tmp_dir / self.TEXTS_FILENAME, 'wb') as texts_file:
+            for batch in self.iter_batches():
+                vectors[len(ids):len(ids) + len(batch["ids"])] = np.asarray(batch["embeddings"], dtype=np.float32)
+                ids.extend(batch["ids"])
+                metadatas.extend(batch["metadatas"])
+                for text in batch["documents"]:
+                    encoded = text.encode('utf-8')
+                    texts_file.write(encoded)
+                    offsets.append(offsets[-1] + len(encoded))
+
+        vectors.flush()
+        del vectors
+        np.save(tmp_dir / self.TEXT_OFFSETS_FILENAME, np.array(offsets, dtype=np.int64))
+
+        # every metadata field becomes a column, so any where clause chroma supports can be evaluated
+        fields = sorted({field for metadata in metadatas for field in metadata})
+        info = {"ids": ids, "dimension": dimension}
+        ColumnarMetadata.from_metadatas(fields, metadatas).save(tmp_dir, info)
+        with open(tmp_dir / self.INFO_FILENAME, 'w') as f:
+            json.dump(info, f)
+
+        # drop the memory maps of the old files before replacing them, the old dir is moved aside (not
+        # deleted) until the new one is in place, so a crash in between leaves a copy load() restores
+        self._reset()
+        old_dir = self.directory.with_name(self.directory.name + ".old")
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if self.directory.exists():
+            os.replace(self.directory, old_dir)
+        os.replace(tmp_dir, self.directory)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.load()
+
+
+BACKENDS = {
+    "chroma": ChromaBackend,
+    "numpy": NumpyBackend
+}
+
+
+def create_backend(name: str, persist_directory: str, embedding_function=None) -> VectorBackend:
+    # to construct a backend by name
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown vector backend: {name} (available: {', '.join(BACKENDS)})")
+    if name == "chroma":
+        return ChromaBackend(persist_directory, embedding_function=embedding_function)
+    return BACKENDS[name](persist_directory)
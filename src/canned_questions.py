@@ -0,0 +1,28 @@
+# questions we know will be asked - the app's example buttons and the model comparison set
+# their embeddings are precomputed at ingest time (VectorStoreManager.build_query_embedding_table)
+
+# example question buttons in app.py
+EXAMPLE_QUESTIONS = [
+    "What is our KYC verification process?",
+    "How does fraud detection work?",
+    "What were Q3 2024 results?",
+    "Explain the payment retry logic",
+    "What caused the October incident?",
+    "What are our Q4 OKR priorities?"
+]
+
+# test questions for llm_comparison.py
+TEST_QUESTIONS = [
+    "What is our KYC verification process?",
+    "How does the fraud detection system work?",
+    "What were the Q3 2024 business results?",
+    "Explain the payment retry logic",
+    "What caused the October incident?",
+    "What are our Q4 OKR priorities?",
+    "How long does a refund take?",
+    "What are the KYC transaction limits?",
+    "Describe the database selection decision",
+    "What is the incident response procedure?"
+]
+
+CANNED_QUESTIONS = list(dict.fromkeys(EXAMPLE_QUESTIONS + TEST_QUESTIONS))
@@ -0,0 +1,266 @@
+# structure-aware chunking for markdown - chunks follow section headings, tables and code blocks are never
+# cut in the middle, and every chunk records the heading path it sits under. pdf/docx text has no reliable
+# structure left and goes through the recursive character splitter
+
+import re
+from typing import List, Dict, Optional
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+TABLE_ROW_PATTERN = re.compile(r"^\s*\|")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\s*\|?\s*:?-{3,}")
+
+# separator between levels of the heading_path metadata
+HEADING_PATH_SEPARATOR = " > "
+
+# chunk size / overlap per category (DocumentIngester(chunk_profiles=CHUNK_PROFILES)), reference documents
+# with long sections and tables get larger chunks so a section stays whole, short faq style answers smaller ones
+# categories not listed use the ingester's chunk_size / chunk_overlap
+CHUNK_PROFILES = {
+    "Technical Documentation": {"chunk_size": 1500, "chunk_overlap": 200},
+    "Product Specifications": {"chunk_size": 1200, "chunk_overlap": 200},
+    "Compliance": {"chunk_size": 1200, "chunk_overlap": 200},
+    "Security": {"chunk_size": 1200, "chunk_overlap": 200},
+    "Customer Support": {"chunk_size": 700, "chunk_overlap": 100},
+    "Meetings & Planning": {"chunk_size": 800, "chunk_overlap": 150}
+}
+
+
+def parse_markdown_blocks(text: str) -> List[Dict]:
+
+    # to split markdown into blocks: headings, paragraphs (anything up to a blank line), tables and fenced code
+    # every block has kind, text, start (char offset in text) and heading_path (titles of the enclosing
+    # headings, a heading block includes its own title)
+    blocks = []
+    headings = []  # (level, title) of the open sections
+    lines = text.splitlines(keepends=True)
+    offset = 0
+    i = 0
+
+    def heading_path():
+        return tuple(title for level, title in headings)
+
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+
+        if not stripped:
+            offset += len(line)
+            i += 1
+            continue
+
+        start = offset
+        heading_match = HEADING_PATTERN.match(line.rstrip("\n"))
+
+        if heading_match:
+            level = len(heading_match.group(1))
+            while headings and headings[-1][0] >= level:
+                headings.pop()
+            headings.append((level, heading_match.group(2).strip()))
+            block_lines = [line]
+            kind = "heading"
+            i += 1
+
+        elif FENCE_PATTERN.match(line):
+            # fenced code runs to the closing fence (or the end of the file if it is never closed)
+            fence = FENCE_PATTERN.match(line).group(1)
+            block_lines = [line]
+            i += 1
+            while i < len(lines):
+                block_lines.append(lines[i])
+                i += 1
+                if lines[i - 1].strip().startswith(fence):
+                    break
+            kind = "code"
+
+        elif TABLE_ROW_PATTERN.match(line):
+            block_lines = []
+            while i < len(lines) and TABLE_ROW_PATTERN.match(lines[i]):
+                block_lines.append(lines[i])
+                i += 1
+            kind = "table"
+
+        else:
+            # a paragraph or list ends at a blank line or where a heading, table or code block starts
+            block_lines = []
+            while i < len(lines) and lines[i].strip() and not (
+                    HEADING_PATTERN.match(lines[i].rstrip("\n")) or FENCE_PATTERN.match(lines[i])
+                    or TABLE_ROW_PATTERN.match(lines[i])):
+                block_lines.append(lines[i])
+                i += 1
+            kind = "text"
+
+        block_text = "".join(block_lines)
+        offset += len(block_text)
+        blocks.append({
+            "kind": kind,
+            "text": block_text.rstrip(),
+            "start": start,
+            "heading_path": heading_path()
+        })
+
+    return blocks
+
+
+class MarkdownChunker:
+    # packs markdown blocks into chunks of up to chunk_size characters along section boundaries
+
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200, min_section_size: Optional[int] = None,
+                 max_atomic_size: Optional[int] = None):
+
+        # chunk_size: target max characters per chunk
+        # chunk_overlap: overlap used when a single paragraph is longer than chunk_size and has to be split,
+        #   chunks made of whole blocks don't overlap
+        # min_section_size: a section shorter than this is merged with its first subsection (title + first
+        #   section, a heading with only subsections under it), defaults to chunk_size / 4
+        # max_atomic_size: tables and code blocks up to this size are kept whole even over chunk_size,
+        #   larger ones are split by rows / lines, defaults to 2 * chunk_size
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.min_section_size = min_section_size if min_section_size is not None else chunk_size // 4
+        self.max_atomic_size = max_atomic_size if max_atomic_size is not None else 2 * chunk_size
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=len,
+            separators=["\n\n", "\n", ". ", " ", ""]
+        )
+
+    def _sections(self, blocks: List[Dict]) -> List[Dict]:
+        # to group blocks by heading, then merge sections too small to stand alone into the next one
+        sections = []
+        for block in blocks:
+            if block["kind"] == "heading" or not sections:
+                sections.append({"heading_path": block["heading_path"], "blocks": []})
+            sections[-1]["blocks"].append(block)
+
+        merged = []
+        for section in sections:
+            previous = merged[-1] if merged else None
+            bare = previous is not None and all(block["kind"] == "heading" for block in previous["blocks"])
+            # only a parent absorbs its child (title + first section, a heading with only subsections), so
+            # the merged chunk still sits under the parent's heading path
+            # a bare heading always goes with its first subsection, it says nothing on its own
+            if previous and section["heading_path"][:len(previous["heading_path"])] == previous["heading_path"] and (
+                    len(previous["blocks"]) == 1 or bare or
+                    self._size(previous["blocks"]) < self.min_section_size and
+                    self._size(previous["blocks"] + section["blocks"]) <= self.chunk_size):
+                previous["blocks"].extend(section["blocks"])
+            elif bare:
+                # a bare heading followed by a sibling (or a shallower heading) goes in front of it and
+                # under its heading path, the chunk is about the section with content
+                merged[-1] = {
+                    "heading_path": section["heading_path"],
+                    "blocks": [{**block, "heading_path": section["heading_path"]} for block in previous["blocks"]]
+                    + section["blocks"]
+                }
+            else:
+                merged.append(section)
+
+        # bare headings at the end of the file have nothing after them, they close the section before
+        if len(merged) > 1 and all(block["kind"] == "heading" for block in merged[-1]["blocks"]):
+            merged[-2]["blocks"].extend(merged.pop()["blocks"])
+        return merged
+
+    def _size(self, blocks: List[Dict]) -> int:
+        return sum(len(block["text"]) + 2 for block in blocks)
+
+    def _split_block(self, block: Dict) -> List[Dict]:
+        # to cut a block that doesn't fit into pieces that do, tables repeat their header row in every piece
+        # and code pieces are re-fenced, so each piece is still valid markdown
+        if block["kind"] in ("table", "code"):
+            if len(block["text"]) <= self.max_atomic_size:
+                return [block]
+        elif len(block["text"]) <= self.chunk_size:
+            return [block]
+
+        lines = block["text"].split("\n")
+
+        if block["kind"] == "table":
+            header_size = 2 if len(lines) > 1 and TABLE_SEPARATOR_PATTERN.match(lines[1]) else 1
+            prefix, body, suffix = lines[:header_size], lines[header_size:], []
+        elif block["kind"] == "code":
+            closed = len(lines) > 1 and FENCE_PATTERN.match(lines[-1])
+            prefix, body = lines[:1], lines[1:-1] if closed else lines[1:]
+            suffix = [FENCE_PATTERN.match(lines[0]).group(1)]
+        else:
+            pieces = []
+            cursor = 0
+            for text in self.text_splitter.split_text(block["text"]):
+                position = block["text"].find(text, cursor)
+                if position >= 0:
+                    cursor = position
+                pieces.append({**block, "text": text, "start": block["start"] + max(position, 0)})
+            return pieces
+
+        pieces = []
+        current = []
+        current_start = block["start"]
+        position = block["start"] + sum(len(line) + 1 for line in prefix)
+        budget = self.chunk_size - sum(len(line) + 1 for line in prefix + suffix)
+
+        for line in body:
+            if current and sum(len(part) + 1 for part in current) + len(line) > budget:
+                pieces.append({**block, "text": "\n".join(prefix + current + suffix), "start": current_start})
+                current = []
+                current_start = position
+            current.append(line)
+            position += len(line) + 1
+
+        if current or not pieces:
+            pieces.append({**block, "text": "\n".join(prefix + current + suffix), "start": current_start})
+        return pieces
+
+    def split_text(self, text: str) -> List[Dict]:
+
+        # to chunk one markdown text, returns dicts with text, heading_path (string) and start_index
+        # a chunk that continues a section starts with the nearest heading line again, so every chunk
+        # is embedded together with what it is about
+        chunks = []
+
+        for section in self._sections(parse_markdown_blocks(text)):
+            current = []
+            last_heading = None
+            repeated_heading = False
+
+            for block in section["blocks"]:
+                for piece in self._split_block(block):
+                    # headings stay with the content that follows them, even if that overflows the chunk
+                    has_content = any(part["kind"] != "heading" for part in current)
+                    if has_content and self._size(current) + len(piece["text"]) > self.chunk_size:
+                        chunks.append(self._make_chunk(current, repeated_heading))
+                        repeated_heading = last_heading is not None and piece["kind"] != "heading"
+                        current = [last_heading] if repeated_heading else []
+                    current.append(piece)
+                    if piece["kind"] == "heading":
+                        last_heading = piece
+
+            if any(part["kind"] != "heading" for part in current) or current and not chunks:
+                chunks.append(self._make_chunk(current, repeated_heading))
+
+        return chunks
+
+    def _make_chunk(self, blocks: List[Dict], repeated_heading: bool) -> Dict:
+        # a repeated heading is context, not content, so the chunk starts at its first new block
+        # the chunk sits under the headings of its first block
+        return {
+            "text": "\n\n".join(block["text"] for block in blocks),
+            "heading_path": HEADING_PATH_SEPARATOR.join(blocks[0]["heading_path"]),
+            "start_index": blocks[1]["start"] if repeated_heading else blocks[0]["start"]
+        }
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        # to chunk markdown documents, chunks keep the document metadata plus heading_path and start_index
+        chunks = []
+        for doc in documents:
+            for chunk in self.split_text(doc.page_content):
+                metadata = dict(doc.metadata)
+                metadata['start_index'] = chunk["start_index"]
+                if chunk["heading_path"]:
+                    metadata['heading_path'] = chunk["heading_path"]
+                chunks.append(Document(page_content=chunk["text"], metadata=metadata))
+        return chunks
+
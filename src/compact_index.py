@@ -0,0 +1,321 @@
+# compact int8 vector index kept next to the chroma collection - 4x smaller than float32 so large
+# collections stay in ram, approximate int8 scores pick candidates and full-precision vectors (memory
+# mapped, only the candidate rows are read) rescore them
+
+import os
+import json
+import hashlib
+import shutil
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Iterable
+
+import numpy as np
+
+from lexical_index import matches_filter
+
+INT8_VECTORS_FILENAME = "vectors_int8.npy"
+FLOAT_VECTORS_FILENAME = "vectors_f32.npy"
+SCALES_FILENAME = "scales.npy"
+METADATA_CODES_FILENAME = "metadata_codes.npy"
+INDEX_INFO_FILENAME = "index.json"
+
+
+def ids_digest(ids: Iterable[str]) -> str:
+    # to fingerprint a set of chunk ids (order independent), ids are content derived so this also
+    # changes when a chunk's text changes
+    digest = hashlib.sha256()
+    for doc_id in sorted(ids):
+        digest.update(doc_id.encode('utf-8') + b"\n")
+    return digest.hexdigest()
+
+
+class ColumnarMetadata:
+    # metadata fields stored as one integer code column per field plus the list of distinct values,
+    # so a where clause is evaluated once per distinct value combination instead of once per row
+
+    def __init__(self, fields: List[str], values: Dict[str, List], codes: np.ndarray):
+        self.fields = list(fields)
+        self.values = values  # field -> distinct values, code i means values[field][i]
+        self.codes = codes  # rows x fields, -1 = field missing
+
+    @classmethod
+    def from_metadatas(cls, fields: List[str], metadatas: Iterable[Dict]) -> "ColumnarMetadata":
+        lookups = {field: {} for field in fields}
+        rows = []
+        for metadata in metadatas:
+            row = []
+            for field in fields:
+                value = (metadata or {}).get(field)
+                if value is None:
+                    row.append(-1)
+                else:
+                    row.append(lookups[field].setdefault(value, len(lookups[field])))
+            rows.append(row)
+
+        codes = np.array(rows, dtype=np.int32).reshape(len(rows), len(fields))
+        return cls(fields, {field: list(lookup) for field, lookup in lookups.items()}, codes)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def get(self, row: int) -> Dict:
+        return {
+            field: self.values[field][code]
+            for field, code in zip(self.fields, self.codes[row]) if code >= 0
+        }
+
+    def mask(self, filter_dict: Optional[Dict]) -> Optional[np.ndarray]:
+
+        # to get a boolean row mask for a chroma style where clause, None means every row matches
+        if not filter_dict:
+            return None
+
+        columns = [i for i, field in enumerate(self.fields) if field in _filter_keys(filter_dict)]
+        if not columns:
+            # the filter only uses fields we don't store, nothing can match it
+            return np.zeros(len(self.codes), dtype=bool)
+
+        combinations, inverse = np.unique(self.codes[:, columns], axis=0, return_inverse=True)
+        matching = np.array([
+            matches_filter({
+                self.fields[column]: self.values[self.fields[column]][code]
+                for column, code in zip(columns, combination) if code >= 0
+            }, filter_dict)
+            for combination in combinations
+        ], dtype=bool)
+        return matching[inverse.reshape(-1)]
+
+    def save(self, directory: Path, info: Dict):
+        np.save(directory / METADATA_CODES_FILENAME, self.codes)
+        info["metadata_fields"] = self.fields
+        info["metadata_values"] = self.values
+
+    @classmethod
+    def load(cls, directory: Path, info: Dict) -> "ColumnarMetadata":
+        return cls(info["metadata_fields"], info["metadata_values"], np.load(directory / METADATA_CODES_FILENAME))
+
+
+def _filter_keys(filter_dict: Dict) -> set:
+    # metadata fields referenced by a where clause, including inside $and / $or
+    keys = set()
+    for key, condition in filter_dict.items():
+        if key in ("$and", "$or"):
+            for clause in condition:
+                keys |= _filter_keys(clause)
+        else:
+            keys.add(key)
+    return keys
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    # to get the indices of the k highest scores in descending order, argpartition keeps it linear
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class CompactVectorIndex:
+    # int8 vectors (per dimension scale) for candidate search + optional float32 vectors for rescoring
+
+    # metadata fields kept for role filtering and for mapping rows back to files
+    METADATA_FIELDS = ("category", "source", "full_path")
+
+    def __init__(self, directory: str, rescore_factor: int = 4, block_rows: int = 65536):
+
+        # directory: where the index files live
+        # rescore_factor: int8 candidates per requested result that get rescored in full precision,
+        #   higher = better recall, more float32 rows read per query
+        # block_rows: rows dequantized at a time, bounds the temporary float buffer per query
+        self.directory = Path(directory)
+        self.rescore_factor = rescore_factor
+        self.block_rows = block_rows
+        self.ids = None
+        self.int8_vectors = None
+        self.float_vectors = None
+        self.scales = None
+        self.metadata = None
+        self.ids_digest = None
+
+    def exists(self) -> bool:
+        return (self.directory / INDEX_INFO_FILENAME).exists()
+
+    def load(self) -> bool:
+
+        # to open the index files, vectors are memory mapped so workers share the page cache
+        if not self.exists():
+            return False
+
+        with open(self.directory / INDEX_INFO_FILENAME, 'r') as f:
+            info = json.load(f)
+
+        self.ids = info["ids"]
+        # indexes written before the digest was recorded never match a collection and get rebuilt
+        self.ids_digest = info.get("ids_digest")
+        self.scales = np.load(self.directory / SCALES_FILENAME)
+        self.int8_vectors = np.load(self.directory / INT8_VECTORS_FILENAME, mmap_mode='r')
+        float_path = self.directory / FLOAT_VECTORS_FILENAME
+        self.float_vectors = np.load(float_path, mmap_mode='r') if float_path.exists() else None
+        self.metadata = ColumnarMetadata.load(self.directory, info)
+        return True
+
+    def __len__(self) -> int:
+        return len(self.ids) if self.ids is not None else 0
+
+    def matches(self, ids: List[str]) -> bool:
+        # to check the index was built from exactly these chunks, a sync by a manager without the
+        # compact index leaves an old copy on disk
+        return len(ids) == len(self) and self.ids_digest == ids_digest(ids)
+
+    @classmethod
+    def build(cls, directory: str, count: int, dimension: int, batches: Iterable[Tuple[List[str], List, List[Dict]]],
+              keep_full_precision: bool = True, rescore_factor: int = 4,
+              block_rows: int = 65536) -> "CompactVectorIndex":
+
+        # to write a new index from (ids, vectors, metadatas) batches, count = total number of vectors
+        # keep_full_precision: also keep the float32 vectors for rescoring (4x the int8 size on disk,
+        #   but only the candidate rows are ever read)
+        # files are written to a temp dir first, a failed build leaves the old index in place
+        target = Path(directory)
+        tmp_dir = target.with_name(target.name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        # pass 1: float32 vectors to disk, track the largest magnitude per dimension for the int8 scale
+        float_vectors = np.lib.format.open_memmap(
+            tmp_dir / FLOAT_VECTORS_FILENAME, mode='w+', dtype=np.float32, shape=(count, dimension)
+        )
+        max_abs = np.zeros(dimension, dtype=np.float32)
+        ids = []
+        metadatas = []
+
+        for batch_ids, batch_vectors, batch_metadatas in batches:
+            vectors = np.asarray(batch_vectors, dtype=np.float32)
+            float_vectors[len(ids):len(ids) + len(vectors)] = vectors
+            np.maximum(max_abs, np.abs(vectors).max(axis=0), out=max_abs)
+            ids.extend(batch_ids)
+            metadatas.extend(
+                {field: (metadata or {}).get(field) for field in cls.METADATA_FIELDS} for metadata in batch_metadatas
+            )
+
+        if len(ids) != count:
+            raise ValueError(f"expected {count} vectors, got {len(ids)}")
+
+        # pass 2: quantize block by block from the float32 file
+        scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+        int8_vectors = np.lib.format.open_memmap(
+            tmp_dir / INT8_VECTORS_FILENAME, mode='w+', dtype=np.int8, shape=(count, dimension)
+        )
+        for start in range(0, count, block_rows):
+            block = float_vectors[start:start + block_rows]
+            int8_vectors[start:start + block_rows] = np.clip(np.rint(block / scales), -127, 127).astype(np.int8)
+
+        int8_vectors.flush()
+        float_vectors.flush()
+        del int8_vectors, float_vectors
+        if not keep_full_precision:
+            os.remove(tmp_dir / FLOAT_VECTORS_FILENAME)
+
+        np.save(tmp_dir / SCALES_FILENAME, scales)
+        info = {"ids": ids, "dimension": dimension, "ids_digest": ids_digest(ids)}
+        ColumnarMetadata.from_metadatas(list(cls.METADATA_FIELDS), metadatas).save(tmp_dir, info)
+        with open(tmp_dir / INDEX_INFO_FILENAME, 'w') as f:
+            json.dump(info, f)
+
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+
+        index = cls(directory, rescore_factor=rescore_factor, block_rows=block_rows)
+        index.load()
+        return index
+
+    def _approximate_scores(self, queries: np.ndarray) -> np.ndarray:
+        # to compute int8 dot products for all rows, x_int8 * scale . q = x_int8 . (q * scale)
+        scaled_queries = (queries * self.scales).T.astype(np.float32)
+        scores = np.empty((len(self.ids), len(queries)), dtype=np.float32)
+
+        for start in range(0, len(self.ids), self.block_rows):
+            block = self.int8_vectors[start:start + self.block_rows].astype(np.float32)
+            scores[start:start + len(block)] = block @ scaled_queries
+
+        return scores
+
+    def search(self, query_embeddings: List[List[float]], k: int = 5, filter_dict: Optional[Dict] = None,
+               rescore_factor: Optional[int] = None) -> List[List[Tuple[str, float]]]:
+
+        # to get the top k (id, distance) pairs per query, filter_dict uses chroma where syntax
+        # distances are squared l2 like the chroma collection (2 - 2 * cosine for normalized vectors)
+        if not self.ids:
+            return [[] for _ in query_embeddings]
+
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.int8_vectors.shape[1])
+        scores = self._approximate_scores(queries)
+
+        mask = self.metadata.mask(filter_dict)
+        if mask is not None:
+            scores[~mask] = -np.inf
+
+        candidate_count = k * (rescore_factor or self.rescore_factor) if self.float_vectors is not None else k
+        results = []
+
+        for column, query in enumerate(queries):
+            candidates = top_k_indices(scores[:, column], candidate_count)
+            candidates = candidates[np.isfinite(scores[candidates, column])]
+
+            if self.float_vectors is not None and len(candidates):
+                # sorted row order keeps the memory mapped reads sequential
+                rows = np.sort(candidates)
+                exact = np.asarray(self.float_vectors[rows]) @ query
+                order = top_k_indices(exact, k)
+                results.append([(self.ids[rows[i]], float(2.0 - 2.0 * exact[i])) for i in order])
+            else:
+                results.append([
+                    (self.ids[row], float(2.0 - 2.0 * scores[row, column])) for row in candidates[:k]
+                ])
+
+        return results
+
+    def exact_search(self, query_embeddings: List[List[float]], k: int = 5,
+                     filter_dict: Optional[Dict] = None) -> List[List[Tuple[str, float]]]:
+
+        # to brute-force the true top k over the float32 vectors, the ground truth for recall measurements
+        if self.float_vectors is None:
+            raise ValueError("exact search needs the float32 vectors (keep_full_precision=True)")
+
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.float_vectors.shape[1])
+        scores = np.empty((len(self.ids), len(queries)), dtype=np.float32)
+        for start in range(0, len(self.ids), self.block_rows):
+            scores[start:start + self.block_rows] = np.asarray(self.float_vectors[start:start + self.block_rows]) @ queries.T
+
+        mask = self.metadata.mask(filter_dict)
+        if mask is not None:
+            scores[~mask] = -np.inf
+
+        results = []
+        for column in range(len(queries)):
+            rows = top_k_indices(scores[:, column], k)
+            rows = rows[np.isfinite(scores[rows, column])]
+            results.append([(self.ids[row], float(2.0 - 2.0 * scores[row, column])) for row in rows])
+        return results
+
+    def get_statistics(self) -> Dict:
+        # to report size, for the recall/memory trade-off
+        if self.ids is None:
+            return {"status": "not_loaded"}
+
+        return {
+            "vectors": len(self.ids),
+            "int8_bytes": int(self.int8_vectors.nbytes),
+            "float32_bytes": int(self.float_vectors.nbytes) if self.float_vectors is not None else 0,
+            "rescoring": self.float_vectors is not None,
+            "rescore_factor": self.rescore_factor
+        }
+
+
+def recall_at_k(results: List[List[str]], reference: List[List[str]], k: int) -> float:
+    # to measure the mean share of the reference top k ids that are also in the result top k
+    recalls = [
+        len(set(result[:k]) & set(expected[:k])) / len(expected[:k])
+        for result, expected in zip(results, reference) if expected
+    ]
+    return float(np.mean(recalls)) if recalls else 0.0
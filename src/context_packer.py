@@ -0,0 +1,136 @@
+# token-budgeted context packing - merges adjacent chunks of the same source, strips the duplicated
+# chunk overlap and fills a token budget greedily by relevance
+
+from __future__ import annotations
+
+from typing import List, Dict, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+
+class ContextPacker:
+    # turns retrieved chunks (in relevance order) into the passages that go into the prompt
+
+    def __init__(self, max_tokens: int = 3000, encoding_name: str = "cl100k_base", max_overlap_chars: int = 400,
+                 min_overlap_chars: int = 20):
+
+        # max_tokens: token budget for all passages together
+        # encoding_name: tiktoken encoding used to count tokens (gemini has no public tokenizer,
+        #   cl100k is close enough for budgeting)
+        # max_overlap_chars: longest overlap searched for between adjacent chunks (chunk_overlap is 200)
+        # min_overlap_chars: shorter matches are treated as coincidence, not overlap
+        self.max_tokens = max_tokens
+        self.encoding_name = encoding_name
+        self.max_overlap_chars = max_overlap_chars
+        self.min_overlap_chars = min_overlap_chars
+        self._encoding = None
+
+    def _get_encoding(self):
+        if self._encoding is None:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception:
+                # tiktoken downloads its bpe file on first use, without it fall back to a char estimate
+                self._encoding = False
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        encoding = self._get_encoding()
+        if encoding:
+            return len(encoding.encode(text))
+        return len(text) // 4 + 1
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        encoding = self._get_encoding()
+        if encoding:
+            return encoding.decode(encoding.encode(text)[:max_tokens])
+        return text[:max_tokens * 4]
+
+    def _merge_texts(self, first: str, second: str) -> str:
+        # to join two adjacent chunks without repeating their shared overlap
+        longest = min(self.max_overlap_chars, len(first), len(second))
+
+        for size in range(longest, self.min_overlap_chars - 1, -1):
+            if first.endswith(second[:size]):
+                return first + second[size:]
+
+        return first + "\n" + second
+
+    def merge_adjacent(self, documents: List[Document]) -> List[Document]:
+
+        # to merge chunks that follow each other in the same source (consecutive chunk_index) into one passage
+        # a passage ranks as high as its best chunk, result is in relevance order
+        from langchain.schema import Document
+        
+        positioned = []
+        for rank, doc in enumerate(documents):
+            chunk_index = doc.metadata.get('chunk_index')
+            source_key = doc.metadata.get('full_path') or doc.metadata.get('source')
+            positioned.append((source_key, chunk_index, rank, doc))
+
+        # chunks without a position or source can't be placed next to anything
+        mergeable = sorted(
+            (item for item in positioned if item[0] is not None and isinstance(item[1], int)),
+            key=lambda item: (item[0], item[1])
+        )
+        runs = []
+        for item in mergeable:
+            previous = runs[-1][-1] if runs else None
+            if previous and previous[0] == item[0] and item[1] == previous[1] + 1:
+                runs[-1].append(item)
+            else:
+                runs.append([item])
+
+        runs.extend(
+            [item] for item in positioned
+            if item[0] is None or not isinstance(item[1], int)
+        )
+
+        passages = []
+        for run in runs:
+            text = run[0][3].page_content.strip()
+            for item in run[1:]:
+                text = self._merge_texts(text, item[3].page_content.strip())
+
+            metadata = dict(run[0][3].metadata)
+            metadata['merged_chunk_ids'] = ",".join(str(item[3].metadata.get('chunk_id', item[1])) for item in run)
+            passages.append((min(item[2] for item in run), Document(page_content=text, metadata=metadata)))
+
+        passages.sort(key=lambda passage: passage[0])
+        return [doc for rank, doc in passages]
+
+    def pack(self, documents: List[Document], max_tokens: Optional[int] = None) -> List[Document]:
+
+        # to pick the passages that fit into the token budget, most relevant first
+        # a passage that doesn't fit is skipped so smaller, less relevant ones can still use the space,
+        # only the top passage is truncated if it alone is over budget
+        from langchain.schema import Document
+        
+        budget = max_tokens or self.max_tokens
+        packed = []
+        used = 0
+
+        for passage in self.merge_adjacent(documents):
+            tokens = self.count_tokens(passage.page_content)
+
+            if used + tokens <= budget:
+                packed.append(passage)
+                used += tokens
+            elif not packed:
+                truncated = self._truncate(passage.page_content, budget)
+                packed.append(Document(page_content=truncated, metadata=passage.metadata))
+                used += self.count_tokens(truncated)
+
+        return packed
+
+    def get_statistics(self, documents: List[Document], packed: List[Document]) -> Dict:
+
+        # to compare prompt context size before and after packing
+        return {
+            "chunks_in": len(documents),
+            "passages_out": len(packed),
+            "tokens_in": sum(self.count_tokens(doc.page_content) for doc in documents),
+            "tokens_out": sum(self.count_tokens(doc.page_content) for doc in packed)
+        }
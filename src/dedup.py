@@ -0,0 +1,117 @@
+# cross-format duplicate chunk detection - the dataset ships the same document as md/pdf/docx, so
+# without this top-k is often filled with the same passage twice
+
+from __future__ import annotations
+
+import re
+import zlib
+from typing import List, Dict, Set, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+# preferred format for the canonical copy, markdown is the original the others were converted from
+FORMAT_PREFERENCE = {'md': 0, 'docx': 1, 'pdf': 2}
+
+
+class ChunkDeduplicator:
+    # drops chunks whose text another format of the same document already covers, one document group
+    # (e.g. kyc_process.md + kyc_process.pdf) at a time, alternates are recorded on the kept chunk in metadata
+
+    def __init__(self, threshold: float = 0.8, shingle_size: int = 3):
+
+        # threshold: min share of a chunk's word shingles found in the kept chunks of the group's other files
+        #   to count as duplicate (a union, not one chunk - md is chunked by section and pdf by characters,
+        #   so a pdf chunk usually spans two or three md chunks)
+        # shingle_size: words per shingle
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+        self._kept_docs = []
+        self._kept_shingles = []
+        self._file_shingles = {}  # file -> union of the shingles of its kept chunks
+        self.total_chunks = 0
+        self.duplicates_removed = 0
+
+    def _shingles(self, text: str) -> Set[int]:
+        # formatting differs between md/pdf/docx extraction, so compare lowercase word sequences only
+        words = re.findall(r"[a-z0-9]+", text.lower())
+        if len(words) < self.shingle_size:
+            return {zlib.crc32(" ".join(words).encode('utf-8'))} if words else set()
+
+        return {
+            zlib.crc32(" ".join(words[i:i + self.shingle_size]).encode('utf-8'))
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    @staticmethod
+    def _file_key(doc: Document) -> str:
+        return doc.metadata.get('full_path') or doc.metadata.get('source', 'Unknown')
+
+    def start_group(self):
+        # to forget the kept chunks of the previous document group, the counters keep running
+        self._kept_docs = []
+        self._kept_shingles = []
+        self._file_shingles = {}
+
+    def add(self, doc: Document) -> bool:
+
+        # to register a chunk of the current group, returns True if it is kept and False if the group's
+        # other files already cover it - chunks are never compared with chunks of their own file
+        self.total_chunks += 1
+        shingles = self._shingles(doc.page_content)
+        file_key = self._file_key(doc)
+
+        if shingles:
+            others = [kept for other_key, kept in self._file_shingles.items() if other_key != file_key]
+            covered = sum(1 for shingle in shingles if any(shingle in kept for kept in others))
+
+            if others and covered / len(shingles) >= self.threshold:
+                # the alternate goes on the other file's chunk that overlaps it most
+                best = max(
+                    (i for i, kept in enumerate(self._kept_docs) if self._file_key(kept) != file_key),
+                    key=lambda i: len(shingles & self._kept_shingles[i])
+                )
+                self._record_alternate(self._kept_docs[best], doc)
+                self.duplicates_removed += 1
+                return False
+
+        self._kept_docs.append(doc)
+        self._kept_shingles.append(shingles)
+        self._file_shingles.setdefault(file_key, set()).update(shingles)
+        return True
+
+    def _record_alternate(self, canonical: Document, duplicate: Document):
+        # chroma metadata values must be scalars, so alternates are a comma separated string
+        alternate = duplicate.metadata.get('source', 'Unknown')
+        if alternate == canonical.metadata.get('source'):
+            return
+
+        alternates = [s for s in canonical.metadata.get('alternate_sources', '').split(',') if s]
+        if alternate not in alternates:
+            alternates.append(alternate)
+            canonical.metadata['alternate_sources'] = ','.join(alternates)
+
+    def deduplicate(self, chunks: List[Document]) -> List[Document]:
+
+        # to drop cross-format duplicates from the chunks of one document group, preferring md over docx
+        # over pdf as the canonical copy, kept chunks come back in their original order
+        self.start_group()
+        by_preference = sorted(
+            range(len(chunks)),
+            key=lambda i: FORMAT_PREFERENCE.get(chunks[i].metadata.get('file_type'), len(FORMAT_PREFERENCE))
+        )
+        keep = set(i for i in by_preference if self.add(chunks[i]))
+        self.start_group()
+
+        return [chunk for i, chunk in enumerate(chunks) if i in keep]
+
+    def get_report(self) -> Dict:
+
+        # to report how much was removed
+        return {
+            "total_chunks": self.total_chunks,
+            "kept_chunks": self.total_chunks - self.duplicates_removed,
+            "duplicates_removed": self.duplicates_removed,
+            "dedup_ratio": self.duplicates_removed / self.total_chunks if self.total_chunks else 0.0
+        }
@@ -0,0 +1,187 @@
+# persistent embedding cache - stores float32 vectors in sqlite keyed by chunk text hash + model name
+# so unchanged chunks (and the md/pdf/docx copies of the same doc) are only encoded once
+
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import List, Dict, Callable, Optional
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class EmbeddingCache:
+    # sqlite blob table: key -> float32 vector bytes, with LRU eviction on last access time
+
+    def __init__(self, cache_path: str, model_name: str, max_entries: int = 200000):
+
+        # cache_path: sqlite file, created if missing
+        # model_name: part of the key so switching models never returns stale vectors
+        # max_entries: size bound, least recently used rows are evicted above it
+        self.cache_path = cache_path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> last lookup time, written with the next put_many (or close) so lookups never write
+        self._pending_access = {}
+
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self._conn.commit()
+        # running row count, the table is only counted again when this says it is over max_entries
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\x00{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+
+        # to look up vectors for texts, None where missing
+        keys = [self._key(text) for text in texts]
+        found = {}
+
+        with self._lock:
+            # sqlite has a limit on bound parameters so query in slices
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+
+            now = time.time()
+            for key in found:
+                self._pending_access[key] = now
+
+            vectors = [found.get(key) for key in keys]
+            hit_count = sum(1 for v in vectors if v is not None)
+            self.hits += hit_count
+            self.misses += len(vectors) - hit_count
+
+        return vectors
+
+    def put_many(self, texts: List[str], vectors: List) -> None:
+
+        # to store vectors for texts and evict if the cache grew past max_entries
+        now = time.time()
+        rows = [
+            (self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+
+        rows = list({row[0]: row for row in rows}.values())
+
+        with self._lock:
+            self._flush_access_times()
+            # replaced rows don't grow the table, only new keys count towards max_entries
+            existing = 0
+            for start in range(0, len(rows), 500):
+                batch = [row[0] for row in rows[start:start + 500]]
+                placeholders = ",".join("?" * len(batch))
+                existing += self._conn.execute(
+                    f"SELECT COUNT(*) FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchone()[0]
+
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                rows
+            )
+            self._count += len(rows) - existing
+            self._evict()
+            self._conn.commit()
+
+    def get_or_compute(self, texts: List[str], compute_fn: Callable[[List[str]], List]) -> np.ndarray:
+
+        # to return vectors for all texts, computing only the misses (and duplicates only once)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        cached = self.get_many(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+
+        if missing:
+            computed = compute_fn(missing)
+            self.put_many(missing, computed)
+            computed_by_text = {
+                text: np.asarray(vector, dtype=np.float32) for text, vector in zip(missing, computed)
+            }
+            cached = [
+                vector if vector is not None else computed_by_text[text]
+                for text, vector in zip(texts, cached)
+            ]
+
+        return np.vstack(cached)
+
+    def _flush_access_times(self):
+        # to write the buffered lookup times, the caller commits
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self._pending_access.items()]
+            )
+            self._pending_access = {}
+
+    def _evict(self):
+        if self._count <= self.max_entries:
+            return
+
+        # another process may share the file, so count for real before deleting anything
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = self._count - self.max_entries
+
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (overflow,)
+            )
+            self._count -= overflow
+
+    def get_statistics(self) -> Dict:
+
+        # to get hit/miss counters and current size
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "model_name": self.model_name
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_access_times()
+            self._conn.commit()
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    # langchain Embeddings wrapper that serves documents and queries from an EmbeddingCache
+
+    def __init__(self, base_embeddings: Embeddings, cache: EmbeddingCache):
+        self.base_embeddings = base_embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_or_compute(texts, self.base_embeddings.embed_documents)
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        vectors = self.cache.get_or_compute([text], lambda missing: [self.base_embeddings.embed_query(missing[0])])
+        return vectors[0].tolist()
@@ -4,34 +4,37 @@ import os
 import sys
 import json
 import time
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 from pathlib import Path
 import pandas as pd
 from dotenv import load_dotenv
 import requests
 import numpy as np
-from sentence_transformers import SentenceTransformer
 import google.generativeai as genai
 
 sys.path.append(str(Path(__file__).parent))
 
 from vectorstore import VectorStoreManager
+from rate_limit import ProviderLimiter, parse_gemini_retry_delay
 
 load_dotenv(dotenv_path="../.env", override=True)
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 genai.configure(api_key=GEMINI_API_KEY)
 JUDGE_MODEL = "gemini-2.5-pro"
+JUDGE_LIMITS = {"max_concurrency": 4, "requests_per_minute": 30}
+JUDGE_CACHE_PATH = "../llm_judge_cache.jsonl"
 
-print("loading embedding model...")
-embedding_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-print("embedding model loaded")
+# same (cached) embeddings as ingestion and querying, so retrieved chunks are usually cache hits
+# the model is loaded by the first similarity calculation, not at import
+embedding_manager = VectorStoreManager(persist_directory="../chroma_db")
 
 
-def retrieve_chunks_for_question(vectorstore_manager: VectorStoreManager, question: str, k: int = 5) -> List[Dict]:
-    # to retrieve chunks for a question using the same method as the rag system
-    docs_with_scores = vectorstore_manager.similarity_search_with_score(question, k=k)
-    
+def format_chunks(docs_with_scores: List[tuple]) -> List[Dict]:
+    # to turn retrieved (document, score) pairs into chunk records
     chunks = []
     for i, (doc, score) in enumerate(docs_with_scores, 1):
         source = doc.metadata.get('source', 'Unknown')
@@ -49,40 +52,62 @@ def retrieve_chunks_for_question(vectorstore_manager: VectorStoreManager, questi
     return chunks
 
 
-def calculate_semantic_similarity(answer: str, chunks: List[Dict]) -> Dict:
-    # to calculate semantic similarity between answer and retrieved chunks
-    if not answer or answer == "ERROR":
-        return {
-            "max_similarity": 0.0,
-            "avg_similarity": 0.0,
-            "min_similarity": 0.0,
-            "weighted_similarity": 0.0
-        }
+def retrieve_chunks_for_question(vectorstore_manager: VectorStoreManager, question: str, k: int = 5) -> List[Dict]:
+    # to retrieve chunks for a question using the same method as the rag system
+    return format_chunks(vectorstore_manager.similarity_search_with_score(question, k=k))
+
+
+def retrieve_chunks_for_questions(vectorstore_manager: VectorStoreManager, questions: List[str], k: int = 5) -> List[List[Dict]]:
+    # batch version of retrieve_chunks_for_question: one encode call and one vector query for all questions
+    return [
+        format_chunks(docs_with_scores)
+        for docs_with_scores in vectorstore_manager.similarity_search_batch(questions, k=k)
+    ]
+
+
+def calculate_semantic_similarity_batch(answers: List[str], chunks: List[Dict]) -> List[Dict]:
+    # to score several answers against the same retrieved chunks: chunks are encoded once,
+    # answers in one batch, and all cosine similarities come from a single matrix product
+    empty_scores = {
+        "max_similarity": 0.0,
+        "avg_similarity": 0.0,
+        "min_similarity": 0.0,
+        "weighted_similarity": 0.0
+    }
     
-    answer_embedding = embedding_model.encode([answer])[0]
+    valid = [i for i, answer in enumerate(answers) if answer and answer != "ERROR"]
+    scores = [dict(empty_scores) for _ in answers]
     
-    chunk_texts = [chunk["content"] for chunk in chunks]
-    chunk_embeddings = embedding_model.encode(chunk_texts)
+    if not valid or not chunks:
+        return scores
     
-    similarities = []
-    for chunk_emb, chunk in zip(chunk_embeddings, chunks):
-        # cosine similarity
-        similarity = np.dot(answer_embedding, chunk_emb) / (
-            np.linalg.norm(answer_embedding) * np.linalg.norm(chunk_emb)
-        )
-        similarities.append(float(similarity))
+    embedding_model = embedding_manager._initialize_embeddings()
+    chunk_embeddings = np.array(embedding_model.embed_documents([chunk["content"] for chunk in chunks]))
+    answer_embeddings = np.array(embedding_model.embed_documents([answers[i] for i in valid]))
+    
+    # cosine similarity matrix, rows = answers, columns = chunks
+    chunk_embeddings = chunk_embeddings / np.linalg.norm(chunk_embeddings, axis=1, keepdims=True)
+    answer_embeddings = answer_embeddings / np.linalg.norm(answer_embeddings, axis=1, keepdims=True)
+    similarities = answer_embeddings @ chunk_embeddings.T
     
     # weighted similarity (higher weight for top-ranked chunks)
-    weights = [1.0 / (i + 1) for i in range(len(similarities))]
-    total_weight = sum(weights)
-    weighted_sim = sum(s * w for s, w in zip(similarities, weights)) / total_weight if total_weight > 0 else 0.0
+    weights = 1.0 / np.arange(1, len(chunks) + 1)
+    weighted = similarities @ weights / weights.sum()
+    
+    for row, answer_idx in enumerate(valid):
+        scores[answer_idx] = {
+            "max_similarity": float(similarities[row].max()),
+            "avg_similarity": float(similarities[row].mean()),
+            "min_similarity": float(similarities[row].min()),
+            "weighted_similarity": float(weighted[row])
+        }
     
-    return {
-        "max_similarity": max(similarities) if similarities else 0.0,
-        "avg_similarity": np.mean(similarities) if similarities else 0.0,
-        "min_similarity": min(similarities) if similarities else 0.0,
-        "weighted_similarity": weighted_sim
-    }
+    return scores
+
+
+def calculate_semantic_similarity(answer: str, chunks: List[Dict]) -> Dict:
+    # to calculate semantic similarity between answer and retrieved chunks
+    return calculate_semantic_similarity_batch([answer], chunks)[0]
 
 
 def query_gemini_judge(chunks: List[Dict], question: str, answer: str, max_retries: int = 2) -> Dict:
@@ -176,6 +201,17 @@ Please respond in the following JSON format ONLY (no other text):
                 }
                 
         except Exception as e:
+            # rate limits are left to the caller's limiter instead of sleeping here
+            if getattr(e, "code", None) == 429 or "429" in str(e):
+                return {
+                    "faithfulness_score": 0,
+                    "coverage_score": 0,
+                    "has_hallucinations": True,
+                    "judge_explanation": "",
+                    "error": "Rate limited",
+                    "rate_limited": True,
+                    "retry_after": parse_gemini_retry_delay(str(e))
+                }
             if attempt < max_retries:
                 wait_time = 5 * (attempt + 1)
                 print(f"\n  [error, waiting {wait_time}s...]", flush=True)
@@ -199,6 +235,75 @@ Please respond in the following JSON format ONLY (no other text):
     }
 
 
+def judge_cache_key(chunks: List[Dict], question: str, answer: str) -> str:
+    # to key a judge verdict by everything the judge sees
+    payload = json.dumps({
+        "model": JUDGE_MODEL,
+        "question": question,
+        "answer": answer,
+        "chunks": [[chunk["source"], chunk["content"]] for chunk in chunks]
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_judge_cache(cache_path: str) -> Dict:
+    # to load verdicts appended by earlier runs, one {"key", "verdict"} json object per line
+    cache = {}
+    if not Path(cache_path).exists():
+        return cache
+    
+    with open(cache_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a run killed mid-write leaves a partial last line
+                continue
+            cache[entry["key"]] = entry["verdict"]
+    
+    return cache
+
+
+def append_judge_verdict(cache_file, key: str, verdict: Dict):
+    cache_file.write(json.dumps({"key": key, "verdict": verdict}) + "\n")
+    cache_file.flush()
+
+
+async def run_judge_requests(requests_to_judge: List[Dict], judge_cache: Dict, cache_path: str) -> Dict:
+    # to run the judge concurrently under a rate limiter, every successful verdict is appended to the cache
+    # right away, by one writer thread so the event loop never waits on the file
+    limiter = ProviderLimiter("gemini judge", **JUDGE_LIMITS)
+    verdicts = {}
+    total = len(requests_to_judge)
+    finished = 0
+    loop = asyncio.get_running_loop()
+    writer = ThreadPoolExecutor(max_workers=1)
+    cache_file = open(cache_path, 'a')
+    
+    async def judge_one(request: Dict):
+        nonlocal finished
+        verdict = await limiter.call(query_gemini_judge, request["chunks"], request["question"], request["answer"])
+        verdicts[request["key"]] = verdict
+        finished += 1
+        
+        if verdict.get("error"):
+            print(f"[{finished}/{total}] {request['label']}: error: {verdict['error']}", flush=True)
+        else:
+            judge_cache[request["key"]] = verdict
+            await loop.run_in_executor(writer, append_judge_verdict, cache_file, request["key"], verdict)
+            print(f"[{finished}/{total}] {request['label']}: (F:{verdict['faithfulness_score']}, C:{verdict['coverage_score']})", flush=True)
+    
+    try:
+        await asyncio.gather(*(judge_one(request) for request in requests_to_judge))
+    finally:
+        writer.shutdown()
+        cache_file.close()
+    return verdicts
+
+
 def evaluate_all_answers():
     # main evaluation function
     
@@ -230,8 +335,14 @@ def evaluate_all_answers():
         except Exception as e:
             print(f"error: failed to load vector store: {str(e)}")
             return
+        
+        # retrieve for all questions at once, one encode call and one vector query
+        print("retrieving chunks...", end=" ", flush=True)
+        all_chunks = retrieve_chunks_for_questions(vectorstore_manager, [result["question"] for result in results], k=5)
+        print("done", flush=True)
+        for result, chunks in zip(results, all_chunks):
+            result["retrieved_chunks"] = chunks
     else:
-        vectorstore_manager = None
         print("chunks already present in results")
     
     model_names = [key.replace("_answer", "") for key in results[0].keys() 
@@ -240,68 +351,68 @@ def evaluate_all_answers():
     print(f"\nfound {len(model_names)} models: {', '.join(model_names)}")
     
     evaluation_results = []
+    judge_requests = {}
+    judge_cache = load_judge_cache(JUDGE_CACHE_PATH)
     
-    total_evaluations = len(results) * len(model_names)
-    current = 0
-    
+    # pass 1: chunks + semantic similarity for all models of a question in one batch
     for result in results:
         question = result["question"]
         question_num = result["question_num"]
         
-        if needs_chunk_retrieval:
-            print(f"\nquestion {question_num}/{len(results)}: {question}")
-            print("retrieving chunks...", end=" ", flush=True)
-            chunks = retrieve_chunks_for_question(vectorstore_manager, question, k=5)
-            print(f"({len(chunks)} chunks retrieved)", flush=True)
-            result["retrieved_chunks"] = chunks
-        else:
-            chunks = result["retrieved_chunks"]
-            print(f"\nevaluating question {question_num}/{len(results)}: {question}")
+        chunks = result["retrieved_chunks"]
+        print(f"\nevaluating question {question_num}/{len(results)}: {question} ({len(chunks)} chunks)")
         
         question_eval = {
             "question": question,
             "question_num": question_num
         }
         
-        for model_name in model_names:
-            current += 1
-            answer = result.get(f"{model_name}_answer")
-            
-            print(f"\n[{current}/{total_evaluations}] evaluating {model_name}...", flush=True)
-            
+        answers = [result.get(f"{model_name}_answer") for model_name in model_names]
+        semantic_scores_list = calculate_semantic_similarity_batch(answers, chunks)
+        
+        for model_name, answer, semantic_scores in zip(model_names, answers, semantic_scores_list):
             if not answer or answer == "ERROR":
-                print("  skipping (no answer)", flush=True)
+                print(f"  {model_name}: skipping (no answer)", flush=True)
                 question_eval[f"{model_name}_semantic_sim"] = 0.0
                 question_eval[f"{model_name}_faithfulness"] = 0
                 question_eval[f"{model_name}_coverage"] = 0
                 question_eval[f"{model_name}_hallucinations"] = True
                 continue
             
-            print("  computing semantic similarity...", end=" ", flush=True)
-            semantic_scores = calculate_semantic_similarity(answer, chunks)
-            print(f"(weighted: {semantic_scores['weighted_similarity']:.3f})", flush=True)
+            print(f"  {model_name}: semantic similarity (weighted: {semantic_scores['weighted_similarity']:.3f})", flush=True)
             
             question_eval[f"{model_name}_semantic_max"] = semantic_scores["max_similarity"]
             question_eval[f"{model_name}_semantic_avg"] = semantic_scores["avg_similarity"]
             question_eval[f"{model_name}_semantic_weighted"] = semantic_scores["weighted_similarity"]
             
-            print("  querying gemini 2.5 pro judge...", end=" ", flush=True)
-            judge_scores = query_gemini_judge(chunks, question, answer)
-            
-            if judge_scores.get("error"):
-                print(f"error: {judge_scores['error']}", flush=True)
-            else:
-                print(f"(F:{judge_scores['faithfulness_score']}, C:{judge_scores['coverage_score']})", flush=True)
+            key = judge_cache_key(chunks, question, answer)
+            question_eval[f"{model_name}_judge_key"] = key
+            if key not in judge_cache:
+                judge_requests[key] = {
+                    "key": key,
+                    "chunks": chunks,
+                    "question": question,
+                    "answer": answer,
+                    "label": f"Q{question_num} {model_name}"
+                }
+        
+        evaluation_results.append(question_eval)
+    
+    # pass 2: judge only answers that are not in the cache yet, concurrently
+    print(f"\njudge: {len(judge_requests)} new answers to judge, {len(judge_cache)} verdicts cached")
+    verdicts = asyncio.run(run_judge_requests(list(judge_requests.values()), judge_cache, JUDGE_CACHE_PATH))
+    
+    for question_eval in evaluation_results:
+        for model_name in model_names:
+            key = question_eval.pop(f"{model_name}_judge_key", None)
+            if key is None:
+                continue
             
+            judge_scores = judge_cache.get(key) or verdicts[key]
             question_eval[f"{model_name}_faithfulness"] = judge_scores["faithfulness_score"]
             question_eval[f"{model_name}_coverage"] = judge_scores["coverage_score"]
             question_eval[f"{model_name}_hallucinations"] = judge_scores["has_hallucinations"]
             question_eval[f"{model_name}_judge_explanation"] = judge_scores.get("judge_explanation", "")
-            
-            if current < total_evaluations:
-                time.sleep(3)
-        
-        evaluation_results.append(question_eval)
     
     if needs_chunk_retrieval:
         updated_results_path = "../llm_comparison_results.json"
@@ -430,6 +541,10 @@ def evaluate_all_answers():
     print(summary_df.to_string(index=False))
     
     summary_df.to_csv("../llm_evaluation_summary.csv", index=False)
+    
+    if embedding_manager.embedding_cache is not None:
+        cache_stats = embedding_manager.embedding_cache.get_statistics()
+        print(f"\nembedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
 
 
 if __name__ == "__main__":
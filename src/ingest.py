@@ -2,60 +2,99 @@
 # document ingestion module for Skyro Knowledge Assistant - loads and preprocess of multiple formats like md, pdf and docx with overchunkin
 
 import os
+import hashlib
+from collections import Counter
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Iterator, Iterable, Optional
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-from langchain_community.document_loaders import (
-    UnstructuredMarkdownLoader,
-    PyPDFLoader,
-    Docx2txtLoader
-)
+
+from dedup import ChunkDeduplicator
+from chunking import MarkdownChunker
+from loaders import LOADERS, MARKDOWN_FORMAT
+
+# recorded in the ingest manifest, an index written with another id scheme is re-chunked on the next sync
+CHUNK_ID_SCHEME = "source-offset-sha256"
 
 
 class DocumentIngester:
     # to load and chunks documents for vector store ingestion
     
-    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200, structure_aware: bool = True,
+                 chunk_profiles: Optional[Dict[str, Dict]] = None, parent_chunk_size: Optional[int] = None):
 
         # chunk_size: Size of text chunks in characters
         # chunk_overlap: Overlap between chunks to maintain context
+        # structure_aware: chunk markdown along its headings, keeping tables and code blocks whole
+        #   (chunking.MarkdownChunker), False splits every format by characters only
+        # chunk_profiles: category -> {"chunk_size", "chunk_overlap"} overriding the defaults above,
+        #   e.g. chunking.CHUNK_PROFILES
+        # parent_chunk_size: small-to-big mode, documents are first cut into parents of this size (sections
+        #   for markdown) and each parent into chunk_size children, children carry metadata['parent_id']
+        #   and the parents are stored once (parent_store.ParentDocumentStore) to be sent to the llm
         
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.structure_aware = structure_aware
+        self.chunk_profiles = chunk_profiles or {}
+        self.parent_chunk_size = parent_chunk_size
         
         # initialize text splitter
-        self.text_splitter = RecursiveCharacterTextSplitter(
+        self.text_splitter = self._create_text_splitter(chunk_size, chunk_overlap)
+        self._splitters = {(chunk_size, chunk_overlap): (self.text_splitter, MarkdownChunker(chunk_size, chunk_overlap))}
+    
+    def _create_text_splitter(self, chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+        return RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
             length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
+            separators=["\n\n", "\n", ". ", " ", ""],
+            add_start_index=True
         )
     
-    def load_document(self, file_path: str) -> List[Document]:
+    def _get_splitters(self, category: str, parent: bool = False) -> tuple:
+        # to get the (text splitter, markdown chunker) for a category's chunk size profile, or for parents
+        profile = self.chunk_profiles.get(category, {})
+        if parent:
+            key = (self.parent_chunk_size, 0)
+        else:
+            key = (profile.get('chunk_size', self.chunk_size), profile.get('chunk_overlap', self.chunk_overlap))
+        if key not in self._splitters:
+            self._splitters[key] = (self._create_text_splitter(*key), MarkdownChunker(*key))
+        return self._splitters[key]
+    
+    def get_chunking_config(self) -> Dict:
+        # everything that changes the chunks of an unchanged file, stored in the ingest manifest
+        return {
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'structure_aware': self.structure_aware,
+            'chunk_profiles': self.chunk_profiles,
+            'parent_chunk_size': self.parent_chunk_size,
+            'chunk_ids': CHUNK_ID_SCHEME
+        }
+    
+    def load_document(self, file_path: str, directory: Optional[str] = None) -> List[Document]:
 
         # to just load docs
+        # directory: the ingested dir, source_path metadata is the path relative to it (the file name without)
         file_path = Path(file_path)
         
         if not file_path.exists():
             return []
         
-        # determine loader based on file extension
+        # determine loader based on file extension (loaders.LOADERS, extend with loaders.register_loader)
         extension = file_path.suffix.lower()
+        loader = LOADERS.get(extension)
+        if loader is None:
+            return []
         
         try:
-            if extension == '.md':
-                loader = UnstructuredMarkdownLoader(str(file_path))
-            elif extension == '.pdf':
-                loader = PyPDFLoader(str(file_path))
-            elif extension == '.docx':
-                loader = Docx2txtLoader(str(file_path))
-            else:
-                return []
-            
             # load document
-            documents = loader.load()
+            documents = loader(file_path)
             
             # add metadata
             for doc in documents:
@@ -63,7 +102,8 @@ class DocumentIngester:
                     'source': str(file_path.name),
                     'file_type': extension[1:],  # remove the dot
                     'category': self._get_category(file_path),
-                    'full_path': str(file_path)
+                    'full_path': str(file_path),
+                    'source_path': self.get_source_path(file_path, directory)
                 })
             
             return documents
@@ -71,48 +111,236 @@ class DocumentIngester:
         except Exception as e:
             return []
     
-    def load_documents_from_directory(self, directory: str, exclude_files: List[str] = None) -> List[Document]:
+    def find_source_files(self, directory: str, exclude_files: List[str] = None) -> List[Path]:
 
-        # to load docs from certain dir
+        # to list the files under a dir that would be ingested (single walk over the tree)
         if exclude_files is None:
             exclude_files = []
         
         directory = Path(directory)
-        all_documents = []
+        source_files = []
         
         # supported extensions
-        supported_extensions = ['.md', '.pdf', '.docx']
+        supported_extensions = set(LOADERS)
         
         # find all files
-        for ext in supported_extensions:
-            files = list(directory.rglob(f'*{ext}'))
+        for file_path in sorted(directory.rglob('*')):
+            if file_path.suffix.lower() not in supported_extensions or not file_path.is_file():
+                continue
             
-            for file_path in files:
-                # skip excluded files
-                if file_path.name in exclude_files:
-                    continue
-                
-                # skip overview/summary files
-                if file_path.name.upper() in ['DATASET_OVERVIEW.md', 'FILE_FORMATS_SUMMARY.md']:
-                    continue
-                
-                docs = self.load_document(str(file_path))
-                all_documents.extend(docs)
+            # skip excluded files
+            if file_path.name in exclude_files:
+                continue
+            
+            # skip overview/summary files
+            if file_path.name.upper() in ['DATASET_OVERVIEW.md', 'FILE_FORMATS_SUMMARY.md']:
+                continue
+            
+            source_files.append(file_path)
+        
+        return source_files
+    
+    def get_source_path(self, file_path, directory: Optional[str] = None) -> str:
+        # to get the path chunk ids are derived from, relative to the ingested dir so the ids survive
+        # moving the data dir or running from another working directory
+        file_path = Path(file_path)
+        if directory is not None:
+            try:
+                return file_path.resolve().relative_to(Path(directory).resolve()).as_posix()
+            except ValueError:
+                pass
+        return file_path.name
+    
+    def load_documents_from_directory(self, directory: str, exclude_files: List[str] = None) -> List[Document]:
+
+        # to load docs from certain dir
+        all_documents = []
+        
+        for file_path in self.find_source_files(directory, exclude_files):
+            docs = self.load_document(str(file_path), directory)
+            all_documents.extend(docs)
         
         return all_documents
     
-    def chunk_documents(self, documents: List[Document]) -> List[Document]:
+    def get_file_fingerprint(self, file_path: str, with_hash: bool = True) -> Dict:
+
+        # to get mtime, size and (optionally) content hash of a file for incremental sync
+        # with_hash: skip reading the file when only mtime/size are needed
+        file_path = Path(file_path)
+        stat = file_path.stat()
+        
+        fingerprint = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size
+        }
+        
+        if with_hash:
+            sha256 = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(block)
+            fingerprint['content_hash'] = sha256.hexdigest()
+        
+        return fingerprint
+    
+    def group_source_files(self, source_files: List[Path]) -> List[List[Path]]:
+
+        # to group files that are the same document in different formats (same dir and name, e.g.
+        # kyc_process.md + kyc_process.pdf) so they are always loaded and deduplicated together
+        groups = {}
+        for file_path in source_files:
+            groups.setdefault(self.get_group_key(file_path), []).append(file_path)
+        return list(groups.values())
+    
+    def get_group_key(self, file_path) -> str:
+        file_path = Path(file_path)
+        return str(file_path.parent / file_path.stem)
+    
+    def iter_chunk_batches(self, directory: str, exclude_files: List[str] = None, batch_size: int = 256,
+                           max_workers: Optional[int] = None, deduplicator: Optional[ChunkDeduplicator] = None,
+                           loaded_files: Optional[List[str]] = None,
+                           parents: Optional[Dict[str, Document]] = None) -> Iterator[List[Document]]:
+
+        # to stream chunks from a dir in batches ready for embedding, files are parsed in a process pool
+        # and chunked as they arrive so only a few files + one batch are held in memory at a time
+        # batch_size: number of chunks per yielded batch
+        # max_workers: parser processes, defaults to cpu count, 1 parses in this process
+        # deduplicator: drops cross-format duplicate chunks, one document group at a time (the same as
+        #   sync_directory), the md copy is kept as canonical
+        # loaded_files: if given, paths of successfully loaded files are appended to it
+        # parents: small-to-big mode, parent passages are added to it by id before their children are yielded,
+        #   parents whose children were all dropped as duplicates are never added
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        
+        source_groups = self.group_source_files(self.find_source_files(directory, exclude_files))
+        batch = []
+        
+        for documents in self._iter_loaded_documents(source_groups, max_workers, directory):
+            if not documents:
+                continue
+            
+            if loaded_files is not None:
+                loaded_files.extend(dict.fromkeys(doc.metadata['full_path'] for doc in documents))
+            
+            group_parents = {} if parents is not None else None
+            chunks = self.chunk_documents(documents, parents=group_parents)
+            
+            if deduplicator is not None:
+                chunks = deduplicator.deduplicate(chunks)
+            
+            if parents is not None:
+                # only what the kept chunks point at, a dropped pdf copy's parents would wait here until the end
+                for doc in chunks:
+                    parent_id = doc.metadata.get('parent_id')
+                    if parent_id in group_parents:
+                        parents[parent_id] = group_parents[parent_id]
+            
+            batch.extend(chunks)
+            
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        
+        if batch:
+            yield batch
+    
+    def load_document_group(self, file_paths: List, directory: Optional[str] = None) -> List[Document]:
+        # to load all formats of one document
+        documents = []
+        for file_path in file_paths:
+            documents.extend(self.load_document(str(file_path), directory))
+        return documents
+    
+    def _iter_loaded_documents(self, source_groups: Iterable[List[Path]], max_workers: int,
+                               directory: Optional[str] = None) -> Iterator[List[Document]]:
+
+        # to load file groups in parallel, yields each group's documents in completion order
+        if max_workers <= 1:
+            for group in source_groups:
+                yield self.load_document_group(group, directory)
+            return
+        
+        groups_iter = iter(source_groups)
+        # keep a bounded number of files in flight so results never pile up in memory
+        max_in_flight = max_workers * 2
+        
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = {
+                executor.submit(_load_document_group_worker, [str(file_path) for file_path in group], directory)
+                for group in islice(groups_iter, max_in_flight)
+            }
+            
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                
+                for future in done:
+                    for group in islice(groups_iter, 1):
+                        pending.add(executor.submit(_load_document_group_worker, [str(file_path) for file_path in group], directory))
+                    yield future.result()
+    
+    def chunk_documents(self, documents: List[Document],
+                        parents: Optional[Dict[str, Document]] = None) -> List[Document]:
 
         # to split documents into smaller chunks for better retrieval.
+        # markdown (and docx/html/csv, their loaders convert to markdown) is chunked by structure and
+        # gets heading_path metadata, other formats by characters,
+        # both with the chunk size of the document's category profile
+        # every chunk gets a content derived chunk_id (used as its vector store id) and its position
+        # among the chunks of its source file as chunk_index, so editing one file renumbers nothing else
+        # parents: with parent_chunk_size set, the parent passages are added to it by parent_id
         
-        chunked_docs = self.text_splitter.split_documents(documents)
+        if self.parent_chunk_size:
+            chunked_docs = []
+            for parent in self._split_documents(documents, parent=True):
+                parent.metadata['parent_id'] = self._get_content_id(parent)
+                if parents is not None:
+                    parents[parent.metadata['parent_id']] = parent
+                chunked_docs.extend(self._split_children(parent))
+        else:
+            chunked_docs = self._split_documents(documents)
         
-        # Add chunk metadata
-        for i, doc in enumerate(chunked_docs):
-            doc.metadata['chunk_id'] = i
+        # Add chunk metadata, chunks come out of the splitters in document order (pages in order for pdf)
+        chunks_per_source = Counter()
+        for doc in chunked_docs:
+            source = doc.metadata.get('full_path')
+            doc.metadata['chunk_id'] = self._get_content_id(doc)
+            doc.metadata['chunk_index'] = chunks_per_source[source]
+            chunks_per_source[source] += 1
         
         return chunked_docs
     
+    def _split_documents(self, documents: List[Document], parent: bool = False) -> List[Document]:
+        chunked_docs = []
+        for doc in documents:
+            text_splitter, markdown_chunker = self._get_splitters(doc.metadata.get('category', 'General'), parent)
+            if self.structure_aware and doc.metadata.get('text_format') == MARKDOWN_FORMAT:
+                chunked_docs.extend(markdown_chunker.split_documents([doc]))
+            else:
+                chunked_docs.extend(text_splitter.split_documents([doc]))
+        return chunked_docs
+    
+    def _split_children(self, parent: Document) -> List[Document]:
+        # children are cut from the parent text, so offsets are shifted to the source and the heading path
+        # is the parent's (the parent text may start mid-section)
+        children = self._split_documents([parent])
+        for child in children:
+            child.metadata['start_index'] = parent.metadata.get('start_index', 0) + child.metadata.get('start_index', 0)
+            if parent.metadata.get('heading_path'):
+                child.metadata['heading_path'] = parent.metadata['heading_path']
+            else:
+                child.metadata.pop('heading_path', None)
+        return children
+    
+    def _get_content_id(self, doc: Document) -> str:
+        # source path + position (pdf page and offset) + text hash, so re-ingesting an unchanged file keeps
+        # its chunk and parent ids and a chunk only gets a new id if it moves or changes
+        metadata = doc.metadata
+        source = metadata.get('source_path') or metadata.get('full_path')
+        position = f"{metadata.get('page', '')}:{metadata.get('start_index', 0)}"
+        text_hash = hashlib.sha256(doc.page_content.encode('utf-8')).hexdigest()
+        return hashlib.sha256(f"{source}\x00{position}\x00{text_hash}".encode('utf-8')).hexdigest()[:32]
+    
     def _get_category(self, file_path: Path) -> str:
 
         # to determine document category based on directory structure
@@ -155,3 +383,8 @@ class DocumentIngester:
             stats['by_category'][category] = stats['by_category'].get(category, 0) + 1
         
         return stats
+
+
+def _load_document_group_worker(file_paths: List[str], directory: Optional[str] = None) -> List[Document]:
+    # process pool entry point, module level so it can be pickled
+    return DocumentIngester().load_document_group(file_paths, directory)
@@ -0,0 +1,166 @@
+# in-process BM25 inverted index kept next to the chroma collection - catches exact identifiers
+# (postmortem 089, ADR 015, endpoint names, KYC level names) that MiniLM embeddings match poorly
+
+import os
+import re
+import json
+import math
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[_\-./][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    # to split text into lowercase terms, compound identifiers (sk_live, adr-015, /payments/refund)
+    # are kept as one term and also split into their parts
+    tokens = []
+    for match in TOKEN_PATTERN.findall(text.lower()):
+        parts = re.split(r"[_\-./]", match)
+        if len(parts) > 1:
+            tokens.append(match)
+        tokens.extend(part for part in parts if part)
+    return tokens
+
+
+def matches_filter(metadata: Dict, filter_dict: Optional[Dict]) -> bool:
+    # to evaluate the subset of chroma where clauses we use ($eq, $ne, $in, $nin, $and, $or) against metadata
+    if not filter_dict:
+        return True
+
+    for key, condition in filter_dict.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, clause) for clause in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, clause) for clause in condition):
+                return False
+            continue
+
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+
+        for operator, operand in condition.items():
+            if operator == "$eq" and value != operand:
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$nin" and value in operand:
+                return False
+
+    return True
+
+
+class BM25Index:
+    # okapi bm25 over chunk texts, keyed by the same ids as the chroma collection
+
+    # metadata fields kept per document, enough for role filtering and deletes by file
+    STORED_FIELDS = ("category", "source", "full_path")
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = {}  # id -> {term: term frequency}
+        self.doc_lengths = {}  # id -> number of terms
+        self.doc_metadata = {}  # id -> stored metadata fields
+        self.postings = {}  # term -> {id: term frequency}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def add(self, ids: List[str], texts: List[str], metadatas: List[Dict]):
+        # to index documents, re-adding an existing id replaces it
+        for doc_id, text, metadata in zip(ids, texts, metadatas):
+            if doc_id in self.doc_terms:
+                self.remove([doc_id])
+
+            term_counts = Counter(tokenize(text))
+            self._add_terms(doc_id, dict(term_counts), {
+                field: metadata.get(field) for field in self.STORED_FIELDS if metadata.get(field) is not None
+            })
+
+    def _add_terms(self, doc_id: str, term_counts: Dict[str, int], metadata: Dict):
+        self.doc_terms[doc_id] = term_counts
+        self.doc_metadata[doc_id] = metadata
+        length = sum(term_counts.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+
+    def remove(self, ids: List[str]):
+        # to drop documents from the index, unknown ids are ignored
+        for doc_id in ids:
+            term_counts = self.doc_terms.pop(doc_id, None)
+            if term_counts is None:
+                continue
+
+            self.total_length -= self.doc_lengths.pop(doc_id)
+            self.doc_metadata.pop(doc_id, None)
+
+            for term in term_counts:
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(doc_id, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def search(self, query: str, k: int = 5, filter_dict: Optional[Dict] = None) -> List[Tuple[str, float]]:
+
+        # to get the top k (id, bm25 score) pairs for a query, filter_dict uses chroma where syntax
+        if not self.doc_terms:
+            return []
+
+        doc_count = len(self.doc_terms)
+        avg_length = self.total_length / doc_count if doc_count else 0.0
+        scores = {}
+
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+
+            for doc_id, term_freq in posting.items():
+                length_norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length if avg_length else 1.0
+                score = idf * term_freq * (self.k1 + 1) / (term_freq + self.k1 * length_norm)
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+
+        if filter_dict:
+            scores = {
+                doc_id: score for doc_id, score in scores.items()
+                if matches_filter(self.doc_metadata.get(doc_id, {}), filter_dict)
+            }
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self, path: str):
+        # to persist the index (postings are rebuilt on load)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "k1": self.k1,
+                "b": self.b,
+                "doc_terms": self.doc_terms,
+                "doc_metadata": self.doc_metadata
+            }, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        for doc_id, term_counts in data["doc_terms"].items():
+            index._add_terms(doc_id, term_counts, data["doc_metadata"].get(doc_id, {}))
+        return index
@@ -2,6 +2,11 @@
 import os
 import time
 import json
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 import pandas as pd
 from dotenv import load_dotenv
@@ -9,6 +14,8 @@ import google.generativeai as genai
 import requests
 
 from vectorstore import VectorStoreManager
+from canned_questions import TEST_QUESTIONS
+from rate_limit import ProviderLimiter, parse_retry_after, parse_gemini_retry_delay
 
 load_dotenv(dotenv_path="../.env", override=True)
 
@@ -26,26 +33,17 @@ MODELS = {
     "Llama 3.3 8B": "meta-llama/llama-3.3-8b-instruct:free"
 }
 
-# test questions
-TEST_QUESTIONS = [
-    "What is our KYC verification process?",
-    "How does the fraud detection system work?",
-    "What were the Q3 2024 business results?",
-    "Explain the payment retry logic",
-    "What caused the October incident?",
-    "What are our Q4 OKR priorities?",
-    "How long does a refund take?",
-    "What are the KYC transaction limits?",
-    "Describe the database selection decision",
-    "What is the incident response procedure?"
-]
+# per provider limits, gemini and openrouter free tiers are limited separately
+PROVIDER_LIMITS = {
+    "gemini": {"max_concurrency": 2, "requests_per_minute": 10},
+    "openrouter": {"max_concurrency": 4, "requests_per_minute": 20}
+}
 
+CHECKPOINT_PATH = "../llm_comparison_checkpoint.jsonl"
 
-def get_context_for_question(vectorstore_manager: VectorStoreManager, question: str, k: int = 5) -> tuple:
-    # to retrieve context for a question and return both formatted string and raw chunks
-    docs_with_scores = vectorstore_manager.similarity_search_with_score(question, k=k)
-    documents = [doc for doc, score in docs_with_scores]
-    
+
+def format_context(docs_with_scores: List[tuple]) -> tuple:
+    # to turn retrieved chunks into the formatted context string and the raw chunk records
     context_parts = []
     chunks = []
     
@@ -66,8 +64,21 @@ def get_context_for_question(vectorstore_manager: VectorStoreManager, question:
     return "\n".join(context_parts), chunks
 
 
-def query_openrouter(model: str, context: str, question: str, max_retries: int = 2) -> Dict:
-    # to query openrouter api with retry logic for rate limits
+def get_context_for_question(vectorstore_manager: VectorStoreManager, question: str, k: int = 5) -> tuple:
+    # to retrieve context for a question and return both formatted string and raw chunks
+    return format_context(vectorstore_manager.similarity_search_with_score(question, k=k))
+
+
+def get_contexts_for_questions(vectorstore_manager: VectorStoreManager, questions: List[str], k: int = 5) -> List[tuple]:
+    # batch version of get_context_for_question: one encode call and one vector query for all questions
+    return [
+        format_context(docs_with_scores)
+        for docs_with_scores in vectorstore_manager.similarity_search_batch(questions, k=k)
+    ]
+
+
+def query_openrouter(model: str, context: str, question: str) -> Dict:
+    # to query openrouter api, 429s are reported back (with Retry-After) so the caller can back off
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
@@ -98,58 +109,52 @@ ANSWER:"""
     
     start_time = time.time()
     
-    for attempt in range(max_retries + 1):
-        try:
-            response = requests.post(OPENROUTER_BASE_URL, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()
-            elapsed_time = time.time() - start_time
-            
-            result = response.json()
-            answer = result['choices'][0]['message']['content']
-            
-            return {
-                "answer": answer,
-                "time": elapsed_time,
-                "error": None
-            }
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 429 and attempt < max_retries:
-                wait_time = 30 * (attempt + 1)
-                print(f"\n  [rate limit, waiting {wait_time}s...]", flush=True)
-                time.sleep(wait_time)
-                continue
-            else:
-                elapsed_time = time.time() - start_time
-                try:
-                    error_detail = response.json().get('error', {}).get('message', str(e))
-                except:
-                    error_detail = str(e)
-                return {
-                    "answer": None,
-                    "time": elapsed_time,
-                    "error": error_detail
-                }
-        except requests.exceptions.Timeout:
-            elapsed_time = time.time() - start_time
-            return {
-                "answer": None,
-                "time": elapsed_time,
-                "error": "Timeout after 30 seconds"
-            }
-        except Exception as e:
-            elapsed_time = time.time() - start_time
+    try:
+        response = requests.post(OPENROUTER_BASE_URL, headers=headers, json=payload, timeout=30)
+        response.raise_for_status()
+        elapsed_time = time.time() - start_time
+        
+        result = response.json()
+        answer = result['choices'][0]['message']['content']
+        
+        return {
+            "answer": answer,
+            "time": elapsed_time,
+            "error": None
+        }
+    except requests.exceptions.HTTPError as e:
+        elapsed_time = time.time() - start_time
+        if e.response.status_code == 429:
             return {
                 "answer": None,
                 "time": elapsed_time,
-                "error": str(e)
+                "error": "Rate limited",
+                "rate_limited": True,
+                "retry_after": parse_retry_after(e.response.headers.get("Retry-After"))
             }
-    
-    elapsed_time = time.time() - start_time
-    return {
-        "answer": None,
-        "time": elapsed_time,
-        "error": "Max retries exceeded"
-    }
+        try:
+            error_detail = response.json().get('error', {}).get('message', str(e))
+        except:
+            error_detail = str(e)
+        return {
+            "answer": None,
+            "time": elapsed_time,
+            "error": error_detail
+        }
+    except requests.exceptions.Timeout:
+        elapsed_time = time.time() - start_time
+        return {
+            "answer": None,
+            "time": elapsed_time,
+            "error": "Timeout after 30 seconds"
+        }
+    except Exception as e:
+        elapsed_time = time.time() - start_time
+        return {
+            "answer": None,
+            "time": elapsed_time,
+            "error": str(e)
+        }
 
 
 def query_gemini(model_name: str, context: str, question: str) -> Dict:
@@ -183,6 +188,15 @@ ANSWER:"""
         }
     except Exception as e:
         elapsed_time = time.time() - start_time
+        # ResourceExhausted from google.api_core carries code 429
+        if getattr(e, "code", None) == 429 or "429" in str(e):
+            return {
+                "answer": None,
+                "time": elapsed_time,
+                "error": "Rate limited",
+                "rate_limited": True,
+                "retry_after": parse_gemini_retry_delay(str(e))
+            }
         return {
             "answer": None,
             "time": elapsed_time,
@@ -190,7 +204,98 @@ ANSWER:"""
         }
 
 
-def run_comparison():
+def checkpoint_key(question: str, model_id: str, context: str) -> str:
+    # to key a checkpointed answer by everything the model saw, a changed index or model id never reuses it
+    payload = json.dumps({"question": question, "model": model_id, "context": context}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(checkpoint_path: str) -> Dict:
+    # to load finished results from an interrupted run, by checkpoint_key
+    done = {}
+    if not Path(checkpoint_path).exists():
+        return done
+    
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a run killed mid-write leaves a partial last line
+                continue
+            if "key" in entry:
+                done[entry["key"]] = entry["result"]
+    
+    return done
+
+
+def append_checkpoint_entry(checkpoint_file, entry: Dict):
+    checkpoint_file.write(json.dumps(entry) + "\n")
+    checkpoint_file.flush()
+
+
+async def run_model_queries(contexts: List[str], questions: List[str], checkpoint_path: str, resume: bool) -> Dict:
+    # to query every (question, model) pair concurrently under per-provider limits, results are keyed by
+    # (question index, model name) so a question listed twice gets its own answers
+    # finished pairs are appended to the checkpoint by one writer thread, so the event loop never waits on
+    # the file and an interrupted run can resume
+    # resume: reuse checkpointed answers whose question, model id and retrieved context are unchanged
+    limiters = {
+        provider: ProviderLimiter(provider, **limits) for provider, limits in PROVIDER_LIMITS.items()
+    }
+    
+    keys = {
+        (index, model_name): checkpoint_key(question, model_id, contexts[index])
+        for index, question in enumerate(questions)
+        for model_name, model_id in MODELS.items()
+    }
+    checkpointed = load_checkpoint(checkpoint_path) if resume else {}
+    done = {pair: checkpointed[key] for pair, key in keys.items() if key in checkpointed}
+    if done:
+        print(f"resuming: {len(done)} results loaded from {checkpoint_path}")
+    
+    loop = asyncio.get_running_loop()
+    writer = ThreadPoolExecutor(max_workers=1)
+    checkpoint_file = open(checkpoint_path, "a" if resume else "w")
+    
+    async def run_one(index: int, question: str, model_name: str, model_id: str):
+        if model_id.startswith("gemini-"):
+            result = await limiters["gemini"].call(query_gemini, model_id, contexts[index], question)
+        else:
+            result = await limiters["openrouter"].call(query_openrouter, model_id, contexts[index], question)
+        
+        if result["error"]:
+            print(f"  {model_name} | {question[:50]}: ERROR: {result['error']}", flush=True)
+        else:
+            # only successful answers are checkpointed, failures are retried on resume
+            entry = {"key": keys[(index, model_name)], "question": question, "model_name": model_name, "result": result}
+            await loop.run_in_executor(writer, append_checkpoint_entry, checkpoint_file, entry)
+            print(f"  {model_name} | {question[:50]}: ({result['time']:.2f}s, {len(result['answer'] or '')} chars)", flush=True)
+        
+        done[(index, model_name)] = result
+    
+    try:
+        tasks = [
+            run_one(index, question, model_name, model_id)
+            for index, question in enumerate(questions)
+            for model_name, model_id in MODELS.items()
+            if (index, model_name) not in done
+        ]
+        print(f"{len(tasks)} requests to send")
+        await asyncio.gather(*tasks)
+    finally:
+        writer.shutdown()
+        checkpoint_file.close()
+    
+    return done
+
+
+def run_comparison(questions: List[str] = None, checkpoint_path: str = CHECKPOINT_PATH, resume: bool = False):
+    
+    # resume: continue an interrupted run from checkpoint_path, a run without errors deletes the checkpoint
     
     # Load vector store
     print("\nloading vector store...")
@@ -201,47 +306,38 @@ def run_comparison():
     
     print(f"vector store loaded: {vm.get_collection_stats()['total_documents']} documents")
     
+    if questions is None:
+        questions = TEST_QUESTIONS
+    
+    # retrieval is local and fast, do it up front, by question index
+    retrieved = get_contexts_for_questions(vm, questions, k=5)
+    contexts = [context for context, chunks in retrieved]
+    chunks_by_question = [chunks for context, chunks in retrieved]
+    
+    model_results = asyncio.run(run_model_queries(contexts, questions, checkpoint_path, resume))
+    
     # results storage
     results = []
     
-    # test each question
-    for q_idx, question in enumerate(TEST_QUESTIONS, 1):
-        print(f"\n question {q_idx}/{len(TEST_QUESTIONS)}: {question}")
-
-        
-        context, chunks = get_context_for_question(vm, question, k=5)
-        
+    for q_idx, question in enumerate(questions, 1):
         question_results = {
             "question": question,
             "question_num": q_idx,
-            "retrieved_chunks": chunks
+            "retrieved_chunks": chunks_by_question[q_idx - 1]
         }
         
-        # Test each model
-        for model_name, model_id in MODELS.items():
-            print(f"\n testing {model_name}...", end=" ", flush=True)
-            
-            # Check if it's a Gemini model (starts with "gemini-")
-            if model_id.startswith("gemini-"):
-                result = query_gemini(model_id, context, question)
-            else:
-                result = query_openrouter(model_id, context, question)
+        for model_name in MODELS.keys():
+            result = model_results[(q_idx - 1, model_name)]
             
             if result["error"]:
-                print(f"ERROR: {result['error']}", flush=True)
                 question_results[f"{model_name}_answer"] = "ERROR"
                 question_results[f"{model_name}_time"] = result["time"]
                 question_results[f"{model_name}_length"] = 0
             else:
                 answer_length = len(result["answer"]) if result["answer"] else 0
-                print(f"({result['time']:.2f}s, {answer_length} chars)", flush=True)
                 question_results[f"{model_name}_answer"] = result["answer"]
                 question_results[f"{model_name}_time"] = result["time"]
                 question_results[f"{model_name}_length"] = answer_length
-            
-            # Wait 20 seconds before next request to avoid rate limiting
-            print(f"  [Waiting 20s before next model...]", flush=True)
-            time.sleep(20)
         
         results.append(question_results)
     
@@ -291,8 +387,25 @@ def run_comparison():
     length_df.to_csv("../llm_comparison_length.csv", index=False)
     
     print("\nresults saved")
+    
+    failed = sum(1 for result in model_results.values() if result["error"])
+    if failed:
+        print(f"{failed} requests failed, rerun with --resume to retry only those")
+    else:
+        Path(checkpoint_path).unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
-    run_comparison()
+    parser = argparse.ArgumentParser(description="Compare LLM answers on the same retrieved context")
+    parser.add_argument("--questions-file", help="json list of questions, defaults to TEST_QUESTIONS")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="jsonl file with finished results")
+    parser.add_argument("--resume", action="store_true", help="reuse answers from an interrupted run's checkpoint")
+    args = parser.parse_args()
+    
+    questions = None
+    if args.questions_file:
+        with open(args.questions_file, "r") as f:
+            questions = json.load(f)
+    
+    run_comparison(questions, checkpoint_path=args.checkpoint, resume=args.resume)
 
@@ -0,0 +1,244 @@
+# document loaders keyed by file extension - plain python parsers for the text formats, so ingestion
+# workers don't need the unstructured stack. markdown, docx, html and csv come out as markdown text
+# (headings, lists, pipe tables) so the structure-aware chunker can split them along their sections
+
+import re
+import csv
+import zipfile
+from pathlib import Path
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+from typing import Callable, Dict, List
+
+from langchain.schema import Document
+
+# extension -> function(path) returning documents, filled by register_loader
+LOADERS: Dict[str, Callable[[Path], List[Document]]] = {}
+
+# metadata['text_format'] of documents whose text keeps markdown structure
+MARKDOWN_FORMAT = "markdown"
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+CORE_PROPERTIES_NAMESPACES = {
+    "cp": "http://schemas.openxmlformats.org/package/2006/metadata/core-properties",
+    "dc": "http://purl.org/dc/elements/1.1/"
+}
+HEADING_STYLE_PATTERN = re.compile(r"^Heading(\d)$")
+
+
+def register_loader(*extensions: str):
+    # decorator to add or replace the loader of one or more extensions (".html", ".htm")
+    # loaders registered at runtime only reach the ingest worker processes on platforms that fork
+    def decorator(loader: Callable[[Path], List[Document]]):
+        for extension in extensions:
+            LOADERS[extension.lower()] = loader
+        return loader
+    return decorator
+
+
+def _read_text(file_path: Path) -> str:
+    # utf-8 with a bom tolerated, undecodable bytes are replaced rather than failing the whole file
+    return file_path.read_text(encoding="utf-8-sig", errors="replace")
+
+
+def _markdown_title(text: str) -> str:
+    match = re.search(r"^#\s+(.+?)\s*#*\s*$", text, re.MULTILINE)
+    return match.group(1) if match else ""
+
+
+def _table_to_markdown(rows: List[List[str]]) -> str:
+    # first row is the header, cells are flattened to one line and pipes escaped
+    rows = [[re.sub(r"\s+", " ", cell).strip().replace("|", "\\|") for cell in row] for row in rows if row]
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    lines = ["| " + " | ".join(rows[0]) + " |", "|" + "---|" * width]
+    lines.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+    return "\n".join(lines)
+
+
+@register_loader(".md", ".markdown")
+def load_markdown(file_path: Path) -> List[Document]:
+    # markdown is already what the chunker wants, it is only read
+    text = _read_text(file_path)
+    return [Document(page_content=text, metadata={"title": _markdown_title(text), "text_format": MARKDOWN_FORMAT})]
+
+
+@register_loader(".txt")
+def load_text(file_path: Path) -> List[Document]:
+    return [Document(page_content=_read_text(file_path), metadata={"text_format": "text"})]
+
+
+@register_loader(".csv")
+def load_csv(file_path: Path) -> List[Document]:
+    # the whole file as one pipe table, the chunker splits long tables by rows and repeats the header
+    with open(file_path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        rows = list(csv.reader(f))
+    return [Document(
+        page_content=_table_to_markdown(rows),
+        metadata={"title": file_path.stem, "text_format": MARKDOWN_FORMAT, "rows": max(len(rows) - 1, 0)}
+    )]
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    parts = []
+    for node in paragraph.iter():
+        if node.tag == WORD_NAMESPACE + "t" and node.text:
+            parts.append(node.text)
+        elif node.tag == WORD_NAMESPACE + "tab":
+            parts.append("\t")
+        elif node.tag in (WORD_NAMESPACE + "br", WORD_NAMESPACE + "cr"):
+            parts.append("\n")
+    return "".join(parts).strip()
+
+
+def _docx_paragraph_style(paragraph) -> str:
+    style = paragraph.find(f"{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}pStyle")
+    return style.get(WORD_NAMESPACE + "val", "") if style is not None else ""
+
+
+@register_loader(".docx")
+def load_docx(file_path: Path) -> List[Document]:
+
+    # to read word/document.xml directly: heading styles become markdown headings, list styles list items
+    # and tables pipe tables, so the chunker sees the same structure as in the markdown original
+    with zipfile.ZipFile(file_path) as archive:
+        body = ElementTree.fromstring(archive.read("word/document.xml")).find(WORD_NAMESPACE + "body")
+        title = ""
+        if "docProps/core.xml" in archive.namelist():
+            core = ElementTree.fromstring(archive.read("docProps/core.xml"))
+            title = core.findtext("dc:title", default="", namespaces=CORE_PROPERTIES_NAMESPACES) or ""
+
+    blocks = []
+    for element in body if body is not None else []:
+        if element.tag == WORD_NAMESPACE + "tbl":
+            rows = [
+                [" ".join(_docx_paragraph_text(p) for p in cell.iter(WORD_NAMESPACE + "p"))
+                 for cell in row.findall(WORD_NAMESPACE + "tc")]
+                for row in element.findall(WORD_NAMESPACE + "tr")
+            ]
+            blocks.append(_table_to_markdown(rows))
+            continue
+
+        if element.tag != WORD_NAMESPACE + "p":
+            continue
+
+        text = _docx_paragraph_text(element)
+        if not text:
+            continue
+
+        style = _docx_paragraph_style(element)
+        heading_match = HEADING_STYLE_PATTERN.match(style)
+        if heading_match:
+            blocks.append("#" * int(heading_match.group(1)) + " " + text)
+        elif style == "Title":
+            blocks.append("# " + text)
+        elif style.startswith("List") or element.find(f"{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}numPr") is not None:
+            # consecutive list items stay one block
+            if blocks and blocks[-1].startswith("- "):
+                blocks[-1] += "\n- " + text
+            else:
+                blocks.append("- " + text)
+        else:
+            blocks.append(text)
+
+    text = "\n\n".join(block for block in blocks if block)
+    return [Document(page_content=text, metadata={"title": title or _markdown_title(text), "text_format": MARKDOWN_FORMAT})]
+
+
+class _HTMLToMarkdown(HTMLParser):
+    # headings, paragraphs, list items and tables to markdown, script/style/nav content dropped
+
+    SKIPPED_TAGS = {"script", "style", "noscript", "nav", "head", "template"}
+    BLOCK_TAGS = {"p", "div", "section", "article", "header", "footer", "blockquote", "pre", "ul", "ol", "br", "hr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self.title = ""
+        self._current = []
+        self._prefix = ""
+        self._skip_depth = 0
+        self._in_title = False
+        self._table = None  # rows of the table being read
+        self._cell = None
+
+    def _flush(self):
+        text = re.sub(r"[ \t\r\f\v]+", " ", "".join(self._current)).strip()
+        if text and self._prefix == "- " and self.blocks and self.blocks[-1].startswith("- "):
+            # consecutive list items stay one block
+            self.blocks[-1] += "\n- " + text
+        elif text:
+            self.blocks.append(self._prefix + text)
+        self._current = []
+        self._prefix = ""
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skip_depth += 1
+        if tag == "title":
+            self._in_title = True
+        elif re.fullmatch(r"h[1-6]", tag):
+            self._flush()
+            self._prefix = "#" * int(tag[1]) + " "
+        elif tag == "li":
+            self._flush()
+            self._prefix = "- "
+        elif tag == "table":
+            self._flush()
+            self._table = []
+        elif tag == "tr" and self._table is not None:
+            self._table.append([])
+        elif tag in ("td", "th") and self._table is not None:
+            self._cell = []
+        elif tag in self.BLOCK_TAGS and self._cell is None:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        if tag == "title":
+            self._in_title = False
+        elif tag in ("td", "th") and self._cell is not None:
+            if self._table:
+                self._table[-1].append("".join(self._cell))
+            self._cell = None
+        elif tag == "table" and self._table is not None:
+            self.blocks.append(_table_to_markdown(self._table))
+            self._table = None
+        elif re.fullmatch(r"h[1-6]", tag) or tag == "li" or (tag in self.BLOCK_TAGS and self._cell is None):
+            self._flush()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data.strip()
+        elif self._skip_depth:
+            return
+        elif self._cell is not None:
+            self._cell.append(data)
+        else:
+            self._current.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+@register_loader(".html", ".htm")
+def load_html(file_path: Path) -> List[Document]:
+    parser = _HTMLToMarkdown()
+    parser.feed(_read_text(file_path))
+    parser.close()
+    text = "\n\n".join(block for block in parser.blocks if block)
+    return [Document(page_content=text, metadata={"title": parser.title or _markdown_title(text), "text_format": MARKDOWN_FORMAT})]
+
+
+@register_loader(".pdf")
+def load_pdf(file_path: Path) -> List[Document]:
+    # pdf text extraction is not worth rewriting, pypdf via langchain, one document per page
+    from langchain_community.document_loaders import PyPDFLoader
+    documents = PyPDFLoader(str(file_path)).load()
+    for doc in documents:
+        doc.metadata["text_format"] = "text"
+    return documents
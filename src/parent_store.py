@@ -0,0 +1,78 @@
+# parent passage store for small-to-big retrieval - small child chunks are embedded and searched, the
+# section/window they were cut from is kept here once and sent to the llm instead
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Dict, Iterable, TYPE_CHECKING
+
+# langchain is imported on first use, vectorstore imports this module at startup
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+
+class ParentDocumentStore:
+    # sqlite table: parent id -> text + metadata, child chunks point at it with metadata['parent_id']
+
+    def __init__(self, store_path: str):
+
+        # store_path: sqlite file, created if missing
+        self.store_path = store_path
+        self._lock = threading.Lock()
+
+        Path(store_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(store_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parents ("
+            "id TEXT PRIMARY KEY, full_path TEXT, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_full_path ON parents(full_path)")
+        self._conn.commit()
+
+    def put_many(self, parents: Iterable[Document]) -> int:
+        # to store parents keyed by metadata['parent_id'], ids are content derived so re-ingesting is idempotent
+        rows = [
+            (doc.metadata['parent_id'], doc.metadata.get('full_path'), doc.page_content, json.dumps(doc.metadata))
+            for doc in parents
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO parents (id, full_path, text, metadata) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+        return len(rows)
+
+    def get_many(self, parent_ids: List[str]) -> Dict[str, Document]:
+        # to fetch parents by id, missing ids are left out
+        from langchain.schema import Document
+        
+        found = {}
+        with self._lock:
+            # sqlite has a limit on bound parameters so query in slices
+            for start in range(0, len(parent_ids), 500):
+                batch = parent_ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT id, text, metadata FROM parents WHERE id IN ({placeholders})", batch
+                ).fetchall()
+                for parent_id, text, metadata in rows:
+                    found[parent_id] = Document(page_content=text, metadata=json.loads(metadata))
+        return found
+
+    def delete_by_path(self, full_path: str) -> int:
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM parents WHERE full_path = ?", (full_path,)).rowcount
+            self._conn.commit()
+        return deleted
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM parents").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
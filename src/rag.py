@@ -1,16 +1,28 @@
+from __future__ import annotations
+
 import os
-from typing import Dict, List, Optional
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Iterator, TYPE_CHECKING
 from dotenv import load_dotenv
 
-from langchain.schema import Document
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+from answer_cache import SemanticAnswerCache
+from context_packer import ContextPacker
+from tracing import Trace, start_trace, activate, span, accumulate, record_error
 
-from vectorstore import VectorStoreManager
+# langchain and the gemini client take seconds to import, they are loaded on first use
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from langchain.prompts import PromptTemplate
+    from vectorstore import VectorStoreManager
+    from reranker import CrossEncoderReranker
 
 load_dotenv()
 
+# bump when the prompt template changes so cached answers from the old prompt are not served
+PROMPT_VERSION = "v1"
+
 # document permissions control
 ROLE_PERMISSIONS = {
     "Admin": ["all"],
@@ -23,28 +35,67 @@ ROLE_PERMISSIONS = {
 }
 
 
+def get_role_filter(user_role: str) -> Optional[Dict]:
+    # to turn a role's allowed categories into a vector search where clause
+    # returns None for unrestricted roles (unknown roles have no categories and are rejected before searching)
+    allowed_categories = ROLE_PERMISSIONS.get(user_role, [])
+    
+    if "all" in allowed_categories:
+        return None
+    
+    return {"category": {"$in": allowed_categories}}
+
+
 class RAGRetriever:
     # question-answering system using retrieval-augmented generation 
     def __init__(self, 
                  vectorstore_manager: VectorStoreManager,
                  model_name: str = "gemini-2.5-flash",
-                 temperature: float = 0.2):
+                 temperature: float = 0.2,
+                 answer_cache: Optional[SemanticAnswerCache] = None,
+                 use_answer_cache: bool = True,
+                 retrieval_mode: str = "vector",
+                 reranker: Optional[CrossEncoderReranker] = None,
+                 rerank_candidates: int = 30,
+                 context_token_budget: Optional[int] = 3000,
+                 expand_to_parents: bool = False,
+                 max_parent_chars: int = 4000):
 
         # initialize RAG retriever.
         # vectorstore_manager: Initialized VectorStoreManager instance
         # model_name: Name of the LLM model to use
         # temperature: LLM temperature (0.0 = deterministic, 1.0 = creative)
+        # answer_cache: shared SemanticAnswerCache, a default one is created if not given
+        # use_answer_cache: set False to always call the LLM
+        # retrieval_mode: "vector" for embedding search only, "hybrid" to fuse it with bm25
+        # reranker: optional CrossEncoderReranker, the search then fetches rerank_candidates chunks
+        #   and the reranker keeps the best ones
+        # context_token_budget: max tokens of retrieved text in the prompt, None sends every chunk in full
+        # expand_to_parents: small-to-big, matched chunks are replaced by their parent passage (collections
+        #   built with DocumentIngester(parent_chunk_size=...)), max_parent_chars caps each passage
+        if retrieval_mode not in ("vector", "hybrid"):
+            raise ValueError(f"Unknown retrieval_mode: {retrieval_mode}")
+        
         self.vectorstore_manager = vectorstore_manager
+        self.retrieval_mode = retrieval_mode
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.context_packer = ContextPacker(max_tokens=context_token_budget) if context_token_budget else None
+        self.expand_to_parents = expand_to_parents
+        self.max_parent_chars = max_parent_chars
         self.model_name = model_name
         self.temperature = temperature
         self.llm = None
         
-        api_key = os.getenv("GEMINI_API_KEY")
+        if answer_cache is None and use_answer_cache:
+            answer_cache = SemanticAnswerCache()
+        self.answer_cache = answer_cache
         
-        self._initialize_llm()
-    
     def _initialize_llm(self):
-        try:
+        # to create the llm client on first use
+        if self.llm is None:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+            
             api_key = os.getenv("GEMINI_API_KEY")
             
             self.llm = ChatGoogleGenerativeAI(
@@ -53,12 +104,13 @@ class RAGRetriever:
                 convert_system_message_to_human=True,
                 google_api_key=api_key
             )
-        except Exception as e:
-            raise
+        return self.llm
     
     def _create_prompt_template(self) -> PromptTemplate:
 
         # to create the prompt template for question answering
+        from langchain.prompts import PromptTemplate
+        
         template = """You are an assistant for Skyro's internal knowledge base. Answer questions using only the provided documentation context.
 
 CONTEXT:
@@ -83,15 +135,22 @@ ANSWER:"""
     def _format_context(self, documents: List[Document]) -> str:
 
         # to format retrieved documents into context string
+        # with a token budget, adjacent chunks are merged without their overlap and the budget is
+        # filled most relevant first
+        if self.context_packer is not None:
+            documents = self.context_packer.pack(documents)
+        
         context_parts = []
         
         for i, doc in enumerate(documents, 1):
             source = doc.metadata.get('source', 'Unknown')
             category = doc.metadata.get('category', 'General')
             content = doc.page_content.strip()
+            # markdown chunks know which section they come from
+            section = f" - {doc.metadata['heading_path']}" if doc.metadata.get('heading_path') else ""
             
             context_parts.append(
-                f"[Document {i} - {source} ({category})]\n{content}\n"
+                f"[Document {i} - {source} ({category}){section}]\n{content}\n"
             )
         
         return "\n".join(context_parts)
@@ -124,106 +183,360 @@ ANSWER:"""
             "error": result["error"]
         }
     
+    def _check_question(self, question: str, user_role: str) -> Optional[Dict]:
+
+        # to validate the question, returns the final result if there is nothing to retrieve
+        if not question or not question.strip():
+            return {
+                "answer": "Please provide a valid question.",
+                "sources": [],
+                "chunks": [],
+                "error": True
+            }
+        
+        if not self.vectorstore_manager.is_loaded():
+            return {
+                "answer": "Vector store not loaded. Please ensure vectorstore.py has been run.",
+                "sources": [],
+                "chunks": [],
+                "error": True
+            }
+        
+        # access control is applied inside the vector search, so the role gets k permitted chunks
+        if not ROLE_PERMISSIONS.get(user_role):
+            return {
+                "answer": "No access",
+                "sources": [],
+                "chunks": [],
+                "error": False
+            }
+        
+        return None
+    
+    def _search_k(self, k: int) -> int:
+        # with a reranker we search wider and let it pick the best k
+        return max(k, self.rerank_candidates) if self.reranker is not None else k
+    
+    def _retrieve(self, question: str, k: int, user_role: str) -> Dict:
+
+        # to validate the question and fetch the permitted chunks
+        # returns {"result": ...} when there is nothing to generate (bad input, no access, no hits)
+        early_result = self._check_question(question, user_role)
+        if early_result is not None:
+            return {"result": early_result}
+        
+        role_filter = get_role_filter(user_role)
+        
+        # retrieve relevant documents, the question embedding is reused for the answer cache
+        question_embedding = self.vectorstore_manager.embed_query(question)
+        if self.retrieval_mode == "hybrid":
+            docs_with_scores = self.vectorstore_manager.hybrid_search(
+                question,
+                k=self._search_k(k),
+                filter_dict=role_filter,
+                query_embedding=question_embedding
+            )
+        else:
+            docs_with_scores = self.vectorstore_manager.similarity_search_by_vector_with_score(
+                question_embedding, 
+                k=self._search_k(k),
+                filter_dict=role_filter
+            )
+        
+        return self._finish_retrieval(question, question_embedding, docs_with_scores, k, role_filter)
+    
+    def _finish_retrieval(self, question: str, question_embedding: List[float], docs_with_scores: List[tuple],
+                          k: int, role_filter: Optional[Dict]) -> Dict:
+
+        # to rerank (if enabled) and package search results
+        if self.reranker is not None and docs_with_scores:
+            with span("rerank") as attributes:
+                docs_with_scores, rerank_info = self.reranker.rerank(question, docs_with_scores, k)
+                attributes.update(rerank_info)
+        
+        if not docs_with_scores:
+            return {"result": {
+                "answer": "No access" if role_filter else "I couldn't find any relevant information in the knowledge base to answer your question.",
+                "sources": [],
+                "chunks": [],
+                "error": False
+            }}
+        
+        # the answer cache is keyed by the matched chunks
+        chunk_ids = [doc.metadata.get('vector_id', '') for doc, score in docs_with_scores]
+        
+        if self.expand_to_parents:
+            with span("expand", chunks=len(docs_with_scores)) as attributes:
+                docs_with_scores = self.vectorstore_manager.expand_to_parents(docs_with_scores, self.max_parent_chars)
+                attributes["passages"] = len(docs_with_scores)
+            # plus the parents they expanded to - a child keeps its id when another part of its parent is
+            # edited, the parent id is derived from the parent's text so it changes
+            chunk_ids += [
+                doc.metadata['parent_id'] for doc, score in docs_with_scores if 'matched_chunk_ids' in doc.metadata
+            ]
+        
+        # separate documents and scores
+        documents = [doc for doc, score in docs_with_scores]
+        
+        return {
+            "question_embedding": question_embedding,
+            "documents": documents,
+            "scores": [score for doc, score in docs_with_scores],
+            "chunk_ids": chunk_ids
+        }
+    
+    def _get_cached_answer(self, retrieval: Dict, k: int, user_role: str) -> Optional[str]:
+        if self.answer_cache is None:
+            return None
+        
+        with span("answer_cache") as attributes:
+            response = self.answer_cache.get(
+                retrieval["question_embedding"], user_role, k, retrieval["chunk_ids"], self.model_name, PROMPT_VERSION
+            )
+            attributes["hit"] = response is not None
+        return response
+    
+    def _store_answer(self, retrieval: Dict, k: int, user_role: str, response: str):
+        if self.answer_cache is not None:
+            self.answer_cache.put(
+                retrieval["question_embedding"], user_role, k, retrieval["chunk_ids"], self.model_name, PROMPT_VERSION, response
+            )
+    
+    def _count_tokens(self, text: str) -> int:
+        # gemini has no public tokenizer, the packer's tiktoken count is close enough for tracking
+        if self.context_packer is not None:
+            return self.context_packer.count_tokens(text)
+        return len(text) // 4 + 1
+    
+    def _build_prompt(self, question: str, documents: List[Document]) -> str:
+        # to pack the context and fill the prompt template, timed as the "format" stage
+        with span("format", chunks=len(documents)) as attributes:
+            prompt = self._create_prompt_template().format(
+                context=self._format_context(documents),
+                question=question
+            )
+            attributes["tokens_in"] = self._count_tokens(prompt)
+        accumulate(tokens_in=attributes["tokens_in"])
+        return prompt
+    
+    def _build_result(self, response: str, documents: List[Document], scores: List[float]) -> Dict:
+
+        # xxtract sources
+        sources = self._extract_sources(documents)
+        
+        # format chunks for display
+        chunks = []
+        for i, (doc, score) in enumerate(zip(documents, scores), 1):
+            chunk = {
+                'rank': i,
+                'source': doc.metadata.get('source', 'Unknown'),
+                'category': doc.metadata.get('category', 'General'),
+                'score': float(score),  # convert to float for JSON serialization
+                'preview': doc.page_content[:300] + "..." if len(doc.page_content) > 300 else doc.page_content
+            }
+            # search score (distance or rrf) stays in 'score', the cross-encoder's is a separate scale
+            if 'rerank_score' in doc.metadata:
+                chunk['rerank_score'] = float(doc.metadata['rerank_score'])
+            # 'distance' (lower is better) in vector mode, 'rrf' (higher is better) in hybrid mode
+            chunk['score_type'] = "rrf" if self.retrieval_mode == "hybrid" else "distance"
+            for rank_key in ('dense_rank', 'lexical_rank'):
+                if rank_key in doc.metadata:
+                    chunk[rank_key] = doc.metadata[rank_key]
+            chunks.append(chunk)
+        
+        return {
+            "answer": response.strip(),
+            "sources": sources,
+            "chunks": chunks,
+            "error": False
+        }
+    
+    def _generate(self, question: str, retrieval: Dict, k: int, user_role: str) -> Dict:
+
+        # to answer from retrieved chunks (answer cache first, then the llm)
+        documents = retrieval["documents"]
+        response = self._get_cached_answer(retrieval, k, user_role)
+        
+        if response is None:
+            # format context and prompt for the LLM
+            prompt = self._build_prompt(question, documents)
+            llm = self._initialize_llm()
+            
+            # generate answer
+            with span("llm", model=self.model_name) as attributes:
+                response = llm.invoke(prompt).content
+                attributes["tokens_out"] = self._count_tokens(response)
+            accumulate(tokens_out=attributes["tokens_out"])
+            
+            self._store_answer(retrieval, k, user_role, response)
+        
+        return self._build_result(response, documents, retrieval["scores"])
+    
     def query_with_context(self, question: str, k: int = 5, user_role: str = "Admin") -> Dict:
 
         # so query the knowledge base and generate an answer with full context
-        try:
-            # validate inputs
-            if not question or not question.strip():
-                return {
-                    "answer": "Please provide a valid question.",
-                    "sources": [],
-                    "chunks": [],
-                    "error": True
-                }
-            
-            if self.vectorstore_manager.vectorstore is None:
-                return {
-                    "answer": "Vector store not loaded. Please ensure vectorstore.py has been run.",
+        # the result carries per-stage "timings" of the request (see tracing.py)
+        with start_trace("query") as trace:
+            try:
+                retrieval = self._retrieve(question, k, user_role)
+                if "result" in retrieval:
+                    result = retrieval["result"]
+                else:
+                    result = self._generate(question, retrieval, k, user_role)
+                
+            except Exception as e:
+                trace.fail(e)
+                result = {
+                    "answer": f"An error occurred: {str(e)}",
                     "sources": [],
                     "chunks": [],
                     "error": True
                 }
-            
-            # retrieve relevant documents
-            docs_with_scores = self.vectorstore_manager.similarity_search_with_score(
-                question, 
-                k=k
+        
+        return {**result, "timings": trace.timings()}
+    
+    def retrieve_batch(self, questions: List[str], k: int = 5, user_role: str = "Admin") -> List[Dict]:
+
+        # to retrieve for many questions at once: one batched encode for all questions and
+        # grouped vector searches, returns one retrieval (or {"result": ...}) per question in input order
+        retrievals = [None] * len(questions)
+        pending = []
+        
+        for i, question in enumerate(questions):
+            early_result = self._check_question(question, user_role)
+            if early_result is not None:
+                retrievals[i] = {"result": early_result}
+            else:
+                pending.append(i)
+        
+        if not pending:
+            return retrievals
+        
+        role_filter = get_role_filter(user_role)
+        pending_questions = [questions[i] for i in pending]
+        question_embeddings = self.vectorstore_manager.embed_queries(pending_questions)
+        
+        if self.retrieval_mode == "hybrid":
+            # bm25 is in-process and cheap, fuse per question with the precomputed embeddings
+            search_results = [
+                self.vectorstore_manager.hybrid_search(
+                    question, k=self._search_k(k), filter_dict=role_filter, query_embedding=embedding
+                )
+                for question, embedding in zip(pending_questions, question_embeddings)
+            ]
+        else:
+            search_results = self.vectorstore_manager.similarity_search_batch(
+                pending_questions,
+                k=self._search_k(k),
+                filter_dict=role_filter,
+                query_embeddings=question_embeddings
             )
-            
-            if not docs_with_scores:
-                return {
-                    "answer": "I couldn't find any relevant information in the knowledge base to answer your question.",
+        
+        for i, embedding, docs_with_scores in zip(pending, question_embeddings, search_results):
+            retrievals[i] = self._finish_retrieval(questions[i], embedding, docs_with_scores, k, role_filter)
+        
+        return retrievals
+    
+    def query_batch(self, questions: List[str], k: int = 5, user_role: str = "Admin", max_workers: int = 4) -> List[Dict]:
+
+        # so answer many questions: retrieval is batched, llm calls run concurrently in a bounded pool
+        # results have the same shape as query_with_context and come back in input order
+        # max_workers: llm calls in flight at once
+        # the whole batch is one trace, every result carries its "timings"
+        with start_trace("query_batch") as trace:
+            trace.set(questions=len(questions))
+            try:
+                retrievals = self.retrieve_batch(questions, k, user_role)
+            except Exception as e:
+                trace.fail(e)
+                retrievals = [{"result": {
+                    "answer": f"An error occurred: {str(e)}",
                     "sources": [],
                     "chunks": [],
-                    "error": False
-                }
-            
-            # separate documents and scores
-            documents = [doc for doc, score in docs_with_scores]
-            scores = [score for doc, score in docs_with_scores]
+                    "error": True
+                }} for _ in questions]
             
-            # apply access control filtering
-            allowed_categories = ROLE_PERMISSIONS.get(user_role, [])
-            if "all" not in allowed_categories:
-                filtered_docs = []
-                filtered_scores = []
-                for doc, score in zip(documents, scores):
-                    doc_category = doc.metadata.get('category', 'General')
-                    if doc_category in allowed_categories:
-                        filtered_docs.append(doc)
-                        filtered_scores.append(score)
-                
-                if not filtered_docs:
+            def answer(i: int) -> Dict:
+                retrieval = retrievals[i]
+                if "result" in retrieval:
+                    return retrieval["result"]
+                try:
+                    return self._generate(questions[i], retrieval, k, user_role)
+                except Exception as e:
+                    record_error(e)
                     return {
-                        "answer": "No access",
+                        "answer": f"An error occurred: {str(e)}",
                         "sources": [],
                         "chunks": [],
-                        "error": False
+                        "error": True
                     }
-                
-                documents = filtered_docs
-                scores = filtered_scores
-            
-            # format context for LLM
-            context = self._format_context(documents)
-            
-            # create prompt
-            prompt_template = self._create_prompt_template()
-            
-            # generate answer
-            chain = LLMChain(llm=self.llm, prompt=prompt_template)
             
-            response = chain.run(
-                context=context,
-                question=question
-            )
+            # pool threads do not inherit the trace, each call runs in a copy of this context
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, answer, i) for i in range(len(questions))]
+                results = [future.result() for future in futures]
+        
+        timings = trace.timings()
+        return [{**result, "timings": timings} for result in results]
+    
+    def stream_query_with_context(self, question: str, k: int = 5, user_role: str = "Admin") -> Iterator[Dict]:
+
+        # so same as query_with_context but streams the answer
+        # yields {"type": "token", "content": ...} while the llm generates, then exactly one
+        # {"type": "result", ...} with the same answer/sources/chunks/error/timings fields as query_with_context
+        # each next() may run on a different thread (the server), so the trace is activated
+        # around every stretch of work instead of across the yields
+        trace = Trace("stream_query")
+        try:
+            with activate(trace):
+                retrieval = self._retrieve(question, k, user_role)
+            if "result" in retrieval:
+                trace.finish()
+                yield {"type": "result", **retrieval["result"], "timings": trace.timings()}
+                return
             
-            # xxtract sources
-            sources = self._extract_sources(documents)
+            documents = retrieval["documents"]
+            with activate(trace):
+                response = self._get_cached_answer(retrieval, k, user_role)
             
-            # format chunks for display
-            chunks = []
-            for i, (doc, score) in enumerate(zip(documents, scores), 1):
-                chunks.append({
-                    'rank': i,
-                    'source': doc.metadata.get('source', 'Unknown'),
-                    'category': doc.metadata.get('category', 'General'),
-                    'score': float(score),  # convert to float for JSON serialization
-                    'preview': doc.page_content[:300] + "..." if len(doc.page_content) > 300 else doc.page_content
-                })
+            if response is not None:
+                yield {"type": "token", "content": response}
+            else:
+                with activate(trace):
+                    prompt = self._build_prompt(question, documents)
+                    llm = self._initialize_llm()
+                
+                parts = []
+                start_time = time.perf_counter()
+                for message_chunk in llm.stream(prompt):
+                    if message_chunk.content:
+                        if not parts:
+                            trace.set(llm_ttft_ms=(time.perf_counter() - start_time) * 1000)
+                        parts.append(message_chunk.content)
+                        yield {"type": "token", "content": message_chunk.content}
+                
+                response = "".join(parts)
+                tokens_out = self._count_tokens(response)
+                trace.add_span("llm", start_time, time.perf_counter(), {"model": self.model_name, "tokens_out": tokens_out})
+                trace.accumulate(tokens_out=tokens_out)
+                with activate(trace):
+                    self._store_answer(retrieval, k, user_role, response)
             
-            return {
-                "answer": response.strip(),
-                "sources": sources,
-                "chunks": chunks,
-                "error": False
-            }
+            result = self._build_result(response, documents, retrieval["scores"])
+            trace.finish()
+            yield {"type": "result", **result, "timings": trace.timings()}
             
         except Exception as e:
-            return {
+            trace.fail(e)
+            trace.finish()
+            yield {
+                "type": "result",
                 "answer": f"An error occurred: {str(e)}",
                 "sources": [],
                 "chunks": [],
-                "error": True
+                "error": True,
+                "timings": trace.timings()
             }
+        finally:
+            # a client that disconnects mid-stream still ends up in the metrics
+            trace.finish()
@@ -0,0 +1,115 @@
+# async rate limiting helpers for the llm benchmark scripts - per provider concurrency limits,
+# token bucket request pacing and 429 backoff driven by Retry-After
+
+import re
+import time
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # to turn a Retry-After header (seconds or http date) into seconds to wait
+    if not value:
+        return None
+
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_gemini_retry_delay(message: str) -> Optional[float]:
+    # to read the suggested delay out of a gemini 429 error message ("retry_delay { seconds: 17 }")
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", message) or re.search(r"retry in ([\d.]+)s", message)
+    return float(match.group(1)) if match else None
+
+
+class AsyncTokenBucket:
+    # classic token bucket: refills at rate_per_minute, holds at most `burst` tokens
+
+    def __init__(self, requests_per_minute: float, burst: int = 1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        # to wait until a request may be sent
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # to hold back every request of this provider after a 429, not just the one that got it
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class ProviderLimiter:
+    # concurrency limit + token bucket + 429 retries for one api provider
+
+    def __init__(self, name: str, max_concurrency: int, requests_per_minute: float, burst: int = 1,
+                 max_retries: int = 3, default_backoff: float = 10.0):
+
+        # max_concurrency: requests in flight at once
+        # requests_per_minute: sustained request rate
+        # max_retries: retries after rate limited responses
+        # default_backoff: base wait when the provider gives no Retry-After, doubled per attempt
+        self.name = name
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.bucket = AsyncTokenBucket(requests_per_minute, burst)
+        self.max_retries = max_retries
+        self.default_backoff = default_backoff
+        self.rate_limited_count = 0
+
+    async def call(self, fn: Callable[..., Dict], *args) -> Dict:
+
+        # to run a blocking request function in a thread under this provider's limits
+        # fn must return a dict, with "rate_limited": True (and optionally "retry_after") on 429
+        result = {}
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                await self.bucket.acquire()
+                result = await asyncio.to_thread(fn, *args)
+
+            if not result.get("rate_limited"):
+                return result
+
+            self.rate_limited_count += 1
+            if attempt == self.max_retries:
+                break
+
+            wait_time = result.get("retry_after") or self.default_backoff * (2 ** attempt)
+            print(f"\n  [{self.name} rate limit, waiting {wait_time:.0f}s...]", flush=True)
+            self.bucket.pause(wait_time)
+            await asyncio.sleep(wait_time)
+
+        return result
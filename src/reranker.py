@@ -0,0 +1,74 @@
+# optional cross-encoder reranking of retrieved chunks - takes a wide vector candidate set and keeps the
+# few most relevant ones, within a latency budget
+
+import time
+from typing import List, Dict, Optional, Tuple
+
+
+class CrossEncoderReranker:
+    # rescoring (question, chunk) pairs with a small cpu cross-encoder, in batches
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", top_n: Optional[int] = None,
+                 batch_size: int = 8, budget_ms: float = 300.0, max_length: int = 512):
+
+        # model_name: sentence-transformers CrossEncoder model
+        # top_n: chunks to keep, defaults to the k asked for by the caller
+        # batch_size: pairs scored per forward pass, the budget is checked between batches
+        # budget_ms: if scoring takes longer than this the original vector order is used instead
+        # max_length: max tokens per (question, chunk) pair
+        self.model_name = model_name
+        self.top_n = top_n
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self.max_length = max_length
+        self.model = None
+        self.fallback_count = 0
+
+    def _initialize_model(self):
+        # to load the cross-encoder on first use
+        if self.model is None:
+            from sentence_transformers import CrossEncoder
+            self.model = CrossEncoder(self.model_name, max_length=self.max_length, device='cpu')
+        return self.model
+
+    def rerank(self, question: str, docs_with_scores: List[Tuple], k: int) -> Tuple[List[Tuple], Dict]:
+
+        # to reorder candidates by cross-encoder score and keep the best top_n (or k)
+        # returns (document, score) pairs with the search score unchanged, the cross-encoder score is put in
+        # metadata['rerank_score'] (logits, not comparable with distances or rrf scores), and info about what happened
+        top_n = self.top_n or k
+        info = {
+            "candidates": len(docs_with_scores),
+            "reranked": False,
+            "elapsed_ms": 0.0
+        }
+
+        if len(docs_with_scores) <= 1:
+            return docs_with_scores[:top_n], info
+
+        # model loading is not counted against the per-query budget
+        model = self._initialize_model()
+
+        start_time = time.perf_counter()
+        pairs = [(question, doc.page_content) for doc, score in docs_with_scores]
+        rerank_scores = []
+
+        for start in range(0, len(pairs), self.batch_size):
+            elapsed_ms = (time.perf_counter() - start_time) * 1000
+            if elapsed_ms > self.budget_ms:
+                # over budget, fall back to the vector search order
+                self.fallback_count += 1
+                info["elapsed_ms"] = elapsed_ms
+                return docs_with_scores[:top_n], info
+
+            batch = pairs[start:start + self.batch_size]
+            rerank_scores.extend(float(score) for score in model.predict(batch, batch_size=len(batch)))
+
+        info["elapsed_ms"] = (time.perf_counter() - start_time) * 1000
+        info["reranked"] = True
+
+        for (doc, _), rerank_score in zip(docs_with_scores, rerank_scores):
+            doc.metadata['rerank_score'] = rerank_score
+
+        reranked = sorted(docs_with_scores, key=lambda item: item[0].metadata['rerank_score'], reverse=True)
+        return reranked[:top_n], info
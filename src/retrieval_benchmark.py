@@ -0,0 +1,254 @@
+# retrieval benchmark - builds the store for each chunking config and backend, runs a labeled question set
+# and reports recall@k, MRR, nDCG@k and search latency percentiles / QPS
+# Run from src: python retrieval_benchmark.py (writes ../evaluations/retrieval_benchmark.json and .csv)
+
+import re
+import csv
+import json
+import math
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+
+from vectorstore import VectorStoreManager, EMBEDDING_CACHE_FILENAME
+from chunking import CHUNK_PROFILES
+
+DATA_DIR = str(Path(__file__).parent.parent / "skyro_dataset" / "data")
+OUTPUT_DIR = "../evaluations"
+# dataset notes, not knowledge base documents
+EXCLUDE_FILES = ["DATASET_OVERVIEW.md", "FILE_FORMATS_SUMMARY.md"]
+
+# chunking configs to compare (DocumentIngester arguments), the first one is what vectorstore.py builds
+CHUNK_CONFIGS = {
+    "profiles": {"chunk_size": 1000, "chunk_overlap": 200, "chunk_profiles": CHUNK_PROFILES},
+    "1000/200": {"chunk_size": 1000, "chunk_overlap": 200},
+    "500/100": {"chunk_size": 500, "chunk_overlap": 100},
+    "1500/300": {"chunk_size": 1500, "chunk_overlap": 300},
+    "1000/200-flat": {"chunk_size": 1000, "chunk_overlap": 200, "structure_aware": False},
+    # small-to-big: 400 char children are searched, results are expanded to their 2000 char parents
+    "400>2000": {"chunk_size": 400, "chunk_overlap": 50, "parent_chunk_size": 2000}
+}
+
+
+
+def config_slug(config_name: str) -> str:
+    # to turn a config name into a directory name, "400>2000" -> "400-2000"
+    return re.sub(r"[^A-Za-z0-9_-]+", "-", config_name).strip("-")
+
+
+# labeled questions - expected sources are document names without extension, so the md/pdf/docx
+# copies of a document all count as a hit
+BENCHMARK_QUESTIONS = [
+    {"question": "What is our KYC verification process?", "expected_sources": ["kyc_process"]},
+    {"question": "What are the transaction limits for each KYC verification level?", "expected_sources": ["kyc_process"]},
+    {"question": "How long do we retain KYC documents?", "expected_sources": ["kyc_process"]},
+    {"question": "Why was a customer's KYC verification rejected?", "expected_sources": ["customer_support_faq", "kyc_process"]},
+    {"question": "How does the fraud detection scoring engine work?", "expected_sources": ["fraud_detection_system"]},
+    {"question": "How often is the fraud model retrained?", "expected_sources": ["fraud_detection_system"]},
+    {"question": "What are the known limitations of the fraud detection system?", "expected_sources": ["fraud_detection_system"]},
+    {"question": "What were the Q3 2024 revenue and profitability numbers?", "expected_sources": ["q3_2024_business_review"]},
+    {"question": "How is the global expansion initiative progressing?", "expected_sources": ["q3_2024_business_review", "q4_2024_okrs"]},
+    {"question": "What are the engineering and product OKRs for Q4 2024?", "expected_sources": ["q4_2024_okrs"]},
+    {"question": "What risks and dependencies were identified for Q4?", "expected_sources": ["q4_2024_okrs"]},
+    {"question": "What did the payment retry experiment show?", "expected_sources": ["payment_retry_logic_results"]},
+    {"question": "How did payment success rate change by retry attempt?", "expected_sources": ["payment_retry_logic_results"]},
+    {"question": "What caused the payment gateway outage in postmortem 089?", "expected_sources": ["incident_postmortem_089"]},
+    {"question": "What action items came out of the payment gateway incident?", "expected_sources": ["incident_postmortem_089"]},
+    {"question": "What stories were committed in sprint 42?", "expected_sources": ["sprint_42_planning"]},
+    {"question": "What technical debt items were discussed in sprint planning?", "expected_sources": ["sprint_42_planning"]},
+    {"question": "What should a new engineer do in their first week?", "expected_sources": ["new_engineer_guide"]},
+    {"question": "How do I set up the development environment?", "expected_sources": ["new_engineer_guide"]},
+    {"question": "How do we handle chargebacks?", "expected_sources": ["chargeback_procedures"]},
+    {"question": "What evidence do we submit to dispute a chargeback?", "expected_sources": ["chargeback_procedures"]},
+    {"question": "Which payment methods does payment processing V2 support?", "expected_sources": ["payment_processing_v2"]},
+    {"question": "What is the rollout plan for Payment Processing System V2?", "expected_sources": ["payment_processing_v2"]},
+    {"question": "What are the security incident severity levels?", "expected_sources": ["incident_response_playbook"]},
+    {"question": "Who is on the incident response team and on-call rotation?", "expected_sources": ["incident_response_playbook"]},
+    {"question": "How long does a refund take?", "expected_sources": ["customer_support_faq", "merchant_api_documentation"]},
+    {"question": "A customer was charged twice, what should support do?", "expected_sources": ["customer_support_faq"]},
+    {"question": "Why did we choose CockroachDB for transaction storage?", "expected_sources": ["adr_015_database_selection"]},
+    {"question": "What was the migration and rollback plan in ADR 015?", "expected_sources": ["adr_015_database_selection"]},
+    {"question": "How do merchants authenticate with the Skyro API?", "expected_sources": ["merchant_api_documentation"]},
+    {"question": "What are the merchant API rate limits?", "expected_sources": ["merchant_api_documentation"]},
+    {"question": "How do webhooks work in the merchant API?", "expected_sources": ["merchant_api_documentation"]}
+]
+
+
+def source_key(metadata: Dict) -> str:
+    # document name without extension, the unit BENCHMARK_QUESTIONS is labeled in
+    return Path(metadata.get('source', '')).stem
+
+
+def score_ranking(retrieved: List[str], expected: List[str], relevant_chunks: int, k: int) -> Dict:
+
+    # to score one ranked list of retrieved chunk sources against the expected sources
+    # recall@k: share of expected documents with at least one chunk in the top k
+    # mrr: 1 / rank of the first relevant chunk
+    # ndcg@k: binary chunk relevance, the ideal ranking has min(k, relevant chunks in the store) hits on top
+    top_k = retrieved[:k]
+    expected_set = set(expected)
+
+    recall = len(expected_set & set(top_k)) / len(expected_set) if expected_set else 0.0
+    first_hit = next((rank for rank, source in enumerate(top_k, 1) if source in expected_set), None)
+    dcg = sum(1.0 / math.log2(rank + 1) for rank, source in enumerate(top_k, 1) if source in expected_set)
+    ideal = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(k, relevant_chunks) + 1))
+
+    return {
+        "recall": recall,
+        "reciprocal_rank": 1.0 / first_hit if first_hit else 0.0,
+        "ndcg": dcg / ideal if ideal > 0 else 0.0
+    }
+
+
+def run_searches(manager: VectorStoreManager, mode: str, questions: List[str], embeddings: List[List[float]],
+                 k: int, repeats: int) -> tuple:
+
+    # to run every question repeats times, returns the rankings of the first pass and per-call latencies
+    rankings = []
+    latencies = []
+
+    for repeat in range(repeats):
+        for question, embedding in zip(questions, embeddings):
+            start_time = time.perf_counter()
+            if mode == "hybrid":
+                results = manager.hybrid_search(question, k=k, query_embedding=embedding)
+            else:
+                results = manager.similarity_search_by_vector_with_score(embedding, k=k)
+            # no-op unless the store was built with parents
+            results = manager.expand_to_parents(results)
+            latencies.append(time.perf_counter() - start_time)
+
+            if repeat == 0:
+                rankings.append([source_key(doc.metadata) for doc, score in results])
+
+    return rankings, latencies
+
+
+def benchmark_store(manager: VectorStoreManager, mode: str, k: int, repeats: int) -> Dict:
+
+    # to compute quality and latency metrics for one built store and retrieval mode
+    questions = [item["question"] for item in BENCHMARK_QUESTIONS]
+    # embedding is the same for every config and backend, only the search itself is timed
+    embeddings = manager.embed_queries(questions)
+
+    chunks_per_source = Counter(
+        source_key(metadata) for page in manager.backend.iter_batches(include_embeddings=False)
+        for metadata in page["metadatas"]
+    )
+
+    # one untimed pass so lazy loading (bm25 index, memory maps) is not counted
+    run_searches(manager, mode, questions[:1], embeddings[:1], k, 1)
+    rankings, latencies = run_searches(manager, mode, questions, embeddings, k, repeats)
+
+    scores = [
+        score_ranking(ranking, item["expected_sources"],
+                      sum(chunks_per_source[source] for source in item["expected_sources"]), k)
+        for ranking, item in zip(rankings, BENCHMARK_QUESTIONS)
+    ]
+    latencies_ms = np.array(latencies) * 1000
+
+    return {
+        "questions": len(questions),
+        f"recall_at_{k}": float(np.mean([score["recall"] for score in scores])),
+        "mrr": float(np.mean([score["reciprocal_rank"] for score in scores])),
+        f"ndcg_at_{k}": float(np.mean([score["ndcg"] for score in scores])),
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p95_ms": float(np.percentile(latencies_ms, 95)),
+        "latency_p99_ms": float(np.percentile(latencies_ms, 99)),
+        "qps": len(latencies) / float(np.sum(latencies)) if latencies else 0.0,
+        "misses": [
+            item["question"] for score, item in zip(scores, BENCHMARK_QUESTIONS) if score["recall"] == 0.0
+        ]
+    }
+
+
+def run_benchmark(config_names: List[str], backends: List[str], modes: List[str], k: int = 5,
+                  repeats: int = 3, data_dir: str = DATA_DIR, output_dir: str = OUTPUT_DIR) -> List[Dict]:
+
+    # to build a throwaway store per chunking config and backend and benchmark every retrieval mode on it
+    # output_dir: also holds the embedding cache, so later runs don't encode the same chunks again
+    from ingest import DocumentIngester
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    embedding_cache_path = str(Path(output_dir) / EMBEDDING_CACHE_FILENAME)
+
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="skyro_benchmark_") as work_dir:
+        for config_name in config_names:
+            ingester = DocumentIngester(**CHUNK_CONFIGS[config_name])
+
+            for backend in backends:
+                # the shared embedding cache makes rebuilding the same chunks cheap
+                manager = VectorStoreManager(
+                    persist_directory=str(Path(work_dir) / f"{config_slug(config_name)}_{backend}"),
+                    embedding_cache_path=embedding_cache_path,
+                    backend=backend
+                )
+                build_stats = manager.rebuild_from_directory(ingester, data_dir, exclude_files=EXCLUDE_FILES)
+                print(f"\n{config_name} / {backend}: {build_stats['chunks']} chunks from {build_stats['files']} files")
+
+                for mode in modes:
+                    metrics = benchmark_store(manager, mode, k, repeats)
+                    results.append({
+                        "chunk_config": config_name,
+                        "chunk_size": ingester.chunk_size,
+                        "chunk_overlap": ingester.chunk_overlap,
+                        "structure_aware": ingester.structure_aware,
+                        "chunk_profiles": bool(ingester.chunk_profiles),
+                        "parent_chunk_size": ingester.parent_chunk_size,
+                        "backend": backend,
+                        "mode": mode,
+                        "k": k,
+                        "chunks": build_stats["chunks"],
+                        **metrics
+                    })
+                    print(f"  {mode}: recall@{k} {metrics[f'recall_at_{k}']:.3f}, mrr {metrics['mrr']:.3f}, "
+                          f"ndcg@{k} {metrics[f'ndcg_at_{k}']:.3f}, p50 {metrics['latency_p50_ms']:.2f} ms, "
+                          f"p95 {metrics['latency_p95_ms']:.2f} ms, p99 {metrics['latency_p99_ms']:.2f} ms, "
+                          f"{metrics['qps']:.0f} qps")
+
+    return results
+
+
+def save_results(results: List[Dict], output_dir: str = OUTPUT_DIR):
+    # to write the full results as json and one csv row per config/backend/mode for regression tracking
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    with open(output_path / "retrieval_benchmark.json", 'w') as f:
+        json.dump({
+            "timestamp": datetime.now().isoformat(),
+            "questions": BENCHMARK_QUESTIONS,
+            "results": results
+        }, f, indent=2)
+
+    columns = [key for key in results[0] if key != "misses"] if results else []
+    with open(output_path / "retrieval_benchmark.csv", 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow({key: round(value, 4) if isinstance(value, float) else value for key, value in result.items()})
+
+    print(f"\nresults saved to {output_path / 'retrieval_benchmark.json'} and {output_path / 'retrieval_benchmark.csv'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark retrieval quality and latency")
+    parser.add_argument("--configs", nargs="+", default=list(CHUNK_CONFIGS), choices=list(CHUNK_CONFIGS))
+    parser.add_argument("--backends", nargs="+", default=["chroma", "numpy"], choices=["chroma", "numpy"])
+    parser.add_argument("--modes", nargs="+", default=["vector", "hybrid"], choices=["vector", "hybrid"])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=3, help="timed passes over the question set")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmark(args.configs, args.backends, args.modes, k=args.k, repeats=args.repeats,
+                                      output_dir=args.output_dir)
+    save_results(benchmark_results, args.output_dir)
@@ -0,0 +1,235 @@
+# headless http query service for Skyro Knowledge Assistant - the same RAGRetriever as the streamlit app,
+# for internal tools (slack bot, support console). Run from src: python server.py
+
+import os
+import sys
+import json
+import time
+import asyncio
+from pathlib import Path
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+
+# add src to path
+sys.path.append(str(Path(__file__).parent))
+
+from vectorstore import VectorStoreManager
+from rag import RAGRetriever, ROLE_PERMISSIONS, get_role_filter
+from answer_cache import SemanticAnswerCache
+from tracing import METRICS, SlowRequestHook, add_hook
+
+PERSIST_DIRECTORY = os.getenv("SKYRO_PERSIST_DIR", "./chroma_db")
+# retrievers in the pool = max requests processed at once, further requests wait for a free one
+RETRIEVER_POOL_SIZE = int(os.getenv("SKYRO_RETRIEVER_POOL_SIZE", "16"))
+# threads for the blocking embedding / chroma / llm calls
+WORKER_THREADS = int(os.getenv("SKYRO_WORKER_THREADS", "32"))
+# requests allowed to wait for a retriever before new ones get a 503
+MAX_QUEUED_REQUESTS = int(os.getenv("SKYRO_MAX_QUEUED_REQUESTS", "64"))
+# requests slower than this get their stage breakdown printed, 0 turns it off
+SLOW_REQUEST_MS = float(os.getenv("SKYRO_SLOW_REQUEST_MS", "10000"))
+# chunk metadata returned by /sources/{source}/chunks, the rest (full_path etc.) describes the server's disk
+SOURCE_CHUNK_FIELDS = ("source", "chunk_index", "page", "heading_path", "category")
+
+
+class QueryRequest(BaseModel):
+    question: str
+    k: int = 5
+    user_role: str = "Admin"
+
+
+class RetrieverPool:
+    # warm RAGRetrievers sharing one VectorStoreManager (one embedding model, one chroma client) and one answer cache
+
+    def __init__(self, vectorstore_manager: VectorStoreManager, size: int, **retriever_kwargs):
+        self.size = size
+        self.answer_cache = SemanticAnswerCache()
+        self._queue = asyncio.Queue()
+        for _ in range(size):
+            self._queue.put_nowait(RAGRetriever(vectorstore_manager, answer_cache=self.answer_cache, **retriever_kwargs))
+
+    async def acquire(self) -> RAGRetriever:
+        return await self._queue.get()
+
+    def release(self, retriever: RAGRetriever):
+        self._queue.put_nowait(retriever)
+
+    def available(self) -> int:
+        return self._queue.qsize()
+
+
+class ServiceState:
+    # everything loaded once per process
+
+    def __init__(self):
+        self.vectorstore_manager = None
+        self.pool = None
+        self.executor = None
+        self.waiting = 0
+        self.counters = {
+            "requests": 0,
+            "stream_requests": 0,
+            "errors": 0,
+            "rejected": 0,
+            "total_seconds": 0.0
+        }
+
+
+state = ServiceState()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state.executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="rag")
+    loop = asyncio.get_running_loop()
+
+    state.vectorstore_manager = VectorStoreManager(persist_directory=PERSIST_DIRECTORY)
+    if not await loop.run_in_executor(state.executor, state.vectorstore_manager.load_vectorstore):
+        raise RuntimeError(f"Failed to load vector store from {PERSIST_DIRECTORY}")
+
+    # load the embedding model now rather than on the first request
+    await loop.run_in_executor(state.executor, state.vectorstore_manager.warm_up, False)
+
+    state.pool = RetrieverPool(state.vectorstore_manager, RETRIEVER_POOL_SIZE, retrieval_mode="hybrid")
+    if SLOW_REQUEST_MS > 0:
+        add_hook(SlowRequestHook(SLOW_REQUEST_MS))
+    yield
+    state.executor.shutdown(wait=False)
+
+
+app = FastAPI(title="Skyro Knowledge Assistant", lifespan=lifespan)
+
+
+async def acquire_retriever() -> RAGRetriever:
+    # to wait for a free retriever, rejecting when too many requests are already waiting
+    if state.waiting >= MAX_QUEUED_REQUESTS:
+        state.counters["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Too many requests, try again later")
+
+    state.waiting += 1
+    try:
+        return await state.pool.acquire()
+    finally:
+        state.waiting -= 1
+
+
+def validate_request(request: QueryRequest):
+    if request.user_role not in ROLE_PERMISSIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown role: {request.user_role}")
+    if not 1 <= request.k <= 20:
+        raise HTTPException(status_code=400, detail="k must be between 1 and 20")
+
+
+@app.post("/query")
+async def query(request: QueryRequest) -> Dict:
+    validate_request(request)
+    retriever = await acquire_retriever()
+    start_time = time.time()
+
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            state.executor, retriever.query_with_context, request.question, request.k, request.user_role
+        )
+    finally:
+        state.pool.release(retriever)
+
+    state.counters["requests"] += 1
+    state.counters["total_seconds"] += time.time() - start_time
+    if result["error"]:
+        state.counters["errors"] += 1
+
+    return result
+
+
+@app.post("/query/stream")
+async def query_stream(request: QueryRequest) -> StreamingResponse:
+    # newline delimited json: token events, then one result event
+    validate_request(request)
+    retriever = await acquire_retriever()
+
+    async def events():
+        start_time = time.time()
+        loop = asyncio.get_running_loop()
+        iterator = retriever.stream_query_with_context(request.question, request.k, request.user_role)
+
+        try:
+            while True:
+                # each next() blocks on the llm, so it runs in the worker pool
+                event = await loop.run_in_executor(state.executor, next, iterator, None)
+                if event is None:
+                    break
+                if event["type"] == "result" and event["error"]:
+                    state.counters["errors"] += 1
+                yield json.dumps(event) + "\n"
+        finally:
+            state.pool.release(retriever)
+            state.counters["stream_requests"] += 1
+            state.counters["total_seconds"] += time.time() - start_time
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@app.get("/sources/{source:path}/chunks")
+async def source_chunks(source: str, user_role: str) -> Dict:
+    # all chunks of one source file in document order, by file name or path relative to the data dir
+    if user_role not in ROLE_PERMISSIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown role: {user_role}")
+
+    loop = asyncio.get_running_loop()
+    documents = await loop.run_in_executor(
+        state.executor, state.vectorstore_manager.get_chunks_by_source, source, get_role_filter(user_role)
+    )
+    if not documents:
+        raise HTTPException(status_code=404, detail=f"No chunks found for {source}")
+
+    return {
+        "source": source,
+        "chunks": [
+            {
+                "id": doc.metadata['vector_id'],
+                "text": doc.page_content,
+                "metadata": {field: doc.metadata[field] for field in SOURCE_CHUNK_FIELDS if field in doc.metadata}
+            }
+            for doc in documents
+        ]
+    }
+
+
+@app.get("/stats")
+async def stats() -> Dict:
+    loop = asyncio.get_running_loop()
+    collection_stats = await loop.run_in_executor(state.executor, state.vectorstore_manager.get_collection_stats)
+
+    handled = state.counters["requests"] + state.counters["stream_requests"]
+    return {
+        "collection": collection_stats,
+        "answer_cache": state.pool.answer_cache.get_statistics(),
+        "requests": {
+            **state.counters,
+            "avg_seconds": state.counters["total_seconds"] / handled if handled else 0.0,
+            "in_flight": state.pool.size - state.pool.available(),
+            "waiting": state.waiting
+        },
+        "latency": METRICS.snapshot()
+    }
+
+
+@app.get("/metrics")
+async def metrics() -> PlainTextResponse:
+    # per-stage latency histograms, llm time to first token and token counts for prometheus
+    return PlainTextResponse(METRICS.export_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/health")
+async def health() -> Dict:
+    return {"status": "ok"}
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=os.getenv("SKYRO_HOST", "0.0.0.0"), port=int(os.getenv("SKYRO_PORT", "8000")))
@@ -0,0 +1,99 @@
+# import-time budget check - imports each module in a fresh interpreter with python -X importtime and
+# reports what its cold start costs and where the time goes. Run from src: python startup_budget.py
+# exits with 1 if a module is over its budget
+
+import sys
+import argparse
+import subprocess
+from pathlib import Path
+from typing import Dict, List
+
+# cumulative import time allowed per module, in ms - heavy libraries (langchain, chroma, torch,
+# the gemini client) must be imported on first use, not at module load
+IMPORT_BUDGETS_MS = {
+    "rag": 300,
+    "vectorstore": 250,
+    "answer_cache": 200,
+    "context_packer": 100,
+    "reranker": 50,
+    "lexical_index": 50
+}
+
+
+def parse_importtime(output: str) -> List[Dict]:
+    # to parse "import time: self [us] | cumulative | imported package" lines, nesting depth is
+    # given by the indentation of the package name
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        name = name.rstrip()
+        entries.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip())) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000
+        })
+    return entries
+
+
+def measure_import(module: str) -> List[Dict]:
+    # to import a module in a new interpreter (so nothing is already in sys.modules) and collect its import times
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=str(Path(__file__).parent),
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    return parse_importtime(result.stderr)
+
+
+def report_module(module: str, budget_ms: float, top: int) -> bool:
+    # to print the total import time of a module and its slowest imports, returns True if within budget
+    entries = measure_import(module)
+    # children are printed before their parent, so the module's own imports are the deeper lines right above it
+    position = max(i for i, entry in enumerate(entries) if entry["module"] == module and entry["depth"] == 0)
+    total_ms = entries[position]["cumulative_ms"]
+    direct = []
+    for entry in reversed(entries[:position]):
+        if entry["depth"] == 0:
+            break
+        if entry["depth"] == 1:
+            direct.append(entry)
+
+    within_budget = total_ms <= budget_ms
+
+    print(f"\n{module}: {total_ms:.0f} ms (budget {budget_ms:.0f} ms) {'ok' if within_budget else 'OVER BUDGET'}")
+
+    # the module's direct imports show which dependency to defer
+    for entry in sorted(direct, key=lambda entry: entry["cumulative_ms"], reverse=True)[:top]:
+        print(f"  {entry['cumulative_ms']:8.1f} ms  {entry['module']}")
+
+    return within_budget
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check cold import time of the RAG modules against a budget")
+    parser.add_argument("modules", nargs="*", help="modules to check, defaults to all modules with a budget")
+    parser.add_argument("--top", type=int, default=10, help="slowest direct imports listed per module")
+    args = parser.parse_args()
+
+    modules = args.modules or list(IMPORT_BUDGETS_MS)
+    failed = []
+
+    for module in modules:
+        try:
+            if not report_module(module, IMPORT_BUDGETS_MS.get(module, float("inf")), args.top):
+                failed.append(module)
+        except RuntimeError as e:
+            print(f"\n{e}")
+            failed.append(module)
+
+    if failed:
+        print(f"\nover budget or failed: {', '.join(failed)}")
+        sys.exit(1)
+    print("\nall modules within budget")
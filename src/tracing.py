@@ -0,0 +1,318 @@
+# request tracing - per-stage spans (embed, search, fetch, rerank, format, llm) for each request, pluggable
+# hooks that see every finished trace, and latency histograms exported in the prometheus text format
+# stdlib only and a no-op outside a trace, so it is safe to call from hot paths
+
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Iterator
+
+# upper bounds in ms, from a cached embedding lookup up to a long llm generation
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+_current_trace = contextvars.ContextVar("skyro_trace", default=None)
+
+
+class Trace:
+    # spans and attributes of one request (one query, stream or batch)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.spans = []
+        self.attributes = {}
+        self.error = None
+        self.total_ms = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: float, end: float, attributes: Optional[Dict] = None) -> Dict:
+        # start / end are time.perf_counter() values, batch llm calls add spans from several threads
+        span = {
+            "name": name,
+            "start_ms": (start - self._start) * 1000,
+            "elapsed_ms": (end - start) * 1000,
+            **(attributes or {})
+        }
+        with self._lock:
+            self.spans.append(span)
+
+        for hook in list(_hooks):
+            _call_hook(hook.on_span, self, span)
+        return span
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def accumulate(self, **values):
+        # to add counts (tokens in/out) to the trace attributes, summed over calls
+        with self._lock:
+            for key, value in values.items():
+                self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def fail(self, error: Exception):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def finish(self):
+        # to close the trace and hand it to the hooks, later calls do nothing
+        if self.total_ms is not None:
+            return
+        self.total_ms = (time.perf_counter() - self._start) * 1000
+
+        for hook in list(_hooks):
+            _call_hook(hook.on_trace, self)
+
+    def stage_totals(self) -> Dict[str, float]:
+        # ms per span name, a stage that ran more than once (hybrid fetches) is summed
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["elapsed_ms"]
+        return totals
+
+    def timings(self) -> Dict:
+        # json-serializable summary attached to results as "timings"
+        return {
+            "trace_id": self.trace_id,
+            "total_ms": self.total_ms,
+            "stages": self.stage_totals(),
+            "spans": list(self.spans),
+            "error": self.error,
+            **self.attributes
+        }
+
+
+class TraceHook:
+    # base class for trace consumers, override either method
+    # hooks run inline on the request thread, so they must be cheap and must not raise
+
+    def on_span(self, trace: Trace, span: Dict):
+        pass
+
+    def on_trace(self, trace: Trace):
+        pass
+
+
+def _call_hook(method, *args):
+    # a broken hook must never fail the request it is observing
+    try:
+        method(*args)
+    except Exception as e:
+        print(f"Trace hook {type(method.__self__).__name__} failed: {e}")
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def record_error(error: Exception):
+    # to mark the current request failed where an error is turned into an empty or error result
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.fail(error)
+
+
+def accumulate(**values):
+    # to add counts to the current trace, does nothing when no trace is active
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.accumulate(**values)
+
+
+@contextmanager
+def activate(trace: Trace) -> Iterator[Trace]:
+    # to make trace the current one for the spans recorded inside the block
+    # generators use this around each stretch between yields, their next() may run on another thread
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def start_trace(name: str) -> Iterator[Trace]:
+    # to trace one request, the trace is finished (and the hooks called) when the block exits
+    trace = Trace(name)
+    try:
+        with activate(trace):
+            yield trace
+    except Exception as e:
+        trace.fail(e)
+        raise
+    finally:
+        trace.finish()
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Dict]:
+    # to time a stage of the current request, yields the attribute dict so results (hits, counts) can be
+    # added inside the block. does nothing when no trace is active
+    trace = _current_trace.get()
+    if trace is None:
+        yield attributes
+        return
+
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        trace.add_span(name, start, time.perf_counter(), attributes)
+
+
+class Histogram:
+    # cumulative-bucket histogram like prometheus keeps, cheap enough to update on every span
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        # upper bound of the bucket holding the q-th observation, what a latency slo is checked against
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return float("inf")
+
+
+class MetricsRegistry:
+    # histograms and counters keyed by (metric name, label values)
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric: str, value: float, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def increment(self, metric: str, value: float = 1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self) -> Dict:
+        # to summarize the histograms (count, avg, p50/p95/p99) and counters for /stats
+        with self._lock:
+            histograms = {}
+            for (metric, labels), histogram in sorted(self._histograms.items()):
+                name = metric + "".join(f"[{value}]" for _, value in labels)
+                histograms[name] = {
+                    "count": histogram.count,
+                    "avg_ms": histogram.total / histogram.count if histogram.count else 0.0,
+                    "p50_ms": histogram.quantile(0.5),
+                    "p95_ms": histogram.quantile(0.95),
+                    "p99_ms": histogram.quantile(0.99)
+                }
+            counters = {
+                metric + "".join(f"[{value}]" for _, value in labels): value
+                for (metric, labels), value in sorted(self._counters.items())
+            }
+        return {"histograms": histograms, "counters": counters}
+
+    def export_prometheus(self) -> str:
+        # to render everything in the prometheus text exposition format for a /metrics endpoint
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        seen = set()
+        for (metric, labels), histogram in histograms:
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.total}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+
+        for (metric, labels), value in counters:
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class MetricsHook(TraceHook):
+    # feeds finished traces into a MetricsRegistry, installed by default
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def on_trace(self, trace: Trace):
+        self.registry.observe("skyro_request_latency_ms", trace.total_ms, request=trace.name)
+        self.registry.increment("skyro_requests_total", request=trace.name, error=str(trace.error is not None).lower())
+
+        for stage, elapsed_ms in trace.stage_totals().items():
+            self.registry.observe("skyro_stage_latency_ms", elapsed_ms, stage=stage)
+
+        if "llm_ttft_ms" in trace.attributes:
+            self.registry.observe("skyro_llm_ttft_ms", trace.attributes["llm_ttft_ms"])
+        for direction in ("in", "out"):
+            if f"tokens_{direction}" in trace.attributes:
+                self.registry.increment("skyro_llm_tokens_total", trace.attributes[f"tokens_{direction}"], direction=direction)
+
+
+class SlowRequestHook(TraceHook):
+    # prints the stage breakdown of requests slower than threshold_ms
+
+    def __init__(self, threshold_ms: float = 5000.0):
+        self.threshold_ms = threshold_ms
+
+    def on_trace(self, trace: Trace):
+        if trace.total_ms < self.threshold_ms:
+            return
+        stages = ", ".join(f"{stage} {elapsed_ms:.0f} ms" for stage, elapsed_ms in trace.stage_totals().items())
+        print(f"Slow {trace.name} {trace.trace_id}: {trace.total_ms:.0f} ms ({stages})")
+
+
+METRICS = MetricsRegistry()
+_hooks: List[TraceHook] = [MetricsHook(METRICS)]
+
+
+def add_hook(hook: TraceHook):
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+
+def remove_hook(hook: TraceHook):
+    if hook in _hooks:
+        _hooks.remove(hook)
@@ -1,59 +1,713 @@
+from __future__ import annotations
+
 import os
+import json
+import time
+import uuid
+import argparse
+import threading
 from pathlib import Path
-from typing import List, Optional, Dict
+from collections import Counter, OrderedDict
+from typing import List, Optional, Dict, Iterable, TYPE_CHECKING
+
+import numpy as np
+
+from lexical_index import BM25Index
+from compact_index import CompactVectorIndex, recall_at_k
+from backends import VectorBackend, create_backend
+from canned_questions import CANNED_QUESTIONS
+from tracing import span, record_error
+
+# langchain, chroma and sentence-transformers are imported on first use, importing this module stays cheap
+if TYPE_CHECKING:
+    from langchain.schema import Document
+    from ingest import DocumentIngester
+    from parent_store import ParentDocumentStore
+
+MANIFEST_FILENAME = "ingest_manifest.json"
+EMBEDDING_CACHE_FILENAME = "embedding_cache.sqlite"
+LEXICAL_INDEX_FILENAME = "bm25_index.json"
+COMPACT_INDEX_DIRNAME = "compact_index"
+QUERY_EMBEDDINGS_FILENAME = "query_embeddings.npz"
+PARENT_STORE_FILENAME = "parent_docstore.sqlite"
+
+
+def normalize_query(text: str) -> str:
+    # to key query embeddings: all-MiniLM-L6-v2 lowercases its input and splits on whitespace, so case and
+    # spacing don't change the vector (a cased embedding model would need the case kept)
+    return " ".join(text.lower().split())
 
-from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.schema import Document
+
+class LazyEmbeddings:
+    # embedding function handed to chroma, the model is only loaded when something is actually embedded
+
+    def __init__(self, manager: "VectorStoreManager"):
+        self.manager = manager
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.manager._initialize_embeddings().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.manager._initialize_embeddings().embed_query(text)
 
 
 class VectorStoreManager:
     # for vector storing operations (embedding generation and similarity search)
     
-    def __init__(self, persist_directory: str = "./chroma_db", embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"):
+    def __init__(self, persist_directory: str = "./chroma_db", embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+                 embedding_cache_path: Optional[str] = None, use_embedding_cache: bool = True,
+                 use_compact_index: bool = False, compact_rescore_factor: int = 4,
+                 compact_full_precision: bool = True, backend: str = "chroma", query_cache_size: int = 1024):
 
         # persist_directory: Directory to persist ChromaDB data
         # embedding_model: HuggingFace model for embeddings
+        # embedding_cache_path: sqlite file for cached vectors, defaults to a file inside persist_directory
+        #   (delete_vectorstore keeps it, so a --full rebuild still reuses the cache)
+        # use_embedding_cache: set False to always encode from scratch
+        # use_compact_index: search an int8 copy of the vectors instead of the backend's own search
+        #   (the backend still stores texts and metadata), the copy is rebuilt on persist after changes
+        # compact_rescore_factor: int8 candidates per result rescored in full precision, trades recall for speed
+        # compact_full_precision: keep float32 vectors on disk for rescoring, False keeps only the int8 copy
+        #   (a fifth of the disk space, lower recall)
+        # backend: "chroma" (hnsw + sqlite) or "numpy" (exact search over memory mapped vectors, see backends.py)
+        # query_cache_size: question embeddings kept in memory (lru), 0 disables it
         self.persist_directory = persist_directory #
         self.embedding_model_name = embedding_model
-        self.vectorstore = None
+        self.backend_name = backend
+        self.backend = None
         self.embeddings = None
+        self.lexical_index = None
+        self.embedding_cache = None
+        self.use_embedding_cache = use_embedding_cache
+        self.base_embeddings = None
+        self.encode_pool = None
+        self.last_index_stats = None
+        self._embeddings_lock = threading.Lock()
+        self._warm_up_thread = None
+        self.use_compact_index = use_compact_index
+        self.compact_rescore_factor = compact_rescore_factor
+        self.compact_full_precision = compact_full_precision
+        self.compact_index = None
+        self._compact_index_stale = False
+        self.parent_store = None
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()  # normalized question -> embedding
+        self._query_cache_lock = threading.Lock()
+        self._query_table = None  # precomputed embeddings of CANNED_QUESTIONS
+        self.query_cache_stats = {"hits": 0, "table_hits": 0, "misses": 0}
+        
+        if embedding_cache_path is None:
+            embedding_cache_path = str(Path(persist_directory) / EMBEDDING_CACHE_FILENAME)
+        self.embedding_cache_path = embedding_cache_path
         
     def _initialize_embeddings(self):
-        # to initialize the embedding model
-        if self.embeddings is None:
-            self.embeddings = HuggingFaceEmbeddings(
+        # to initialize the embedding model, the lock keeps a background warm-up and a first query
+        # from loading it twice
+        if self.embeddings is not None:
+            return self.embeddings
+        
+        with self._embeddings_lock:
+            if self.embeddings is not None:
+                return self.embeddings
+            
+            from langchain.embeddings import HuggingFaceEmbeddings
+            from embedding_cache import EmbeddingCache, CachedEmbeddings
+            
+            embeddings = HuggingFaceEmbeddings(
                 model_name=self.embedding_model_name,
                 model_kwargs={'device': 'cpu'},  # Use 'cuda' if GPU available
                 encode_kwargs={'normalize_embeddings': True}
             )
+            self.base_embeddings = embeddings
+            
+            if self.use_embedding_cache:
+                # normalization is part of the key, unnormalized vectors must never share entries
+                self.embedding_cache = EmbeddingCache(
+                    self.embedding_cache_path,
+                    model_name=f"{self.embedding_model_name}:normalized"
+                )
+                embeddings = CachedEmbeddings(embeddings, self.embedding_cache)
+            
+            self.embeddings = embeddings
         return self.embeddings
     
+    def _warm_up_embeddings(self):
+        try:
+            self._initialize_embeddings()
+            # the first forward pass is much slower than later ones, do it here too (not through the cache)
+            self.base_embeddings.embed_query("warm up")
+        except Exception as e:
+            # the first query loads the model again and reports the error
+            print(f"embedding warm-up failed: {type(e).__name__}: {e}")
+
+    def warm_up(self, background: bool = True) -> Optional[threading.Thread]:
+
+        # to load the embedding model before the first query needs it
+        # background: load it in a daemon thread and return that thread, so a UI can render meanwhile
+        if self.embeddings is not None:
+            return None
+
+        if not background:
+            self._warm_up_embeddings()
+            return None
+
+        if self._warm_up_thread is None or not self._warm_up_thread.is_alive():
+            self._warm_up_thread = threading.Thread(target=self._warm_up_embeddings, name="embedding-warm-up", daemon=True)
+            self._warm_up_thread.start()
+        return self._warm_up_thread
+
     def create_vectorstore(self, documents: List[Document], batch_size: int = 100) -> bool:
 
         # to create a new vector store from documents
+        # batch_size: number of chunks embedded and written to chroma per add call
         try:
             if not documents:
                 return False
             
-            # initialize embeddings
-            embeddings = self._initialize_embeddings()
-            
-            # create vector store
-            self.vectorstore = Chroma.from_documents(
-                documents=documents,
-                embedding=embeddings,
-                persist_directory=self.persist_directory,
-                collection_name="skyro_knowledge"
-            )
+            # create vector store and embed in bounded batches
+            self.index_documents([documents], batch_size=batch_size)
             
             # persist to disk
-            self.vectorstore.persist()
+            self.persist()
             return True
             
         except Exception as e:
             return False
     
+    def _encode_texts(self, texts: List[str], encode_batch_size: int, multi_process: bool) -> List[List[float]]:
+
+        # to encode texts with the sentence-transformers model, optionally over a process pool on all cores
+        model = self.base_embeddings.client
+        # same preprocessing as HuggingFaceEmbeddings so vectors match the query side
+        texts = [text.replace("\n", " ") for text in texts]
+        
+        if multi_process:
+            if self.encode_pool is None:
+                self.encode_pool = model.start_multi_process_pool(
+                    target_devices=['cpu'] * (os.cpu_count() or 1)
+                )
+            vectors = model.encode_multi_process(texts, self.encode_pool, batch_size=encode_batch_size)
+            # encode_multi_process has no normalize option
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        else:
+            vectors = model.encode(texts, batch_size=encode_batch_size, normalize_embeddings=True)
+        
+        return vectors.tolist()
+    
+    def embed_texts(self, texts: List[str], encode_batch_size: int = 64, multi_process: bool = False) -> List[List[float]]:
+
+        # to embed chunk texts, going through the embedding cache when enabled
+        self._initialize_embeddings()
+        
+        if self.embedding_cache is not None:
+            vectors = self.embedding_cache.get_or_compute(
+                texts,
+                lambda missing: self._encode_texts(missing, encode_batch_size, multi_process)
+            )
+            return vectors.tolist()
+        
+        return self._encode_texts(texts, encode_batch_size, multi_process)
+    
+    def stop_encode_pool(self):
+        # to shut down the multi-process encode workers
+        if self.encode_pool is not None:
+            self.base_embeddings.client.stop_multi_process_pool(self.encode_pool)
+            self.encode_pool = None
+    
+    def index_documents(self, batches: Iterable[List[Document]], batch_size: int = 100,
+                        encode_batch_size: int = 64, multi_process: bool = False) -> Dict:
+
+        # to embed chunks and write them to the backend in bounded add batches, so peak memory
+        # depends on batch_size and not on corpus size
+        # batches: iterable of chunk lists, e.g. DocumentIngester.iter_chunk_batches
+        # batch_size: chunks per embed + chroma add call
+        # encode_batch_size: batch size inside the sentence-transformers forward pass
+        # multi_process: fan encoding out over a sentence-transformers process pool
+        backend = self._get_or_create_backend()
+        lexical_index = self._get_lexical_index()
+        
+        total_chunks = 0
+        embed_seconds = 0.0
+        write_seconds = 0.0
+        start_time = time.time()
+        
+        for batch in batches:
+            for start in range(0, len(batch), batch_size):
+                documents = batch[start:start + batch_size]
+                texts = [doc.page_content for doc in documents]
+                
+                embed_start = time.time()
+                vectors = self.embed_texts(texts, encode_batch_size, multi_process)
+                embed_seconds += time.time() - embed_start
+                
+                write_start = time.time()
+                # content derived ids from the ingester (DocumentIngester.chunk_documents), random for other documents
+                ids = [doc.metadata.get('chunk_id') or str(uuid.uuid4()) for doc in documents]
+                metadatas = [doc.metadata for doc in documents]
+                backend.add(ids, vectors, texts, metadatas)
+                # keep the bm25 index in step with the collection
+                lexical_index.add(ids, texts, metadatas)
+                self._compact_index_stale = True
+                write_seconds += time.time() - write_start
+                
+                total_chunks += len(documents)
+        
+        elapsed = time.time() - start_time
+        
+        self.last_index_stats = {
+            "chunks": total_chunks,
+            "seconds": elapsed,
+            "embed_seconds": embed_seconds,
+            "write_seconds": write_seconds,
+            "chunks_per_second": total_chunks / elapsed if elapsed > 0 else 0.0,
+            "embed_chunks_per_second": total_chunks / embed_seconds if embed_seconds > 0 else 0.0
+        }
+        return self.last_index_stats
+    
+    def rebuild_from_directory(self, ingester: DocumentIngester, directory: str, exclude_files: List[str] = None,
+                               batch_size: int = 100, max_workers: Optional[int] = None,
+                               multi_process: bool = False, deduplicate: bool = True) -> Dict:
+
+        # to drop the collection and re-embed a whole dir through the streaming pipeline,
+        # writes a fresh manifest so later sync_directory calls stay incremental
+        # deduplicate: drop chunks another format of the same document already covers, per document group
+        self.delete_vectorstore()
+        
+        chunks_per_file = Counter()
+        loaded_files = []
+        parents = {}  # small-to-big mode: parents waiting for their children to be indexed
+        from dedup import ChunkDeduplicator
+        
+        deduplicator = ChunkDeduplicator() if deduplicate else None
+        
+        def counted_batches():
+            for batch in ingester.iter_chunk_batches(directory, exclude_files, max_workers=max_workers,
+                                                     deduplicator=deduplicator, loaded_files=loaded_files,
+                                                     parents=parents):
+                for doc in batch:
+                    chunks_per_file[doc.metadata['full_path']] += 1
+                self._store_parents(batch, parents)
+                yield batch
+        
+        stats = self.index_documents(counted_batches(), batch_size=batch_size, multi_process=multi_process)
+        self.persist()
+        
+        # files that failed to load are left out so the next sync retries them
+        manifest = {"files": {}, "chunking": ingester.get_chunking_config()}
+        for full_path in loaded_files:
+            fingerprint = ingester.get_file_fingerprint(full_path)
+            fingerprint["chunk_count"] = chunks_per_file[full_path]
+            manifest["files"][full_path] = fingerprint
+        self._save_manifest(manifest)
+        
+        stats["files"] = len(loaded_files)
+        if deduplicator is not None:
+            stats["dedup"] = deduplicator.get_report()
+        
+        self._ensure_query_embedding_table()
+        return stats
+    
+    def persist(self):
+        # to flush the collection and the bm25 index to disk, and rebuild the compact index if chunks changed
+        if self.backend is not None:
+            self.backend.persist()
+        if self.lexical_index is not None:
+            self.lexical_index.save(str(Path(self.persist_directory) / LEXICAL_INDEX_FILENAME))
+        if self.use_compact_index and self._compact_index_stale:
+            self.build_compact_index()
+    
+    def _get_parent_store(self, create: bool = False) -> Optional[ParentDocumentStore]:
+        # to open the parent passage store, None if this collection was not built in small-to-big mode
+        if self.parent_store is None:
+            store_path = Path(self.persist_directory) / PARENT_STORE_FILENAME
+            if create or store_path.exists():
+                from parent_store import ParentDocumentStore
+                self.parent_store = ParentDocumentStore(str(store_path))
+        return self.parent_store
+    
+    def _store_parents(self, chunks: List[Document], parents: Dict[str, Document]):
+        # to move the parents of these chunks from the pending dict into the store, parents whose
+        # children were all dropped as duplicates are never stored
+        parent_ids = dict.fromkeys(doc.metadata['parent_id'] for doc in chunks if doc.metadata.get('parent_id'))
+        ready = [parents.pop(parent_id) for parent_id in parent_ids if parent_id in parents]
+        if ready:
+            self._get_parent_store(create=True).put_many(ready)
+    
+    def expand_to_parents(self, docs_with_scores: List[tuple], max_parent_chars: int = 4000) -> List[tuple]:
+
+        # small-to-big: to replace matched child chunks by their parent passage, children of one parent
+        # collapse into one passage at the rank (and score) of its best child
+        # max_parent_chars: longer parents are cut to a window of this size around the matched children
+        # chunks without a stored parent are passed through unchanged
+        parent_store = self._get_parent_store()
+        if parent_store is None or not docs_with_scores:
+            return docs_with_scores
+        
+        parent_ids = list(dict.fromkeys(
+            doc.metadata['parent_id'] for doc, score in docs_with_scores if doc.metadata.get('parent_id')
+        ))
+        stored = parent_store.get_many(parent_ids)
+        
+        from langchain.schema import Document
+        
+        matched = {}  # parent id -> children in rank order
+        order = []  # (parent id or None, child, score) in rank order, one entry per passage
+        for doc, score in docs_with_scores:
+            parent_id = doc.metadata.get('parent_id')
+            if parent_id not in stored:
+                order.append((None, doc, score))
+            elif parent_id not in matched:
+                matched[parent_id] = [doc]
+                order.append((parent_id, doc, score))
+            else:
+                matched[parent_id].append(doc)
+        
+        expanded = []
+        for parent_id, doc, score in order:
+            if parent_id is None:
+                expanded.append((doc, score))
+                continue
+            
+            parent = stored[parent_id]
+            text = parent.page_content
+            if len(text) > max_parent_chars:
+                text = self._parent_window(parent, matched[parent_id], max_parent_chars)
+            
+            metadata = dict(parent.metadata)
+            metadata['vector_id'] = doc.metadata.get('vector_id')
+            metadata['matched_chunk_ids'] = ",".join(child.metadata.get('vector_id', '') for child in matched[parent_id])
+            for score_key in ('rerank_score', 'dense_rank', 'lexical_rank'):
+                if score_key in doc.metadata:
+                    metadata[score_key] = doc.metadata[score_key]
+            expanded.append((Document(page_content=text, metadata=metadata), score))
+        
+        return expanded
+    
+    def _parent_window(self, parent: Document, children: List[Document], max_chars: int) -> str:
+        # to cut max_chars of the parent around its matched children (around the best one if they are
+        # spread wider than that)
+        parent_start = parent.metadata.get('start_index', 0)
+        spans = [
+            (child.metadata.get('start_index', parent_start) - parent_start,
+             child.metadata.get('start_index', parent_start) - parent_start + len(child.page_content))
+            for child in children
+        ]
+        start = min(span[0] for span in spans)
+        end = max(span[1] for span in spans)
+        if end - start > max_chars:
+            start, end = spans[0]
+        
+        padding = max(max_chars - (end - start), 0) // 2
+        start = max(0, start - padding)
+        end = min(len(parent.page_content), start + max_chars)
+        start = max(0, end - max_chars)
+        return parent.page_content[start:end]
+    
+    def _compact_index_path(self) -> Path:
+        return Path(self.persist_directory) / COMPACT_INDEX_DIRNAME
+    
+    def _get_compact_index(self) -> Optional[CompactVectorIndex]:
+        # to open the compact index, None if it was never built or no longer holds the collection's chunks
+        # (searches then use the backend, and the next persist rebuilds it)
+        if self.compact_index is None:
+            index = CompactVectorIndex(str(self._compact_index_path()), rescore_factor=self.compact_rescore_factor)
+            if index.load():
+                if index.matches(self._get_or_create_backend().get_ids(None)):
+                    self.compact_index = index
+                else:
+                    self._compact_index_stale = True
+        return self.compact_index
+    
+    def build_compact_index(self, batch_size: int = 5000) -> Dict:
+
+        # to write the int8 (+ float32) copy of every vector in the collection, read from the backend in
+        # pages so memory stays bounded by batch_size
+        backend = self._get_or_create_backend()
+        count = backend.count()
+        start_time = time.time()
+        
+        def pages():
+            for page in backend.iter_batches(batch_size):
+                yield page["ids"], page["embeddings"], page["metadatas"]
+        
+        dimension = len(next(backend.iter_batches(1))["embeddings"][0]) if count else 384
+        self.compact_index = CompactVectorIndex.build(
+            str(self._compact_index_path()), count, dimension, pages(),
+            keep_full_precision=self.compact_full_precision,
+            rescore_factor=self.compact_rescore_factor
+        )
+        self._compact_index_stale = False
+        
+        return {**self.compact_index.get_statistics(), "seconds": time.time() - start_time}
+    
+    def measure_compact_recall(self, query_embeddings: Optional[List[List[float]]] = None, k: int = 10,
+                               filter_dict: Optional[Dict] = None, sample_size: int = 100) -> Dict:
+
+        # to measure recall@k of the compact index and of the float32 backend search for the same queries
+        # the reference is an exact brute-force search over the float32 vectors (chroma's hnsw is
+        # approximate too), without them the backend's results are the reference
+        # query_embeddings: defaults to sample_size vectors taken from the collection itself
+        compact_index = self._get_compact_index()
+        if compact_index is None:
+            raise ValueError("compact index not built or out of date, run build_compact_index first")
+        
+        if query_embeddings is None:
+            query_embeddings = next(self.backend.iter_batches(sample_size))["embeddings"]
+        
+        start_time = time.perf_counter()
+        backend_ids = [
+            [doc_id for doc_id, distance in ids]
+            for ids in self.backend.query(query_embeddings, k, filter_dict)
+        ]
+        backend_seconds = time.perf_counter() - start_time
+        
+        start_time = time.perf_counter()
+        compact_results = compact_index.search(query_embeddings, k=k, filter_dict=filter_dict)
+        compact_seconds = time.perf_counter() - start_time
+        compact_ids = [[doc_id for doc_id, distance in ids] for ids in compact_results]
+        
+        if compact_index.float_vectors is not None:
+            exact_results = compact_index.exact_search(query_embeddings, k=k, filter_dict=filter_dict)
+            reference_ids = [[doc_id for doc_id, distance in ids] for ids in exact_results]
+            reference = "exact"
+        else:
+            reference_ids = backend_ids
+            reference = self.backend.name
+        
+        return {
+            "queries": len(query_embeddings),
+            "k": k,
+            "reference": reference,
+            "backend": self.backend.name,
+            "recall_at_k": recall_at_k(compact_ids, reference_ids, k),
+            "backend_recall_at_k": recall_at_k(backend_ids, reference_ids, k),
+            "backend_ms_per_query": backend_seconds * 1000 / len(query_embeddings),
+            "compact_ms_per_query": compact_seconds * 1000 / len(query_embeddings),
+            **compact_index.get_statistics()
+        }
+    
+    def _get_lexical_index(self) -> BM25Index:
+
+        # to get the bm25 index, loading it from disk or building it from the collection if missing
+        if self.lexical_index is None:
+            index_path = Path(self.persist_directory) / LEXICAL_INDEX_FILENAME
+            
+            if index_path.exists():
+                self.lexical_index = BM25Index.load(str(index_path))
+            else:
+                self.lexical_index = BM25Index()
+                # stores built before the bm25 index existed get one built from their chunks
+                if self.backend is not None and self.backend.count() > 0:
+                    for page in self.backend.iter_batches(include_embeddings=False):
+                        self.lexical_index.add(page["ids"], page["documents"], page["metadatas"])
+                    self.lexical_index.save(str(index_path))
+        
+        return self.lexical_index
+    
+    def _manifest_path(self) -> Path:
+        return Path(self.persist_directory) / MANIFEST_FILENAME
+    
+    def _load_manifest(self) -> Dict:
+
+        # to load the per-file manifest (path -> mtime, size, content hash, chunk count)
+        manifest_path = self._manifest_path()
+        
+        if not manifest_path.exists():
+            return {"files": {}}
+        
+        try:
+            with open(manifest_path, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {"files": {}}
+    
+    def _save_manifest(self, manifest: Dict):
+        manifest_path = self._manifest_path()
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # write to temp file first so a crash mid-write doesn't corrupt the manifest
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+    
+    def _create_backend(self) -> VectorBackend:
+        return create_backend(self.backend_name, self.persist_directory, embedding_function=LazyEmbeddings(self))
+    
+    def _get_or_create_backend(self) -> VectorBackend:
+
+        # to open the collection, creating an empty one if nothing is persisted yet
+        if self.backend is None:
+            backend = self._create_backend()
+            backend.open()
+            self.backend = backend
+        return self.backend
+    
+    def is_loaded(self) -> bool:
+        # to check whether there is a collection to search
+        return self.backend is not None and self.backend.is_loaded()
+    
+    def delete_documents_by_path(self, full_path: str) -> int:
+
+        # to delete all chunks that came from one source file, returns number of chunks deleted
+        if not self.is_loaded():
+            return 0
+        
+        existing_ids = self.backend.get_ids({"full_path": full_path})
+        
+        if self._get_parent_store() is not None:
+            self.parent_store.delete_by_path(full_path)
+        
+        if existing_ids:
+            self.backend.delete(existing_ids)
+            self._get_lexical_index().remove(existing_ids)
+            self._compact_index_stale = True
+        
+        return len(existing_ids)
+    
+    def sync_directory(self, ingester: DocumentIngester, directory: str, exclude_files: List[str] = None,
+                       deduplicate: bool = True) -> Dict:
+
+        # to incrementally sync the collection with a directory: only new/changed files are
+        # re-chunked and re-embedded, chunks of removed files are deleted
+        # files are handled per document group (same name, different format), a change to one format
+        # re-ingests the whole group so cross-format deduplication stays correct
+        report = {
+            "added": [],
+            "updated": [],
+            "removed": [],
+            "unchanged": 0,
+            "failed": [],
+            "chunks_added": 0,
+            "chunks_deleted": 0,
+            "duplicates_removed": 0,
+            "index_seconds": 0.0
+        }
+        
+        self._get_or_create_backend()
+        manifest = self._load_manifest()
+        known_files = manifest.get("files", {})
+        source_files = ingester.find_source_files(directory, exclude_files)
+        seen_paths = set(str(file_path) for file_path in source_files)
+        
+        # chunking settings changed since the last ingest (or were not recorded), every file has to be re-chunked
+        rechunk_all = manifest.get("chunking") != ingester.get_chunking_config()
+        
+        # files that disappeared from the directory, their groups need re-ingesting too
+        dirty_groups = set()
+        for full_path in list(known_files.keys()):
+            if full_path not in seen_paths:
+                report["chunks_deleted"] += self.delete_documents_by_path(full_path)
+                report["removed"].append(full_path)
+                dirty_groups.add(ingester.get_group_key(full_path))
+                del known_files[full_path]
+        
+        for group in ingester.group_source_files(source_files):
+            changed = {}
+            
+            for file_path in group:
+                full_path = str(file_path)
+                previous = known_files.get(full_path)
+                
+                # cheap check first: same mtime and size means we don't even hash the file
+                fingerprint = ingester.get_file_fingerprint(full_path, with_hash=False)
+                if previous and previous["mtime"] == fingerprint["mtime"] and previous["size"] == fingerprint["size"]:
+                    continue
+                
+                fingerprint = ingester.get_file_fingerprint(full_path)
+                if previous and previous["content_hash"] == fingerprint["content_hash"]:
+                    # touched but not modified, just refresh mtime
+                    previous.update(fingerprint)
+                    continue
+                
+                changed[full_path] = fingerprint
+            
+            if not changed and not rechunk_all and ingester.get_group_key(group[0]) not in dirty_groups:
+                report["unchanged"] += len(group)
+                continue
+            
+            loaded = {}
+            for file_path in group:
+                full_path = str(file_path)
+                documents = ingester.load_document(full_path, directory)
+                if documents:
+                    loaded[full_path] = documents
+                elif full_path in changed:
+                    # keep old chunks and manifest entry so the file is retried next sync
+                    report["failed"].append(full_path)
+            
+            if not loaded:
+                continue
+            
+            parents = {}
+            chunks = ingester.chunk_documents([doc for documents in loaded.values() for doc in documents], parents=parents)
+            if deduplicate:
+                total_chunks = len(chunks)
+                from dedup import ChunkDeduplicator
+                chunks = ChunkDeduplicator().deduplicate(chunks)
+                report["duplicates_removed"] += total_chunks - len(chunks)
+            
+            for full_path in loaded:
+                if full_path in known_files:
+                    report["chunks_deleted"] += self.delete_documents_by_path(full_path)
+                    if full_path in changed:
+                        report["updated"].append(full_path)
+                elif full_path in changed:
+                    report["added"].append(full_path)
+            report["unchanged"] += len(group) - len(changed)
+            
+            self._store_parents(chunks, parents)
+            index_stats = self.index_documents([chunks])
+            report["chunks_added"] += len(chunks)
+            report["index_seconds"] += index_stats["seconds"]
+            
+            chunks_per_file = Counter(doc.metadata['full_path'] for doc in chunks)
+            for full_path in loaded:
+                fingerprint = changed.get(full_path) or known_files.get(full_path) or ingester.get_file_fingerprint(full_path)
+                fingerprint["chunk_count"] = chunks_per_file[full_path]
+                known_files[full_path] = fingerprint
+        
+        manifest["files"] = known_files
+        manifest["chunking"] = ingester.get_chunking_config()
+        self._save_manifest(manifest)
+        self.persist()
+        self._ensure_query_embedding_table()
+        
+        return report
+    
+    def get_chunks_by_source(self, source: str, filter_dict: Optional[Dict] = None) -> List[Document]:
+
+        # to fetch every chunk of one source file in document order (chunk_index)
+        # source: file name ("incident_postmortem_089.md"), path relative to the ingested dir
+        #   ("support/incident_postmortem_089.md") or full path, a file name shared by files in several
+        #   dirs returns the chunks of all of them, grouped by file
+        # filter_dict: extra where clause, e.g. the role filter
+        # each returned document carries its id in metadata['vector_id']
+        if not self.is_loaded():
+            return []
+        
+        from langchain.schema import Document
+        
+        try:
+            ids = []
+            for key in ('source_path', 'full_path', 'source'):
+                where = {key: source} if filter_dict is None else {"$and": [{key: source}, filter_dict]}
+                ids = self.backend.get_ids(where)
+                if ids:
+                    break
+            
+            documents = []
+            for doc_id, text, metadata in self.backend.get(ids):
+                metadata = dict(metadata)
+                metadata['vector_id'] = doc_id
+                documents.append(Document(page_content=text, metadata=metadata))
+            
+            documents.sort(key=lambda doc: (doc.metadata.get('full_path', ''), doc.metadata.get('chunk_index', 0)))
+            return documents
+        except Exception as e:
+            print(f"ERROR fetching chunks of {source}: {type(e).__name__}: {e}")
+            return []
+    
     def load_vectorstore(self) -> bool:
 
         # to load existing vector store from disk
@@ -64,15 +718,12 @@ class VectorStoreManager:
                 print(f"ERROR: Persist path does not exist: {persist_path.absolute()}")
                 return False
             
-            # Initialize embeddings
-            embeddings = self._initialize_embeddings()
-            
-            # Load vector store
-            self.vectorstore = Chroma(
-                persist_directory=self.persist_directory,
-                embedding_function=embeddings,
-                collection_name="skyro_knowledge"
-            )
+            # Load vector store, the embedding model itself is loaded by the first query (or warm_up)
+            backend = self._create_backend()
+            if not backend.load():
+                print(f"ERROR: No {backend.name} index found in {persist_path.absolute()}")
+                return False
+            self.backend = backend
             
             print(f"Successfully loaded vector store from {persist_path.absolute()}")
             return True
@@ -87,40 +738,270 @@ class VectorStoreManager:
 
         # to search for similar documents
         # k: Number of results to return
-        if self.vectorstore is None:
+        if not self.is_loaded():
             return []
         
         try:
-            if filter_dict:
-                results = self.vectorstore.similarity_search(
-                    query, 
-                    k=k, 
-                    filter=filter_dict
-                )
-            else:
-                results = self.vectorstore.similarity_search(query, k=k)
+            results = self.similarity_search_by_vector_with_score(self.embed_query(query), k=k, filter_dict=filter_dict)
             
-            return results
+            return [doc for doc, score in results]
             
         except Exception as e:
             return []
     
-    def similarity_search_with_score(self, query: str, k: int = 5) -> List[tuple]:
+    def _query_table_path(self) -> Path:
+        return Path(self.persist_directory) / QUERY_EMBEDDINGS_FILENAME
+    
+    def _get_query_table(self) -> Dict[str, List[float]]:
+        # to load the precomputed canned question embeddings, ignored if built with another model
+        if self._query_table is None:
+            table = {}
+            path = self._query_table_path()
+            if path.exists():
+                try:
+                    with np.load(path) as data:
+                        if str(data["model"]) == self.embedding_model_name:
+                            table = dict(zip(data["questions"].tolist(), data["embeddings"].tolist()))
+                except (OSError, KeyError, ValueError):
+                    table = {}
+            self._query_table = table
+        return self._query_table
+    
+    def build_query_embedding_table(self, questions: Optional[List[str]] = None) -> int:
+
+        # to precompute embeddings for questions we know will be asked (CANNED_QUESTIONS by default),
+        # so they never touch the model at query time; returns the number of questions stored
+        keys = list(dict.fromkeys(normalize_query(question) for question in (questions or CANNED_QUESTIONS)))
+        vectors = self._initialize_embeddings().embed_documents(keys) if keys else []
+        
+        path = self._query_table_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, questions=np.array(keys), embeddings=np.array(vectors, dtype=np.float32),
+                     model=np.array(self.embedding_model_name))
+        os.replace(tmp_path, path)
+        
+        self._query_table = dict(zip(keys, np.array(vectors, dtype=np.float32).tolist()))
+        return len(keys)
+    
+    def _ensure_query_embedding_table(self):
+        # to (re)build the table at ingest time when it is missing or the canned questions changed
+        expected = set(normalize_query(question) for question in CANNED_QUESTIONS)
+        if set(self._get_query_table()) != expected:
+            self.build_query_embedding_table()
+    
+    def _lookup_query_embedding(self, key: str) -> Optional[List[float]]:
+        vector = self._get_query_table().get(key)
+        if vector is not None:
+            self.query_cache_stats["table_hits"] += 1
+            return vector
+        
+        with self._query_cache_lock:
+            vector = self._query_cache.get(key)
+            if vector is not None:
+                self._query_cache.move_to_end(key)
+                self.query_cache_stats["hits"] += 1
+                return vector
+            self.query_cache_stats["misses"] += 1
+        return None
+    
+    def _remember_query_embedding(self, key: str, vector: List[float]):
+        if self.query_cache_size <= 0:
+            return
+        with self._query_cache_lock:
+            self._query_cache[key] = vector
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+    
+    def embed_query(self, query: str) -> List[float]:
+        # to embed a question the same way the vector search does, from the canned table or the lru if possible
+        key = normalize_query(query)
+        with span("embed", queries=1) as attributes:
+            vector = self._lookup_query_embedding(key)
+            attributes["encoded"] = int(vector is None)
+            
+            if vector is None:
+                vector = self._initialize_embeddings().embed_query(key)
+                self._remember_query_embedding(key, vector)
+        
+        return list(vector)
+    
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 5,
+                                               filter_dict: Optional[Dict] = None) -> List[tuple]:
+
+        # to search with an already computed query embedding
+        # each returned document carries its chroma id in metadata['vector_id']
+        if not self.is_loaded():
+            return []
+        
+        try:
+            return self._search_by_vectors([embedding], k, filter_dict)[0]
+            
+        except Exception as e:
+            record_error(e)
+            return []
+    
+    def similarity_search_with_score(self, query: str, k: int = 5, filter_dict: Optional[Dict] = None) -> List[tuple]:
         # to search with relevance scores
-        if self.vectorstore is None:
+        # filter_dict: chroma where clause applied inside the search, so k results all match it
+        if not self.is_loaded():
             return []
         
         try:
-            results = self.vectorstore.similarity_search_with_score(query, k=k)
-            return results
+            return self.similarity_search_by_vector_with_score(self.embed_query(query), k=k, filter_dict=filter_dict)
+
+        except Exception as e:
+            return []
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        # to embed many questions in one encode call instead of one call per question,
+        # questions already in the canned table or the lru are not encoded again
+        if not queries:
+            return []
+        
+        keys = [normalize_query(query) for query in queries]
+        vectors = {}
+        with span("embed", queries=len(keys)) as attributes:
+            for key in dict.fromkeys(keys):
+                vector = self._lookup_query_embedding(key)
+                if vector is not None:
+                    vectors[key] = vector
+            
+            missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+            attributes["encoded"] = len(missing)
+            if missing:
+                for key, vector in zip(missing, self._initialize_embeddings().embed_documents(missing)):
+                    vectors[key] = vector
+                    self._remember_query_embedding(key, vector)
+        
+        return [list(vectors[key]) for key in keys]
+
+    def similarity_search_batch(self, queries: List[str], k: int = 5, filter_dict: Optional[Dict] = None,
+                                query_embeddings: Optional[List[List[float]]] = None) -> List[List[tuple]]:
+
+        # to run many vector searches in one backend query (one filter for the whole batch), chunk texts
+        # are fetched once per unique id
+        # returns one list of (document, distance) pairs per query, in input order
+        # query_embeddings: reuse embeddings the caller already computed
+        if not self.is_loaded() or not queries:
+            return [[] for _ in queries]
+
+        try:
+            if query_embeddings is None:
+                query_embeddings = self.embed_queries(queries)
+
+            return self._search_by_vectors(query_embeddings, k, filter_dict)
+
+        except Exception as e:
+            record_error(e)
+            return [[] for _ in queries]
+
+    def _search_ids(self, query_embeddings: List[List[float]], k: int,
+                    filter_dict: Optional[Dict]) -> List[List[tuple]]:
+
+        # to get (id, distance) pairs per query from the compact index when enabled, otherwise from the backend
+        # role filters are applied inside the index search, "filtered" tells filtered searches apart
+        compact_index = self._get_compact_index() if self.use_compact_index else None
+        with span("search", index="compact" if compact_index is not None else self.backend_name,
+                  queries=len(query_embeddings), k=k, filtered=filter_dict is not None):
+            if compact_index is not None:
+                return compact_index.search(query_embeddings, k=k, filter_dict=filter_dict)
+
+            return self.backend.query(query_embeddings, k, filter_dict)
+
+    def _search_by_vectors(self, query_embeddings: List[List[float]], k: int,
+                           filter_dict: Optional[Dict]) -> List[List[tuple]]:
+
+        # to search and attach chunk texts, queries often share chunks so each one is fetched once
+        # each returned document carries its chroma id in metadata['vector_id']
+        from langchain.schema import Document
+
+        id_results = self._search_ids(query_embeddings, k, filter_dict)
+
+        unique_ids = list(dict.fromkeys(doc_id for ids in id_results for doc_id, distance in ids))
+        with span("fetch", chunks=len(unique_ids)):
+            chunks = {doc_id: (text, metadata) for doc_id, text, metadata in self.backend.get(unique_ids)}
+
+        batch_results = []
+        for ids in id_results:
+            docs_with_scores = []
+            for doc_id, distance in ids:
+                if doc_id not in chunks:
+                    continue
+                text, metadata = chunks[doc_id]
+                metadata = dict(metadata)
+                metadata['vector_id'] = doc_id
+                docs_with_scores.append((Document(page_content=text, metadata=metadata), distance))
+            batch_results.append(docs_with_scores)
+
+        return batch_results
+
+    def hybrid_search(self, query: str, k: int = 5, filter_dict: Optional[Dict] = None,
+                      query_embedding: Optional[List[float]] = None, candidate_k: Optional[int] = None,
+                      rrf_k: int = 60) -> List[tuple]:
+
+        # to combine bm25 and vector results with reciprocal rank fusion
+        # returns (document, fused score) pairs, higher score is better, each document carries its rank in
+        # either list as metadata['dense_rank'] / metadata['lexical_rank'] (absent if that list missed it)
+        # query_embedding: reuse an embedding the caller already computed
+        # candidate_k: results taken from each ranking before fusing, defaults to 4 * k
+        # rrf_k: rank offset in 1 / (rrf_k + rank), larger values flatten the rank weighting
+        if not self.is_loaded():
+            return []
+        
+        try:
+            if candidate_k is None:
+                candidate_k = max(4 * k, 20)
+            if query_embedding is None:
+                query_embedding = self.embed_query(query)
+            
+            vector_results = self.similarity_search_by_vector_with_score(query_embedding, k=candidate_k, filter_dict=filter_dict)
+            with span("lexical", k=candidate_k, filtered=filter_dict is not None):
+                lexical_results = self._get_lexical_index().search(query, k=candidate_k, filter_dict=filter_dict)
+            
+            fused_scores = {}
+            documents = {}
+            lexical_ranks = {}
+            
+            for rank, (doc, distance) in enumerate(vector_results, 1):
+                doc_id = doc.metadata['vector_id']
+                doc.metadata['dense_rank'] = rank
+                documents[doc_id] = doc
+                fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+            
+            for rank, (doc_id, bm25_score) in enumerate(lexical_results, 1):
+                lexical_ranks[doc_id] = rank
+                fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+            
+            top_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:k]
+            
+            # chunks found only by bm25 still need their text and metadata
+            missing_ids = [doc_id for doc_id in top_ids if doc_id not in documents]
+            if missing_ids:
+                from langchain.schema import Document
+                with span("fetch", chunks=len(missing_ids)):
+                    fetched = self.backend.get(missing_ids)
+                for doc_id, text, metadata in fetched:
+                    metadata = dict(metadata)
+                    metadata['vector_id'] = doc_id
+                    documents[doc_id] = Document(page_content=text, metadata=metadata)
+            
+            for doc_id, rank in lexical_ranks.items():
+                if doc_id in documents:
+                    documents[doc_id].metadata['lexical_rank'] = rank
+            
+            return [(documents[doc_id], fused_scores[doc_id]) for doc_id in top_ids if doc_id in documents]
             
         except Exception as e:
+            record_error(e)
             return []
     
     def get_collection_stats(self) -> Dict:
 
         # to get statistics about the vector store collection
-        if self.vectorstore is None:
+        if not self.is_loaded():
             return {
                 "total_documents": 0,
                 "embedding_dimension": 0,
@@ -129,18 +1010,36 @@ class VectorStoreManager:
             }
         
         try:
-            # get collection
-            collection = self.vectorstore._collection
-            count = collection.count()
-            
-            return {
-                "total_documents": count,
+            stats = {
+                "backend": self.backend.name,
+                "total_documents": self.backend.count(),
                 "embedding_dimension": 384,  # all-MiniLM-L6-v2 dimension
                 "model_name": self.embedding_model_name,
                 "persist_directory": self.persist_directory,
                 "status": "loaded"
             }
             
+            if self.embedding_cache is not None:
+                stats["embedding_cache"] = self.embedding_cache.get_statistics()
+            
+            if self.last_index_stats is not None:
+                stats["last_index"] = self.last_index_stats
+            
+            if self.use_compact_index and self._get_compact_index() is not None:
+                stats["compact_index"] = self.compact_index.get_statistics()
+            
+            if self._get_parent_store() is not None:
+                stats["parent_documents"] = self.parent_store.count()
+            
+            stats["query_embedding_cache"] = {
+                **self.query_cache_stats,
+                "entries": len(self._query_cache),
+                "max_entries": self.query_cache_size,
+                "table_entries": len(self._get_query_table())
+            }
+            
+            return stats
+            
         except Exception as e:
             return {
                 "total_documents": 0,
@@ -155,12 +1054,89 @@ class VectorStoreManager:
             import shutil
             persist_path = Path(self.persist_directory)
             
+            if self.parent_store is not None:
+                self.parent_store.close()
+                self.parent_store = None
+            
             if persist_path.exists():
-                shutil.rmtree(persist_path)
-                self.vectorstore = None
+                # everything but the embedding cache (and its sqlite journal), re-embedding is the slow part
+                cache_path = Path(self.embedding_cache_path).resolve()
+                for child in persist_path.iterdir():
+                    if child.resolve().parent == cache_path.parent and child.name.startswith(cache_path.name):
+                        continue
+                    if child.is_dir():
+                        shutil.rmtree(child)
+                    else:
+                        child.unlink()
+                self.backend = None
+                self.lexical_index = None
+                self._query_table = None
+                self.compact_index = None
                 return True
             else:
                 return False
                 
         except Exception as e:
             return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or incrementally sync the Skyro vector store")
+    parser.add_argument("--data-dir", default=str(Path(__file__).parent.parent / "skyro_dataset" / "data"))
+    parser.add_argument("--persist-dir", default="./chroma_db")
+    parser.add_argument("--full", action="store_true", help="drop the existing store and re-embed everything")
+    parser.add_argument("--batch-size", type=int, default=100, help="chunks per embed + chroma add batch")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes for --full, defaults to cpu count")
+    parser.add_argument("--multi-process", action="store_true", help="encode over a process pool on all cores")
+    parser.add_argument("--compact", action="store_true",
+                        help="also build the int8 compact index and report its recall against an exact search")
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default="chroma",
+                        help="vector storage, numpy = exact search over a memory mapped matrix")
+    parser.add_argument("--parent-chunk-size", type=int, default=None,
+                        help="small-to-big: index small chunks and store their parents of this size for expansion")
+    args = parser.parse_args()
+    
+    from ingest import DocumentIngester
+    from chunking import CHUNK_PROFILES
+    
+    manager = VectorStoreManager(persist_directory=args.persist_dir, use_compact_index=args.compact,
+                                 backend=args.backend)
+    ingester = DocumentIngester(chunk_profiles=CHUNK_PROFILES, parent_chunk_size=args.parent_chunk_size)
+    
+    if args.full:
+        build_stats = manager.rebuild_from_directory(
+            ingester, args.data_dir,
+            batch_size=args.batch_size,
+            max_workers=args.workers,
+            multi_process=args.multi_process
+        )
+        manager.stop_encode_pool()
+        print(f"indexed {build_stats['chunks']} chunks from {build_stats['files']} files in {build_stats['seconds']:.1f}s "
+              f"({build_stats['chunks_per_second']:.1f} chunks/sec, embedding {build_stats['embed_chunks_per_second']:.1f} chunks/sec)")
+        if "dedup" in build_stats:
+            print(f"near-duplicate chunks removed: {build_stats['dedup']['duplicates_removed']} "
+                  f"({build_stats['dedup']['dedup_ratio']:.1%} of {build_stats['dedup']['total_chunks']})")
+    else:
+        sync_report = manager.sync_directory(ingester, args.data_dir)
+        
+        print(f"added: {len(sync_report['added'])}, updated: {len(sync_report['updated'])}, "
+              f"removed: {len(sync_report['removed'])}, unchanged: {sync_report['unchanged']}, "
+              f"failed: {len(sync_report['failed'])}")
+        print(f"chunks added: {sync_report['chunks_added']}, chunks deleted: {sync_report['chunks_deleted']}, "
+              f"near-duplicates removed: {sync_report['duplicates_removed']}")
+        for full_path in sync_report["failed"]:
+            print(f"  could not load {full_path}")
+    
+    if args.compact:
+        if manager._get_compact_index() is None:
+            manager.build_compact_index()
+        recall = manager.measure_compact_recall()
+        print(f"compact index: {recall['vectors']} vectors, int8 {recall['int8_bytes'] / 1e6:.1f} MB, "
+              f"float32 {recall['float32_bytes'] / 1e6:.1f} MB")
+        print(f"recall@{recall['k']} vs {recall['reference']} search: compact {recall['recall_at_k']:.3f} "
+              f"({recall['compact_ms_per_query']:.2f} ms/query), {recall['backend']} {recall['backend_recall_at_k']:.3f} "
+              f"({recall['backend_ms_per_query']:.2f} ms/query)")
+    
+    if manager.embedding_cache is not None:
+        cache_stats = manager.embedding_cache.get_statistics()
+        print(f"embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
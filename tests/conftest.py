@@ -0,0 +1,8 @@
+# the modules in src import each other by plain name (they are run from src), put it on the path
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+DATA_DIR = Path(__file__).resolve().parent.parent / "skyro_dataset" / "data"
+
+sys.path.insert(0, str(SRC_DIR))
@@ -0,0 +1,32 @@
+# numpy vector backend persistence
+
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from backends import VectorBackend, NumpyBackend
+
+
+def test_load_restores_index_moved_aside_by_an_interrupted_persist(tmp_path):
+    backend = NumpyBackend(str(tmp_path))
+    backend.open()
+    backend.add(["a", "b"], [[1.0, 0.0], [0.0, 1.0]], ["alpha", "beta"], [{"source": "a.md"}, {"source": "b.md"}])
+    backend.persist()
+
+    # persist() stopped after moving the old files aside
+    os.replace(backend.directory, backend.directory.with_name(backend.directory.name + ".old"))
+
+    reopened = NumpyBackend(str(tmp_path))
+    assert reopened.load()
+    assert sorted(reopened.get_ids(None)) == ["a", "b"]
+
+
+def test_backend_missing_a_method_fails_on_creation():
+    class Incomplete(VectorBackend):
+        def load(self) -> bool:
+            return False
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,34 @@
+# structure-aware markdown chunking
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from chunking import MarkdownChunker
+
+
+def test_bare_heading_before_sibling_is_kept():
+    text = "## Intro\n\nIntro text.\n\n## Limits\n\n## Daily limits\n\nUp to 10,000 USD per day.\n"
+
+    chunks = MarkdownChunker().split_text(text)
+
+    assert [chunk["heading_path"] for chunk in chunks] == ["Intro", "Daily limits"]
+    assert chunks[1]["text"] == "## Limits\n\n## Daily limits\n\nUp to 10,000 USD per day."
+    assert chunks[1]["start_index"] == text.index("## Limits")
+
+
+def test_bare_heading_at_end_of_file_is_kept():
+    text = "## Intro\n\nIntro text.\n\n## Appendix\n"
+
+    chunks = MarkdownChunker().split_text(text)
+
+    assert [chunk["text"] for chunk in chunks] == ["## Intro\n\nIntro text.\n\n## Appendix"]
+
+
+def test_bare_heading_goes_with_its_first_subsection():
+    text = "# Title\n\n" + "Intro. " * 100 + "\n\n## Fees\n\n### Card fees\n\n1.5% per payment.\n"
+
+    chunks = MarkdownChunker().split_text(text)
+
+    assert chunks[-1]["heading_path"] == "Title > Fees"
+    assert chunks[-1]["text"].startswith("## Fees\n\n### Card fees")
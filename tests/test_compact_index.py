@@ -0,0 +1,23 @@
+# int8 compact index staleness check
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from compact_index import CompactVectorIndex
+
+
+def build(directory, ids):
+    vectors = np.eye(len(ids), 4, dtype=np.float32)
+    metadatas = [{"source": f"{doc_id}.md"} for doc_id in ids]
+    return CompactVectorIndex.build(str(directory), len(ids), 4, [(ids, vectors, metadatas)])
+
+
+def test_index_matches_only_the_ids_it_was_built_from(tmp_path):
+    build(tmp_path / "compact_index", ["a", "b", "c"])
+
+    index = CompactVectorIndex(str(tmp_path / "compact_index"))
+    assert index.load()
+    assert index.matches(["c", "a", "b"])
+    assert not index.matches(["a", "b"])
+    assert not index.matches(["a", "b", "d"])
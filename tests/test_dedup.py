@@ -0,0 +1,79 @@
+# cross-format deduplication on real md/pdf pairs from the dataset
+
+import shutil
+
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("langchain_community")
+pytest.importorskip("pypdf")
+
+from conftest import DATA_DIR
+from dedup import ChunkDeduplicator
+from ingest import DocumentIngester
+
+DOCUMENT_PAIRS = [
+    DATA_DIR / "compliance" / "kyc_process",
+    DATA_DIR / "operations" / "chargeback_procedures",
+]
+
+
+def load_group_chunks(ingester, stem):
+    documents = ingester.load_document_group([stem.with_suffix(".md"), stem.with_suffix(".pdf")])
+    return ingester.chunk_documents(documents)
+
+
+@pytest.mark.parametrize("stem", DOCUMENT_PAIRS, ids=lambda stem: stem.name)
+def test_pdf_copy_is_dropped_with_flat_chunking(stem):
+    chunks = load_group_chunks(DocumentIngester(structure_aware=False), stem)
+    md_chunks = [chunk for chunk in chunks if chunk.metadata["file_type"] == "md"]
+
+    kept = ChunkDeduplicator().deduplicate(chunks)
+
+    assert [chunk.metadata["file_type"] for chunk in kept] == ["md"] * len(md_chunks)
+    assert any("alternate_sources" in chunk.metadata for chunk in kept)
+
+
+def test_chunks_of_one_file_are_never_compared():
+    ingester = DocumentIngester(structure_aware=False)
+    documents = ingester.load_document_group([DOCUMENT_PAIRS[0].with_suffix(".md")])
+    # the same text twice in one file is the author's choice, not a format copy
+    documents[0].page_content = documents[0].page_content * 2
+    chunks = ingester.chunk_documents(documents)
+
+    assert ChunkDeduplicator().deduplicate(chunks) == chunks
+
+
+def test_stream_deduplicates_per_group_like_sync(tmp_path):
+    # rebuild_from_directory shares one deduplicator across the stream, sync_directory uses one per group,
+    # both must index the same chunks
+    for stem in DOCUMENT_PAIRS:
+        for suffix in (".md", ".pdf"):
+            shutil.copy(stem.with_suffix(suffix), tmp_path / stem.with_suffix(suffix).name)
+    ingester = DocumentIngester(structure_aware=False)
+
+    streamed = [
+        chunk.metadata["chunk_id"]
+        for batch in ingester.iter_chunk_batches(str(tmp_path), max_workers=1, deduplicator=ChunkDeduplicator())
+        for chunk in batch
+    ]
+    per_group = [
+        chunk.metadata["chunk_id"]
+        for group in ingester.group_source_files(ingester.find_source_files(str(tmp_path)))
+        for chunk in ChunkDeduplicator().deduplicate(
+            ingester.chunk_documents(ingester.load_document_group(group, str(tmp_path)))
+        )
+    ]
+
+    assert sorted(streamed) == sorted(per_group)
+
+
+@pytest.mark.parametrize("stem", DOCUMENT_PAIRS, ids=lambda stem: stem.name)
+def test_pdf_copy_is_dropped_with_structure_aware_chunking(stem):
+    # md is chunked by section and pdf by characters, so no single md chunk covers a pdf chunk
+    chunks = load_group_chunks(DocumentIngester(structure_aware=True), stem)
+    md_chunks = [chunk for chunk in chunks if chunk.metadata["file_type"] == "md"]
+
+    kept = ChunkDeduplicator().deduplicate(chunks)
+
+    assert [chunk.metadata["file_type"] for chunk in kept] == ["md"] * len(md_chunks)
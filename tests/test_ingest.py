@@ -0,0 +1,39 @@
+# streaming ingestion in small-to-big mode
+
+import shutil
+
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("langchain_community")
+pytest.importorskip("pypdf")
+pytest.importorskip("numpy")
+
+from conftest import DATA_DIR
+from dedup import ChunkDeduplicator
+from ingest import DocumentIngester
+from vectorstore import VectorStoreManager
+
+
+def test_parents_of_dropped_copies_are_not_kept_pending(tmp_path):
+    # the same loop as rebuild_from_directory, without embedding: parents of the pdf copy, whose children
+    # are all duplicates of the md, must not wait in the pending dict until the rebuild ends
+    stem = DATA_DIR / "compliance" / "kyc_process"
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for suffix in (".md", ".pdf"):
+        shutil.copy(stem.with_suffix(suffix), data_dir / stem.with_suffix(suffix).name)
+
+    ingester = DocumentIngester(chunk_size=400, parent_chunk_size=2000)
+    manager = VectorStoreManager(persist_directory=str(tmp_path / "db"))
+    parents = {}
+    kept_parent_ids = set()
+
+    for batch in ingester.iter_chunk_batches(str(data_dir), max_workers=1, deduplicator=ChunkDeduplicator(),
+                                             parents=parents):
+        assert {chunk.metadata["file_type"] for chunk in batch} == {"md"}
+        kept_parent_ids.update(chunk.metadata["parent_id"] for chunk in batch)
+        manager._store_parents(batch, parents)
+
+    assert parents == {}
+    assert manager.parent_store.count() == len(kept_parent_ids)